@@ -0,0 +1,214 @@
+# pylint: disable=no-value-for-parameter, too-many-locals
+"""
+Benchmark of the data pipeline run at the start of each experiment:
+    load_data - src.datasets.{dataset}.load_data
+    common_processor - src.data.common_processor for each data_type
+    data_postfactory - model-specific postprocessing (e.g. BNT padding)
+    cross_validation_split - outer train/test split
+    dataloader_factory - train/valid/test split and tensor datasets
+    full_pass - iteration over all the resulting dataloaders
+Each stage is measured for wall time, peak RSS, the size of its output
+and the bytes it copied (output arrays and tensors not sharing memory with the stage input;
+intermediate copies show up in the peak RSS only).
+Results are saved to cfg.output_dir as JSON and CSV, and compared with cfg.baseline if set.
+
+Usage:
+    PYTHONPATH=. python benchmarks/bench_data.py n_subjects=[1000,10000]
+    PYTHONPATH=. python benchmarks/bench_data.py dataset=fbirn
+"""
+from copy import deepcopy
+import gc
+from importlib import import_module
+import time
+
+from omegaconf import OmegaConf, DictConfig, open_dict
+import hydra
+import numpy as np
+import pandas as pd
+import torch
+from torch.utils.data import DataLoader
+
+from benchmarks.common import (
+    CONF_ROOT,
+    synthetic_cfg,
+    set_model_config,
+    get_HPs,
+    save_results,
+    check_baseline,
+)
+from src.data import common_processor, data_postfactory
+from src.dataloader import cross_validation_split, dataloader_factory
+from src.profiling import PeakMemory
+
+KEYS = ["dataset", "n_subjects", "time_length", "n_components", "stage", "variant"]
+
+
+@hydra.main(version_base=None, config_path="conf", config_name="bench_data")
+def start(bench_cfg: DictConfig):
+    """Run the benchmark for each dataset size"""
+    if bench_cfg.dataset == "synthetic":
+        sizes = [
+            (n_subjects, time_length, n_components)
+            for n_subjects in bench_cfg.n_subjects
+            for time_length in bench_cfg.time_lengths
+            for n_components in bench_cfg.n_components
+        ]
+    else:
+        # size of a real dataset is fixed
+        sizes = [(None, None, None)]
+
+    results = []
+    for size in sizes:
+        results += benchmark_pipeline(bench_cfg, *size)
+        gc.collect()
+
+    df = pd.DataFrame(results)
+    print(
+        df[
+            KEYS + ["time_s", "rss_increase_mb", "output_mb", "copied_mb"]
+        ].to_string(index=False)
+    )
+
+    results_path = save_results(results, bench_cfg.output_dir, "data", bench_cfg)
+    check_baseline(bench_cfg, results, results_path, KEYS, {"time_s": False})
+
+
+def benchmark_pipeline(bench_cfg, n_subjects, time_length, n_components):
+    """Return the results of every pipeline stage for a single dataset size"""
+    cfg = synthetic_cfg(bench_cfg, n_subjects or 0, time_length or 0, n_components or 0)
+    with open_dict(cfg):
+        cfg.mode.batch_size = bench_cfg.batch_size
+        cfg.mode.n_splits = bench_cfg.n_splits
+        cfg.mode.n_trials = bench_cfg.n_trials
+        if bench_cfg.dataset != "synthetic":
+            cfg.dataset = OmegaConf.load(
+                CONF_ROOT.joinpath(f"dataset/{bench_cfg.dataset}.yaml")
+            )
+
+    results = []
+    # [n_subjects, time_length, n_components] of the loaded data
+    shape = [n_subjects, time_length, n_components]
+
+    def run(stage, variant, function, inputs):
+        output, stage_results = run_stage(function, inputs)
+        results.append(
+            {
+                "dataset": bench_cfg.dataset,
+                "n_subjects": shape[0],
+                "time_length": shape[1],
+                "n_components": shape[2],
+                "stage": stage,
+                "variant": variant,
+                **stage_results,
+            }
+        )
+        print(results[-1])
+        return output
+
+    dataset_module = import_module(f"src.datasets.{bench_cfg.dataset}")
+    raw_data = run("load_data", None, lambda: dataset_module.load_data(cfg), ())
+    shape[:] = raw_data[0].shape
+    for row in results:
+        row.update(zip(["n_subjects", "time_length", "n_components"], shape))
+
+    # processed data is shared by the models with the same data_type
+    processed = {}
+    for data_type in bench_cfg.data_types:
+        with open_dict(cfg):
+            cfg.model = {"data_type": data_type}
+        processed[data_type] = run(
+            "common_processor",
+            data_type,
+            lambda: common_processor(cfg, raw_data),
+            raw_data,
+        )
+
+    for model_name in bench_cfg.models:
+        set_model_config(cfg, model_name)
+        data_type = cfg.model.data_type if "data_type" in cfg.model else "TS"
+        if data_type not in processed:
+            print(f"Skipping '{model_name}': data_type '{data_type}' is not benchmarked")
+            continue
+        main_data, data_info = processed[data_type]
+        with open_dict(cfg):
+            cfg.dataset.data_info = {"main": data_info}
+        model_cfg = get_HPs(cfg, import_module(f"src.models.{model_name}"), "default")
+
+        # data_postfactory may modify the data in place
+        data = {"main": deepcopy(main_data)}
+        data = run(
+            "data_postfactory",
+            model_name,
+            lambda: data_postfactory(cfg, model_cfg, data),
+            data,
+        )
+        run(
+            "cross_validation_split",
+            model_name,
+            lambda: cross_validation_split(data["main"], cfg.mode.n_splits, 0),
+            data,
+        )
+        dataloaders = run(
+            "dataloader_factory",
+            model_name,
+            lambda: dataloader_factory(cfg, data, k=0, trial=0),
+            data,
+        )
+        run("full_pass", model_name, lambda: full_pass(dataloaders), ())
+
+    return results
+
+
+def run_stage(function, inputs):
+    """Run the stage, return its output and its time, memory and copy statistics"""
+    # stages may replace the arrays of their input dicts in place
+    input_arrays = list(arrays(inputs))
+
+    gc.collect()
+    with PeakMemory(trace_python=False) as memory:
+        start = time.perf_counter()
+        output = function()
+        elapsed = time.perf_counter() - start
+
+    output_bytes, copied_bytes = 0, 0
+    for array in arrays(output):
+        output_bytes += array.nbytes
+        if not any(np.may_share_memory(array, other) for other in input_arrays):
+            copied_bytes += array.nbytes
+
+    mb = 1024**2
+    return output, {
+        "time_s": elapsed,
+        **memory.results,
+        "output_mb": output_bytes / mb,
+        "copied_mb": copied_bytes / mb,
+    }
+
+
+def arrays(obj):
+    """Yield numpy arrays and (CPU) tensors as arrays found in nested dicts/lists/tuples/DataLoaders"""
+    if isinstance(obj, np.ndarray):
+        yield obj
+    elif isinstance(obj, torch.Tensor):
+        yield obj.detach().cpu().numpy()
+    elif isinstance(obj, DataLoader):
+        yield from arrays(getattr(obj.dataset, "tensors", ()))
+    elif isinstance(obj, dict):
+        for value in obj.values():
+            yield from arrays(value)
+    elif isinstance(obj, (list, tuple)):
+        for value in obj:
+            yield from arrays(value)
+
+
+def full_pass(dataloaders):
+    """Iterate over all the dataloaders, return the number of batches"""
+    n_batches = 0
+    for dataloader in dataloaders.values():
+        for _ in dataloader:
+            n_batches += 1
+    return n_batches
+
+
+if __name__ == "__main__":
+    start()
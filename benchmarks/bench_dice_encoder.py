@@ -0,0 +1,190 @@
+# pylint: disable=no-value-for-parameter, broad-except, too-many-locals
+"""
+Benchmark of the DICE temporal encoder implementations (model_cfg.lstm.impl, see src.models.dice.DICE):
+    torch - nn.LSTM over batch_size * n_components single-feature sequences
+    scan - the same LSTM as an explicit channel-batched scan with fused gate matmuls
+    conv - gated dilated convolutions approximating the LSTM
+Each implementation is measured on synthetic data for each point of the
+batch size x time length x component count x LSTM layers grid, on CPU:
+    scope=encoder - the temporal encoder alone, on [batch_size * n_components, time_length, 1]
+    scope=model - the whole DICE model
+    mode=forward - inference forward pass (eval mode, no grad)
+    mode=forward_backward - forward pass, loss and backward pass
+The scan implementation shares the parameters of the torch one, max_abs_diff is the largest
+difference of their logits (scope=model) or encoder outputs (scope=encoder).
+Results are saved to cfg.output_dir as JSON and CSV, and compared with cfg.baseline if set.
+
+Usage:
+    PYTHONPATH=. python benchmarks/bench_dice_encoder.py batch_sizes=[32] time_lengths=[140,490]
+"""
+import gc
+from importlib import import_module
+
+from omegaconf import DictConfig, open_dict
+import hydra
+import pandas as pd
+import torch
+
+from benchmarks.common import (
+    synthetic_cfg,
+    set_model_config,
+    measure,
+    save_results,
+    check_baseline,
+)
+from benchmarks.bench_models import saved_tensors_mb
+from src.data import data_factory
+from src.model import model_factory
+from src.model_utils import criterion_factory
+from src.models.dice import lstm_scan
+
+KEYS = ["impl", "scope", "mode", "batch_size", "time_length", "n_components", "num_layers"]
+
+
+@hydra.main(version_base=None, config_path="conf", config_name="bench_dice_encoder")
+def start(bench_cfg: DictConfig):
+    """Run the benchmark grid"""
+    if bench_cfg.threads is not None:
+        torch.set_num_threads(bench_cfg.threads)
+
+    results = []
+    for time_length in bench_cfg.time_lengths:
+        for n_components in bench_cfg.n_components:
+            for batch_size in bench_cfg.batch_sizes:
+                for num_layers in bench_cfg.num_layers:
+                    point = {
+                        "batch_size": batch_size,
+                        "time_length": time_length,
+                        "n_components": n_components,
+                        "num_layers": num_layers,
+                    }
+                    print(f"Benchmarking {point}")
+                    try:
+                        results += benchmark_point(bench_cfg, point)
+                    except Exception as e:
+                        print(f"Failed: {e!r}")
+                        results.append({**point, "impl": None, "error": repr(e)})
+                    gc.collect()
+
+    df = pd.DataFrame(results)
+    summary = [
+        column
+        for column in KEYS
+        + ["throughput", "speedup", "latency_p50_ms", "saved_tensors_mb", "max_abs_diff", "error"]
+        if column in df.columns
+    ]
+    print(df[summary].to_string(index=False))
+
+    results_path = save_results(results, bench_cfg.output_dir, "dice_encoder", bench_cfg)
+    check_baseline(
+        bench_cfg,
+        results,
+        results_path,
+        KEYS,
+        {"throughput": True},
+    )
+
+
+def build_model(cfg, bench_cfg, impl, num_layers):
+    """Return DICE with the default HPs, the given encoder implementation and number of LSTM layers"""
+    with open_dict(cfg):
+        cfg.model.lstm_impl = impl
+    model_cfg = import_module("src.models.dice").default_HPs(cfg)
+    model_cfg.lstm.num_layers = num_layers
+    if impl == "conv":
+        model_cfg.lstm.kernel_size = bench_cfg.kernel_size
+
+    torch.manual_seed(bench_cfg.seed)
+    return model_factory(cfg, model_cfg), criterion_factory(cfg, model_cfg)
+
+
+def encoder(model):
+    """Temporal encoder of the model as a function of [batch_size * n_components, time_length, 1]"""
+    if model.lstm_impl == "torch":
+        return lambda x: model.lstm(x)[0]
+    if model.lstm_impl == "scan":
+        return lambda x: lstm_scan(model.lstm, x)
+    return model.lstm
+
+
+def benchmark_point(bench_cfg, point):
+    """Return the results of all implementations, scopes and modes for a single grid point"""
+    cfg = synthetic_cfg(
+        bench_cfg, point["batch_size"], point["time_length"], point["n_components"]
+    )
+    set_model_config(cfg, "dice")
+    data = data_factory(cfg)
+
+    device = torch.device("cpu")
+    x = torch.tensor(data["main"]["TS"], dtype=torch.float32)
+    y = torch.tensor(data["main"]["labels"], dtype=torch.int64)
+    B, T, C = x.shape
+    x_encoder = x.permute(0, 2, 1).reshape(B * C, T, 1)
+
+    models = {}
+    for impl in bench_cfg.impls:
+        models[impl], criterion = build_model(cfg, bench_cfg, impl, point["num_layers"])
+    if "torch" in models and "scan" in models:
+        models["scan"].load_state_dict(models["torch"].state_dict())
+
+    results = []
+    reference = {}
+    for impl, model in models.items():
+        scopes = {
+            "encoder": (encoder(model), x_encoder, lambda output: output.sum()),
+            "model": (model, x, lambda output: criterion(output, y, model, device)),
+        }
+        for scope, (function, inputs, loss) in scopes.items():
+
+            def forward():
+                with torch.no_grad():
+                    return function(inputs)
+
+            def forward_backward():
+                model.zero_grad()
+                loss(function(inputs)).backward()
+
+            model.eval()
+            output = forward()
+            if impl == "torch":
+                reference[scope] = output
+            max_abs_diff = (
+                (output - reference[scope]).abs().max().item()
+                if impl == "scan" and scope in reference
+                else None
+            )
+
+            for mode, step in [("forward", forward), ("forward_backward", forward_backward)]:
+                model.train(mode != "forward")
+                timing = measure(step, bench_cfg.warmup, bench_cfg.iters)
+                results.append(
+                    {
+                        "impl": impl,
+                        "scope": scope,
+                        "mode": mode,
+                        **point,
+                        "throughput": B / timing["latency_mean_ms"] * 1000,
+                        **timing,
+                        "saved_tensors_mb": saved_tensors_mb(step)
+                        if mode == "forward_backward"
+                        else None,
+                        "max_abs_diff": max_abs_diff,
+                    }
+                )
+            gc.collect()
+
+    # speedup relative to nn.LSTM
+    baseline = {
+        (row["scope"], row["mode"]): row["throughput"]
+        for row in results
+        if row["impl"] == "torch"
+    }
+    for row in results:
+        if (row["scope"], row["mode"]) in baseline:
+            row["speedup"] = row["throughput"] / baseline[(row["scope"], row["mode"])]
+
+    return results
+
+
+if __name__ == "__main__":
+    start()
@@ -0,0 +1,221 @@
+# pylint: disable=no-value-for-parameter, broad-except, too-many-locals
+"""
+Benchmark of the FBNetGen blocks (see src.models.src.fbnetgen_modules) on random node embeddings:
+    embed2graph - Embed2GraphByLinear, the learned graph of the region embeddings [batch_size, roi_num, input_dim]:
+        onehot - the original construction, gathering the region pairs with dense one-hot
+            [roi_num^2, roi_num] matrices (kept here as the reference)
+        linear - the current one, fc_out split into the sender and receiver halves broadcast over the pairs
+    gnn - GNNPredictor message passing over a random learned graph [batch_size, roi_num, roi_num]
+        with the FNC node features [batch_size, roi_num, roi_num]:
+        legacy - the original propagation (node features scaled by the node degrees)
+        bmm - dense message passing m @ x
+        topk - m @ x over the top_k strongest edges of each node, gathered from the nodes
+Each implementation is measured on CPU for each point of the batch size x region count grid
+(x embedding size for embed2graph):
+    mode=forward - inference forward pass (eval mode, no grad)
+    mode=forward_backward - forward pass and backward pass of the sum of the outputs
+Implementations of a block share the parameters, max_abs_diff is the largest difference of their outputs
+from the first implementation's ones (gnn: bmm is the reference of topk, their difference is the sparsification error);
+constant_mb is the size of the implementation's constant tensors.
+Results are saved to cfg.output_dir as JSON and CSV, and compared with cfg.baseline if set.
+
+Usage:
+    PYTHONPATH=. python benchmarks/bench_fbnetgen.py roi_nums=[53,100,360] batch_sizes=[8]
+    PYTHONPATH=. python benchmarks/bench_fbnetgen.py blocks=[gnn] top_k=20
+"""
+import gc
+
+from omegaconf import DictConfig
+import hydra
+import numpy as np
+import pandas as pd
+import torch
+from torch import nn
+
+from benchmarks.common import measure, save_results, check_baseline
+from benchmarks.bench_models import saved_tensors_mb
+from src.models.src.fbnetgen_modules import Embed2GraphByLinear, GNNPredictor
+
+KEYS = ["block", "impl", "mode", "batch_size", "roi_num", "input_dim"]
+
+
+@hydra.main(version_base=None, config_path="conf", config_name="bench_fbnetgen")
+def start(bench_cfg: DictConfig):
+    """Run the benchmark grid"""
+    if bench_cfg.threads is not None:
+        torch.set_num_threads(bench_cfg.threads)
+
+    results = []
+    for block in bench_cfg.blocks:
+        if block not in BLOCKS:
+            raise NotImplementedError(f"Unknown FBNetGen block '{block}'")
+        # the node features of the gnn block are FNC, input_dim is the number of regions
+        input_dims = bench_cfg.input_dims if block == "embed2graph" else [None]
+        for roi_num in bench_cfg.roi_nums:
+            for input_dim in input_dims:
+                for batch_size in bench_cfg.batch_sizes:
+                    point = {
+                        "block": block,
+                        "batch_size": batch_size,
+                        "roi_num": roi_num,
+                        "input_dim": input_dim or roi_num,
+                    }
+                    print(f"Benchmarking {point}")
+                    try:
+                        results += benchmark_block(bench_cfg, point)
+                    except Exception as e:
+                        print(f"Failed: {e!r}")
+                        results.append({**point, "impl": None, "error": repr(e)})
+                    gc.collect()
+
+    df = pd.DataFrame(results)
+    summary = [
+        column
+        for column in KEYS
+        + [
+            "throughput",
+            "speedup",
+            "latency_p50_ms",
+            "saved_tensors_mb",
+            "constant_mb",
+            "max_abs_diff",
+            "error",
+        ]
+        if column in df.columns
+    ]
+    print(df[summary].to_string(index=False))
+
+    results_path = save_results(results, bench_cfg.output_dir, "fbnetgen", bench_cfg)
+    check_baseline(
+        bench_cfg,
+        results,
+        results_path,
+        KEYS,
+        {"throughput": True},
+    )
+
+
+class OneHotEmbed2Graph(nn.Module):
+    """The original Embed2GraphByLinear construction with one-hot pair matrices"""
+
+    def __init__(self, module: Embed2GraphByLinear, roi_num):
+        super().__init__()
+        self.fc_out = module.fc_out
+        self.fc_cat = module.fc_cat
+
+        off_diag = np.ones([roi_num, roi_num])
+        identity = np.identity(roi_num, dtype=np.float32)
+        self.rel_rec = torch.from_numpy(identity[np.where(off_diag)[0]])
+        self.rel_send = torch.from_numpy(identity[np.where(off_diag)[1]])
+
+    def forward(self, x):
+        batch_sz, region_num, _ = x.shape
+        receivers = torch.matmul(self.rel_rec, x)
+        senders = torch.matmul(self.rel_send, x)
+        x = torch.cat([senders, receivers], dim=2)
+        x = torch.relu(self.fc_out(x))
+        x = torch.relu(self.fc_cat(x))
+        return torch.reshape(x, (batch_sz, region_num, region_num, -1))
+
+
+def embed2graph(bench_cfg, point):
+    """Embed2GraphByLinear implementations and their inputs"""
+    x = torch.randn(point["batch_size"], point["roi_num"], point["input_dim"])
+    module = Embed2GraphByLinear(point["input_dim"], point["roi_num"])
+
+    impls = {}
+    for impl in bench_cfg.embed2graph_impls:
+        if impl == "onehot":
+            impls[impl] = OneHotEmbed2Graph(module, point["roi_num"])
+        elif impl == "linear":
+            impls[impl] = module
+        else:
+            raise NotImplementedError(f"Unknown Embed2GraphByLinear implementation '{impl}'")
+    return impls, (x,)
+
+
+def gnn(bench_cfg, point):
+    """GNNPredictor message passing implementations and their inputs"""
+    bz, roi_num = point["batch_size"], point["roi_num"]
+    m = torch.relu(torch.randn(bz, roi_num, roi_num))
+    node_feature = torch.randn(bz, roi_num, roi_num)
+
+    impls = {}
+    for impl in bench_cfg.gnn_impls:
+        top_k = bench_cfg.top_k if impl == "topk" else None
+        impls[impl] = GNNPredictor(roi_num, roi_num, message_passing=impl, top_k=top_k)
+    state_dict = next(iter(impls.values())).state_dict()
+    for module in impls.values():
+        module.load_state_dict(state_dict)
+    return impls, (m, node_feature)
+
+
+# {block: function returning the block's implementations and inputs for a grid point}
+BLOCKS = {"embed2graph": embed2graph, "gnn": gnn}
+
+
+def benchmark_block(bench_cfg, point):
+    """Return the results of all implementations of the block and modes for a single grid point"""
+    torch.manual_seed(bench_cfg.seed)
+    impls, inputs = BLOCKS[point["block"]](bench_cfg, point)
+    # GNNPredictor's legacy propagation and bmm compute different functions, bmm is the reference of topk
+    references = {"legacy": "legacy", "bmm": "bmm", "topk": "bmm"}
+
+    results = []
+    outputs = {}
+    for impl, module in impls.items():
+        constant_mb = sum(
+            tensor.nbytes
+            for tensor in vars(module).values()
+            if isinstance(tensor, torch.Tensor)
+        ) / 1024**2
+        inputs = [x.detach().requires_grad_(True) for x in inputs]
+
+        def forward():
+            with torch.no_grad():
+                return module(*inputs)
+
+        def forward_backward():
+            module.zero_grad()
+            module(*inputs).sum().backward()
+
+        module.eval()
+        outputs[impl] = forward()
+        reference = references.get(impl, next(iter(impls)))
+        max_abs_diff = (
+            (outputs[impl] - outputs[reference]).abs().max().item()
+            if reference in outputs
+            else None
+        )
+
+        for mode, step in [("forward", forward), ("forward_backward", forward_backward)]:
+            module.train(mode != "forward")
+            timing = measure(step, bench_cfg.warmup, bench_cfg.iters)
+            results.append(
+                {
+                    "impl": impl,
+                    "mode": mode,
+                    **point,
+                    "throughput": point["batch_size"] / timing["latency_mean_ms"] * 1000,
+                    **timing,
+                    "saved_tensors_mb": saved_tensors_mb(step)
+                    if mode == "forward_backward"
+                    else None,
+                    "constant_mb": constant_mb,
+                    "max_abs_diff": max_abs_diff,
+                }
+            )
+        gc.collect()
+
+    # speedup relative to the first implementation
+    baseline = {
+        row["mode"]: row["throughput"] for row in results if row["impl"] == next(iter(impls))
+    }
+    for row in results:
+        row["speedup"] = row["throughput"] / baseline[row["mode"]]
+
+    return results
+
+
+if __name__ == "__main__":
+    start()
@@ -0,0 +1,171 @@
+# pylint: disable=no-value-for-parameter, broad-except, too-many-locals
+"""
+Throughput and memory benchmark of the models in src/models.
+
+Every model is built from its default (or random) HPs for each point of the
+batch size x time length x component count grid, on synthetic data, and measured on CPU:
+    forward - inference forward pass (eval mode, no grad)
+    forward_backward - forward pass, loss and backward pass
+    train_step - forward_backward and optimizer step
+Results are saved to cfg.output_dir as JSON and CSV, and compared with cfg.baseline if set.
+
+Usage:
+    PYTHONPATH=. python benchmarks/bench_models.py models=[dice,bnt] batch_sizes=[16] baseline=<previous .json>
+"""
+from copy import deepcopy
+import gc
+from importlib import import_module
+import json
+
+from omegaconf import DictConfig, OmegaConf
+import hydra
+import pandas as pd
+import torch
+
+from benchmarks.common import (
+    synthetic_cfg,
+    set_model_config,
+    get_HPs,
+    input_key,
+    measure,
+    save_results,
+    check_baseline,
+)
+from src.data import data_factory, data_postfactory
+from src.model import model_factory
+from src.model_utils import criterion_factory, optimizer_factory
+from src.profiling import PeakMemory
+
+KEYS = ["model", "mode", "batch_size", "time_length", "n_components"]
+
+
+@hydra.main(version_base=None, config_path="conf", config_name="bench_models")
+def start(bench_cfg: DictConfig):
+    """Run the benchmark grid"""
+    if bench_cfg.threads is not None:
+        torch.set_num_threads(bench_cfg.threads)
+
+    results = []
+    for time_length in bench_cfg.time_lengths:
+        for n_components in bench_cfg.n_components:
+            for batch_size in bench_cfg.batch_sizes:
+                for model_name in bench_cfg.models:
+                    point = {
+                        "model": model_name,
+                        "batch_size": batch_size,
+                        "time_length": time_length,
+                        "n_components": n_components,
+                    }
+                    print(f"Benchmarking {point}")
+                    try:
+                        results += benchmark_model(
+                            bench_cfg, model_name, batch_size, time_length, n_components
+                        )
+                    except Exception as e:
+                        print(f"Failed: {e!r}")
+                        results.append({**point, "mode": None, "error": repr(e)})
+                    gc.collect()
+
+    df = pd.DataFrame(results)
+    summary = [
+        column
+        for column in KEYS + ["throughput", "latency_p50_ms", "saved_tensors_mb", "error"]
+        if column in df.columns
+    ]
+    print(df[summary].to_string(index=False))
+
+    results_path = save_results(results, bench_cfg.output_dir, "models", bench_cfg)
+    check_baseline(
+        bench_cfg,
+        results,
+        results_path,
+        KEYS,
+        {"throughput": True},
+    )
+
+
+def benchmark_model(bench_cfg, model_name, batch_size, time_length, n_components):
+    """Return the results of forward, forward_backward and train_step for a single grid point"""
+    cfg = synthetic_cfg(bench_cfg, batch_size, time_length, n_components)
+    set_model_config(cfg, model_name)
+    model_module = import_module(f"src.models.{model_name}")
+
+    # build the model the same way scripts/run_experiments.py does
+    data = data_factory(cfg)
+    model_cfg = get_HPs(cfg, model_module, bench_cfg.hps, seed=bench_cfg.seed)
+    data = data_postfactory(cfg, model_cfg, deepcopy(data))
+    model = model_factory(cfg, model_cfg)
+    criterion = criterion_factory(cfg, model_cfg)
+    optimizer = optimizer_factory(cfg, model_cfg, model)
+
+    device = torch.device("cpu")
+    x = torch.tensor(data["main"][input_key(cfg)], dtype=torch.float32)
+    y = torch.tensor(data["main"]["labels"], dtype=torch.int64)
+
+    def forward():
+        with torch.no_grad():
+            model(x)
+
+    def forward_backward():
+        optimizer.zero_grad()
+        loss = criterion(model(x), y, model, device)
+        loss.backward()
+
+    def train_step():
+        forward_backward()
+        optimizer.step()
+
+    params = sum(p.numel() for p in model.parameters())
+    results = []
+    for mode, step in [
+        ("forward", forward),
+        ("forward_backward", forward_backward),
+        ("train_step", train_step),
+    ]:
+        model.train(mode != "forward")
+
+        timing = measure(step, bench_cfg.warmup, bench_cfg.iters)
+        gc.collect()
+        with PeakMemory() as memory:
+            for _ in range(bench_cfg.memory_iters):
+                step()
+        # RSS rarely shrinks after the allocator got memory from the OS, so also count
+        # the activations saved for backward, which doesn't depend on the allocator
+        memory.results["saved_tensors_mb"] = saved_tensors_mb(step)
+
+        results.append(
+            {
+                "model": model_name,
+                "mode": mode,
+                "batch_size": batch_size,
+                "time_length": time_length,
+                "n_components": n_components,
+                "params": params,
+                # runs are comparable only if they benchmark the same HPs
+                "hps": json.dumps(OmegaConf.to_container(model_cfg, resolve=True), sort_keys=True),
+                "throughput": batch_size / timing["latency_mean_ms"] * 1000,
+                **timing,
+                **memory.results,
+            }
+        )
+
+    return results
+
+
+def saved_tensors_mb(step):
+    """Size of the tensors saved for backward during a single step (MB)"""
+    saved = {}
+
+    def pack(tensor):
+        storage = tensor.untyped_storage()
+        saved[storage.data_ptr()] = storage.nbytes()
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        step()
+
+    return sum(saved.values()) / 1024**2
+
+
+if __name__ == "__main__":
+    start()
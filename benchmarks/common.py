@@ -0,0 +1,190 @@
+# pylint: disable=invalid-name
+"""Shared utilities of the benchmarks: configs, timing, results and baselines"""
+import json
+import os
+import platform
+import random
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+import torch
+from omegaconf import OmegaConf, DictConfig, open_dict
+
+from src.settings import PROJECT_ROOT, UTCNOW
+
+CONF_ROOT = PROJECT_ROOT.joinpath("src/conf")
+
+
+def synthetic_cfg(bench_cfg: DictConfig, n_subjects, time_length, n_components):
+    """
+    Return experiment config for the synthetic dataset of the given shape
+    (see src/conf/dataset/synthetic.yaml) without a model
+    """
+    dataset_cfg = OmegaConf.load(CONF_ROOT.joinpath("dataset/synthetic.yaml"))
+    dataset_cfg.n_subjects = n_subjects
+    dataset_cfg.time_length = time_length
+    dataset_cfg.n_components = n_components
+    dataset_cfg.seed = bench_cfg.seed
+
+    return OmegaConf.create(
+        {
+            "mode": {
+                "name": "exp",
+                "max_epochs": 200,
+                "batch_size": n_subjects,
+            },
+            "dataset": dataset_cfg,
+            "model": {},
+        }
+    )
+
+
+def set_model_config(cfg: DictConfig, model_name: str):
+    """Set cfg.model from 'src/conf/model/{model_name}.yaml'"""
+    with open_dict(cfg):
+        cfg.model = OmegaConf.load(CONF_ROOT.joinpath(f"model/{model_name}.yaml"))
+
+
+def seed_everything(seed: int):
+    """Seed python's random (used by the models' random_HPs), numpy and torch"""
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+
+
+def get_HPs(cfg: DictConfig, model_module, hps: str, seed: int = None):
+    """
+    Return the model's default HPs if hps is 'default', or random HPs if hps is 'random'
+    (falls back to the default HPs for the models that are not tunable).
+    If seed is set, the random HPs are the same for every run with this seed.
+    Must be called after the data is loaded, HPs depend on cfg.dataset.data_info
+    """
+    if seed is not None:
+        seed_everything(seed)
+    if hps == "random" and hasattr(model_module, "random_HPs"):
+        return model_module.random_HPs(cfg)
+    if hps == "random":
+        print(f"'{cfg.model.name}' has no random_HPs, using default_HPs")
+    return model_module.default_HPs(cfg)
+
+
+def input_key(cfg: DictConfig):
+    """Key of the model's input in the processed data, see src.data.common_processor"""
+    if "data_type" not in cfg.model or cfg.model.data_type == "TS":
+        return "TS"
+    if cfg.model.data_type in ["FNC", "tri-FNC"]:
+        return "FNC"
+    raise NotImplementedError(f"Unsupported data_type '{cfg.model.data_type}'")
+
+
+def measure(step, warmup: int, iters: int):
+    """Run `step` warmup + iters times, return latency statistics of the last iters runs (ms)"""
+    for _ in range(warmup):
+        step()
+
+    latencies = []
+    for _ in range(iters):
+        start = time.perf_counter()
+        step()
+        latencies.append(time.perf_counter() - start)
+
+    latencies = np.array(latencies) * 1000
+    return {
+        "latency_mean_ms": latencies.mean(),
+        "latency_p50_ms": np.percentile(latencies, 50),
+        "latency_p90_ms": np.percentile(latencies, 90),
+        "latency_p99_ms": np.percentile(latencies, 99),
+    }
+
+
+def environment():
+    """Description of the machine the benchmarks are run on"""
+    return {
+        "date": UTCNOW,
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+        "python": platform.python_version(),
+        "torch": torch.__version__,
+        "torch_threads": torch.get_num_threads(),
+    }
+
+
+def save_results(results, output_dir: str, name: str, bench_cfg: DictConfig):
+    """Save results as '{output_dir}/{name}_{date}.json' (with the environment and config) and .csv"""
+    os.makedirs(output_dir, exist_ok=True)
+    path = f"{output_dir}/{name}_{UTCNOW}"
+
+    with open(f"{path}.json", "w", encoding="utf8") as f:
+        json.dump(
+            {
+                "environment": environment(),
+                "config": OmegaConf.to_container(bench_cfg, resolve=True),
+                "results": results,
+            },
+            f,
+            indent=2,
+            default=lambda value: value.item() if hasattr(value, "item") else str(value),
+        )
+    pd.DataFrame(results).to_csv(f"{path}.csv", index=False)
+
+    print(f"Results are saved in '{path}.json' and '{path}.csv'")
+    return f"{path}.json"
+
+
+def compare_with_baseline(results, baseline_path: str, keys, metrics, tolerance: float):
+    """
+    Compare the results with the results stored in a previous run's JSON file.
+    metrics is a dict {metric: True if higher is better}.
+    Returns a DataFrame with '{metric}_baseline' and '{metric}_ratio' (current / baseline) columns
+    and a 'regression' column, True if any metric is worse than the baseline by more than tolerance
+    """
+    with open(baseline_path, "r", encoding="utf8") as f:
+        baseline = pd.DataFrame(json.load(f)["results"])
+
+    current = pd.DataFrame(results)
+    columns = list(keys) + list(metrics)
+    df = current[columns].merge(
+        baseline[columns], on=list(keys), how="left", suffixes=("", "_baseline")
+    )
+
+    df["regression"] = False
+    for metric, higher_is_better in metrics.items():
+        df[f"{metric}_ratio"] = df[metric] / df[f"{metric}_baseline"]
+        if higher_is_better:
+            df["regression"] |= df[f"{metric}_ratio"] < 1 - tolerance
+        else:
+            df["regression"] |= df[f"{metric}_ratio"] > 1 + tolerance
+
+    return df
+
+
+def check_baseline(bench_cfg: DictConfig, results, results_path: str, keys, metrics):
+    """
+    If bench_cfg.baseline is set, compare the results with it, save the comparison next to
+    the results and print the regressions; exit with code 1 on regressions
+    if bench_cfg.fail_on_regression is True
+    """
+    if bench_cfg.baseline is None:
+        return
+
+    df = compare_with_baseline(
+        results, bench_cfg.baseline, keys, metrics, bench_cfg.tolerance
+    )
+    df.to_csv(results_path.replace(".json", "_vs_baseline.csv"), index=False)
+
+    ratios = [f"{metric}_ratio" for metric in metrics]
+    print(f"Comparison with '{bench_cfg.baseline}':")
+    print(df[list(keys) + ratios].to_string(index=False))
+
+    regressions = df[df["regression"]]
+    if len(regressions) == 0:
+        print("No regressions found")
+        return
+
+    print(f"{len(regressions)} regression(s) beyond tolerance {bench_cfg.tolerance}:")
+    print(regressions[list(keys) + ratios].to_string(index=False))
+    if bench_cfg.fail_on_regression:
+        sys.exit(1)
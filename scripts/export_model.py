@@ -0,0 +1,97 @@
+# pylint: disable=no-value-for-parameter, too-many-locals
+"""Script for exporting a trained model to TorchScript/ONNX artifacts for serving"""
+import json
+import os
+import sys
+
+from omegaconf import DictConfig
+import hydra
+
+import numpy as np
+import pandas as pd
+import torch
+
+from src.inference import Ensemble
+from src.export import (
+    shape_contract,
+    quantize,
+    export_torchscript,
+    export_onnx,
+    compare,
+    latency_ms,
+)
+
+
+@hydra.main(version_base=None, config_path="../src/conf", config_name="export_config")
+def start(cfg: DictConfig):
+    """
+    Export the model of the cfg.path run in cfg.formats (and its int8 variant if cfg.quantize is True),
+    check that the exported models match the eager one on the held-out cfg.data,
+    and compare their latencies. Exits with code 1 if any parity check fails
+    """
+    device = torch.device("cpu")
+    ensemble = Ensemble([cfg.path], device, use_vmap=False)
+    model = ensemble.models[0]
+    contract = shape_contract(ensemble.cfg, ensemble.model_cfg)
+
+    output_dir = cfg.output_dir if cfg.output_dir is not None else f"{cfg.path}/export"
+    os.makedirs(output_dir, exist_ok=True)
+    with open(f"{output_dir}/contract.json", "w", encoding="utf8") as f:
+        json.dump(contract, f, indent=2)
+
+    # held-out data, preprocessed the same way as the training data
+    ts_data = np.array(np.load(cfg.data, mmap_mode="r")[: cfg.n_samples], dtype=np.float32)
+    held_out = torch.as_tensor(ensemble.preprocess(ts_data)[0], dtype=torch.float32)
+    example = held_out[: cfg.batch_size]
+
+    eager_latency = latency_ms(model, example, cfg.warmup, cfg.iters)
+
+    artifacts = []
+    for export_format in cfg.formats:
+        if export_format == "torchscript":
+            path = f"{output_dir}/model.pt"
+            exported = export_torchscript(model, example, path, contract)
+        elif export_format == "onnx":
+            path = f"{output_dir}/model.onnx"
+            exported = export_onnx(model, example, path, contract)
+        else:
+            raise NotImplementedError(f"Unknown export format '{export_format}'")
+        artifacts.append((export_format, path, exported, False))
+
+    if cfg.quantize:
+        path = f"{output_dir}/model_int8.pt"
+        exported = export_torchscript(quantize(model), example, path, contract)
+        artifacts.append(("torchscript_int8", path, exported, True))
+
+    report = []
+    for name, path, exported, quantized in artifacts:
+        row = {"artifact": name, "path": path}
+        if exported is not None:
+            row.update(compare(model, exported, held_out))
+            # int8 logits are not expected to match exactly, their predictions are
+            if quantized:
+                row["passed"] = row["prediction_agreement"] >= cfg.min_agreement
+            else:
+                row["passed"] = row["max_abs_diff"] <= cfg.atol
+            row["latency_ms"] = latency_ms(exported, example, cfg.warmup, cfg.iters)
+            row["speedup"] = eager_latency / row["latency_ms"]
+        report.append(row)
+
+    with open(f"{output_dir}/report.json", "w", encoding="utf8") as f:
+        json.dump(
+            {"eager_latency_ms": eager_latency, "batch_size": cfg.batch_size, "artifacts": report},
+            f,
+            indent=2,
+        )
+
+    print(f"Eager latency: {eager_latency:.3f} ms per batch of {example.shape[0]}")
+    print(pd.DataFrame(report).drop(columns="path").to_string(index=False))
+    print(f"Artifacts are saved in '{output_dir}'")
+
+    if any(not row.get("passed", True) for row in report):
+        print("Exported models don't match the eager model")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    start()
@@ -16,6 +16,8 @@ from src.model import model_config_factory, model_factory
 from src.model_utils import criterion_factory, optimizer_factory, scheduler_factory
 from src.logger import logger_factory
 from src.trainer import trainer_factory
+from src.pruner import pruner_factory, TrialPruned
+from src.results_store import results_store_factory
 
 
 @hydra.main(version_base=None, config_path="../src/conf", config_name="exp_config")
@@ -99,10 +101,31 @@ def tune(cfg, original_data, outer_k=None, is_interupted=False):
     else:
         starting_trial = 0
 
+    # set the tuning fold directory and load the pruner state from it
+    set_run_name(cfg, outer_k=outer_k, trial=starting_trial, inner_k=0)
+    pruner = pruner_factory(cfg)
+    results_store = results_store_factory(cfg)
+
     # for each trial get new set of HPs, test them using CV
     for trial in range(starting_trial, cfg.mode.n_trials):
-        # get random model config
-        model_cfg = model_config_factory(cfg)
+        set_run_name(cfg, outer_k=outer_k, trial=trial, inner_k=0)
+        trial_config_path = f"{cfg.trial_dir}/model_config.yaml"
+        if (
+            is_interupted
+            and trial == starting_trial
+            and results_store.has_config(trial_config_path)
+        ):
+            # continue the interrupted trial with its HPs after its finished inner folds
+            model_cfg = results_store.load_config(trial_config_path)
+            cv_results = results_store.cv_runs(cfg).to_dict("records")
+            print(f"Resuming trial {trial:04d} from inner k {len(cv_results):02d}")
+        else:
+            # get random model config
+            model_cfg = model_config_factory(cfg)
+            cv_results = []
+            # save model config before the runs, so the trial can be resumed
+            os.makedirs(cfg.trial_dir, exist_ok=True)
+            results_store.add_config(trial_config_path, model_cfg)
         # reshape data according to model config (if needed)
         data = data_postfactory(
             cfg,
@@ -110,7 +133,8 @@ def tune(cfg, original_data, outer_k=None, is_interupted=False):
             original_data,
         )
         # run nested CV
-        for inner_k in range(0, cfg.mode.n_splits):
+        pruned = False
+        for inner_k in range(len(cv_results), cfg.mode.n_splits):
             if outer_k is not None:
                 print(f"Outer k: {outer_k:02d}")
             print(f"Trial: {trial:04d}")
@@ -119,41 +143,57 @@ def tune(cfg, original_data, outer_k=None, is_interupted=False):
             set_run_name(cfg, outer_k=outer_k, trial=trial, inner_k=inner_k)
             os.makedirs(cfg.run_dir, exist_ok=True)
             dataloaders = dataloader_factory(cfg, data, k=inner_k)
-            results = run_trial(cfg, model_cfg, dataloaders)
+            try:
+                results = run_trial(cfg, model_cfg, dataloaders, pruner)
+            except TrialPruned:
+                pruned = True
+                if not cfg.mode.preserve_checkpoints and os.path.exists(
+                    f"{cfg.run_dir}/best_model.pt"
+                ):
+                    os.remove(f"{cfg.run_dir}/best_model.pt")
+                break
 
             # save results of nested CV in the trial directory
-            df = pd.DataFrame(results, index=[0])
-            with open(f"{cfg.trial_dir}/CV_runs.csv", "a", encoding="utf8") as f:
-                df.to_csv(f, header=f.tell() == 0, index=False)
-
-        # save model config
-        with open(f"{cfg.trial_dir}/model_config.yaml", "w", encoding="utf8") as f:
-            OmegaConf.save(model_cfg, f)
-
-        # summarize the trial's CV results and save them
-        df = pd.read_csv(f"{cfg.trial_dir}/CV_runs.csv")
-        score = np.mean(df["test_score"].to_numpy())
-        loss = np.mean(df["test_average_loss"].to_numpy())
-        time = np.mean(df["training_time"].to_numpy())
-        df = pd.DataFrame(
+            cv_results.append(results)
+            results_store.add_run(cfg, results)
+
+            # check if the trial is hopeless after the finished inner folds
+            if inner_k + 1 < cfg.mode.n_splits and pruner.report_fold(
+                trial, inner_k, cv_results
+            ):
+                pruned = True
+                break
+
+        # summarize the trial's CV results and save them;
+        # pruned trials are recorded, but are not eligible for the best config
+        if pruned:
+            score, loss, time = np.nan, np.nan, np.nan
+        else:
+            df = pd.DataFrame(cv_results)
+            score = np.mean(df["test_score"].to_numpy())
+            loss = np.mean(df["test_average_loss"].to_numpy())
+            time = np.mean(df["training_time"].to_numpy())
+        results_store.add_trial(
+            cfg,
             {
                 "trial": trial,
                 "score": score,
                 "loss": loss,
                 "time": time,
-                "path_to_config": f"{cfg.trial_dir}/model_config.yaml",
+                "pruned": pruned,
+                "path_to_config": trial_config_path,
             },
-            index=[0],
         )
-        with open(f"{cfg.k_dir}/trial_runs.csv", "a", encoding="utf8") as f:
-            df.to_csv(f, header=f.tell() == 0, index=False)
+
+    results_store.export(cfg)
 
     # get optimal config and save it
-    df = pd.read_csv(f"{cfg.k_dir}/trial_runs.csv")
+    df = results_store.trial_runs(cfg)
+    if "pruned" in df:
+        df = df[~df["pruned"].astype(bool)]
     best_idx = df["score"].idxmax()
     best_config_path = df.loc[best_idx]["path_to_config"]
-    with open(best_config_path, "r", encoding="utf8") as f:
-        best_config = OmegaConf.load(f)
+    best_config = results_store.load_config(best_config_path)
     with open(f"{cfg.k_dir}/best_config.yaml", "w", encoding="utf8") as f:
         OmegaConf.save(best_config, f)
 
@@ -167,6 +207,8 @@ def experiment(cfg, original_data, is_interupted=False):
     else:
         starting_k = 0
 
+    results_store = results_store_factory(cfg)
+
     for outer_k in range(starting_k, cfg.mode.n_splits):
         # for each fold get optimal set of HPs,
         # unless single_HP is True,
@@ -197,22 +239,20 @@ def experiment(cfg, original_data, is_interupted=False):
             results = run_trial(cfg, model_cfg, dataloaders)
 
             # save run's results in the folds directory
-            df = pd.DataFrame(results, index=[0])
-            with open(f"{cfg.k_dir}/fold_runs.csv", "a", encoding="utf8") as f:
-                df.to_csv(f, header=f.tell() == 0, index=False)
+            results_store.add_run(cfg, results)
 
         # save outer_k's model config
-        with open(f"{cfg.k_dir}/model_config.yaml", "w", encoding="utf8") as f:
-            OmegaConf.save(model_cfg, f)
+        results_store.add_config(f"{cfg.k_dir}/model_config.yaml", model_cfg)
 
-        # load and save the fold's results in the project directory
-        df = pd.read_csv(f"{cfg.k_dir}/fold_runs.csv")
-        with open(f"{cfg.project_dir}/runs.csv", "a", encoding="utf8") as f:
-            df.to_csv(f, header=f.tell() == 0, index=False)
+        # save the fold's results in the project directory
+        results_store.add_fold(cfg)
 
 
-def run_trial(cfg, model_cfg, dataloaders):
-    """Given config and prepared dataloaders, build and train the model and return test results"""
+def run_trial(cfg, model_cfg, dataloaders, pruner=None):
+    """
+    Given config and prepared dataloaders, build and train the model and return test results.
+    Raises src.pruner.TrialPruned if the pruner stops the training
+    """
     model = model_factory(cfg, model_cfg)
     criterion = criterion_factory(cfg, model_cfg)
     optimizer = optimizer_factory(cfg, model_cfg, model)
@@ -229,9 +269,13 @@ def run_trial(cfg, model_cfg, dataloaders):
         scheduler,
         logger,
     )
+    if pruner is not None:
+        trainer.pruner = pruner
 
-    results = trainer.run()
-    logger.finish()
+    try:
+        results = trainer.run()
+    finally:
+        logger.finish()
 
     return results
 
@@ -0,0 +1,53 @@
+# pylint: disable=no-value-for-parameter
+"""Script for scoring new subjects with the models trained by run_experiments.py"""
+import os
+
+from omegaconf import DictConfig
+import hydra
+
+import numpy as np
+import pandas as pd
+import torch
+
+from src.inference import find_runs, Ensemble, score
+
+
+@hydra.main(version_base=None, config_path="../src/conf", config_name="inference_config")
+def start(cfg: DictConfig):
+    """Score cfg.data with all the trained models found in cfg.path and save the probabilities"""
+    if cfg.device is not None:
+        device = torch.device(cfg.device)
+    else:
+        device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+    print(f"Used device: {device}")
+
+    ensemble = Ensemble(find_runs(cfg.path), device, use_vmap=cfg.vmap)
+
+    # the data is memory-mapped and read in chunks
+    ts_data = np.load(cfg.data, mmap_mode="r")
+    print(f"Scoring data of shape {ts_data.shape}")
+    probabilities, ensemble_probabilities = score(
+        ensemble, ts_data, cfg.chunk_size, cfg.batch_size
+    )
+
+    output_dir = cfg.output_dir if cfg.output_dir is not None else f"{cfg.path}/inference"
+    os.makedirs(output_dir, exist_ok=True)
+    np.save(f"{output_dir}/model_probabilities.npy", probabilities)
+    np.save(f"{output_dir}/ensemble_probabilities.npy", ensemble_probabilities)
+    pd.DataFrame({"model": range(len(ensemble.run_dirs)), "run_dir": ensemble.run_dirs}).to_csv(
+        f"{output_dir}/models.csv", index=False
+    )
+
+    predictions = pd.DataFrame(
+        ensemble_probabilities,
+        columns=[f"probability_{c}" for c in range(ensemble.n_classes)],
+    )
+    predictions.insert(0, "prediction", ensemble_probabilities.argmax(axis=1))
+    predictions.insert(0, "subject", range(len(predictions)))
+    predictions.to_csv(f"{output_dir}/predictions.csv", index=False)
+
+    print(f"Predictions are saved in '{output_dir}'")
+
+
+if __name__ == "__main__":
+    start()
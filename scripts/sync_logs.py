@@ -0,0 +1,19 @@
+# pylint: disable=no-value-for-parameter
+"""Script for uploading the logs of 'logger=local' runs to wandb"""
+import os
+
+from omegaconf import DictConfig
+import hydra
+
+from src.logger import sync_local_logs
+
+
+@hydra.main(version_base=None, config_path="../src/conf", config_name="sync_config")
+def start(cfg: DictConfig):
+    """Sync all local logs found under cfg.path"""
+    os.environ["WANDB_SILENT"] = "true" if cfg.wandb_silent else "false"
+    sync_local_logs(cfg.path)
+
+
+if __name__ == "__main__":
+    start()
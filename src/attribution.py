@@ -0,0 +1,139 @@
+# pylint: disable=invalid-name, too-many-instance-attributes, too-many-locals
+"""Input attributions (saliency maps) of the trained models"""
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+
+from omegaconf import DictConfig
+
+
+class Attribution:
+    """
+    Input attributions of the trained model, computed after testing for the splits
+    in cfg.attribution.splits (all the dataloaders if null):
+        saliency - gradients of the target class logit w.r.t. the input
+            (same as captum.attr.Saliency with abs=False)
+        integrated_gradients - integrated gradients with zero baseline: midpoint Riemann sum
+            over cfg.attribution.ig_steps steps, cfg.attribution.ig_batch_steps of which
+            are evaluated in a single batch
+    Gradients are computed w.r.t. the inputs only (the first input of multi-input models,
+    e.g. TS of TS-FNC models, the other inputs are kept fixed), in batches of cfg.attribution.batch_size
+    (cfg.mode.batch_size by default) and streamed to memory-mapped
+    '{run_dir}/{split}_grads_{class}.npy' files [class subjects, *input shape]
+    if cfg.attribution.save_maps is True, in the order of the split's dataset.
+    Per-class mean and abs-mean maps are accumulated on the fly and saved to
+    '{run_dir}/{split}_grads_summary.npz' (count, mean, abs_mean, indexed by class).
+    """
+
+    def __init__(self, cfg: DictConfig, model, device):
+        self.model = model
+        self.device = device
+        self.n_classes = cfg.dataset.data_info.main.n_classes
+
+        attribution_cfg = cfg.attribution if "attribution" in cfg else {}
+        self.splits = attribution_cfg.get("splits", None)
+        self.method = attribution_cfg.get("method", "saliency")
+        assert self.method in ["saliency", "integrated_gradients"]
+        self.save_maps = attribution_cfg.get("save_maps", True)
+        self.steps = attribution_cfg.get("ig_steps", 32)
+        self.batch_steps = attribution_cfg.get("ig_batch_steps", 8)
+        self.batch_size = attribution_cfg.get("batch_size", None) or cfg.mode.batch_size
+
+    def grad(self, data, target, other_inputs=()):
+        """
+        Gradients of the sum of the target class logits w.r.t. the batch;
+        samples don't interact in eval mode, so these are the per-sample gradients.
+        Note: torch.func.grad is avoided, it decomposes nn.LSTM (DICE) into much slower
+        and more memory-hungry ops
+        """
+        with torch.enable_grad():
+            data = data.detach().requires_grad_(True)
+            logits = self.model(data, *other_inputs)
+            # some models also return auxiliary outputs
+            logits = logits[0] if isinstance(logits, tuple) else logits
+            return torch.autograd.grad(logits.gather(1, target[:, None]).sum(), data)[0]
+
+    def gradients(self, data, target, other_inputs=()):
+        """Attributions of the batch"""
+        if self.method == "saliency":
+            return self.grad(data, target, other_inputs)
+
+        total = torch.zeros_like(data)
+        alphas = (torch.arange(self.steps, device=self.device) + 0.5) / self.steps
+        for batch_alphas in alphas.split(self.batch_steps):
+            n_steps = batch_alphas.shape[0]
+            # [n_steps * batch_size, ...] inputs scaled by each of the alphas
+            scaled = batch_alphas.view(-1, *[1] * data.dim()) * data
+            grads = self.grad(
+                scaled.reshape(-1, *data.shape[1:]),
+                target.repeat(n_steps),
+                [x.repeat(n_steps, *[1] * (x.dim() - 1)) for x in other_inputs],
+            )
+            total += grads.view(n_steps, *data.shape).sum(0)
+        return data * total / self.steps
+
+    def run(self, dataloaders, path: str):
+        """Compute and save the attributions of the requested splits"""
+        splits = list(dataloaders) if self.splits is None else self.splits
+        self.model.eval()
+        for split in splits:
+            if split not in dataloaders:
+                print(f"No '{split}' split, skipping its attributions")
+                continue
+            self.run_split(split, dataloaders[split].dataset, path)
+
+    def run_split(self, split, dataset, path):
+        # fixed order, the train dataloader is shuffled
+        dataloader = DataLoader(
+            dataset, batch_size=self.batch_size, shuffle=False, num_workers=0
+        )
+        labels = dataset_labels(dataset)
+        counts = np.bincount(labels, minlength=self.n_classes)
+        input_shape = tuple(dataset[0][0].shape)
+
+        maps = {}
+        if self.save_maps:
+            for class_label in range(self.n_classes):
+                maps[class_label] = np.lib.format.open_memmap(
+                    f"{path}/{split}_grads_{class_label}.npy",
+                    mode="w+",
+                    dtype=np.float32,
+                    shape=(int(counts[class_label]),) + input_shape,
+                )
+        sums = np.zeros((self.n_classes,) + input_shape)
+        abs_sums = np.zeros((self.n_classes,) + input_shape)
+        offsets = np.zeros(self.n_classes, dtype=np.int64)
+
+        for data, *other_inputs, target in dataloader:
+            data, target = data.to(self.device), target.to(self.device)
+            other_inputs = [x.to(self.device) for x in other_inputs]
+            grads = self.gradients(data, target, other_inputs).detach().cpu().numpy()
+            target = target.cpu().numpy()
+
+            for class_label in np.unique(target):
+                class_grads = grads[target == class_label]
+                sums[class_label] += class_grads.sum(0)
+                abs_sums[class_label] += np.abs(class_grads).sum(0)
+                if self.save_maps:
+                    start = offsets[class_label]
+                    maps[class_label][start : start + class_grads.shape[0]] = class_grads
+                offsets[class_label] += class_grads.shape[0]
+
+        for class_map in maps.values():
+            class_map.flush()
+
+        scale = np.maximum(counts, 1).reshape((-1,) + (1,) * len(input_shape))
+        np.savez(
+            f"{path}/{split}_grads_summary.npz",
+            count=counts,
+            mean=(sums / scale).astype(np.float32),
+            abs_mean=(abs_sums / scale).astype(np.float32),
+        )
+
+
+def dataset_labels(dataset):
+    """Labels of the dataset, the last item of its samples"""
+    if hasattr(dataset, "tensors"):
+        # TensorDataset, see src.dataloader.common_dataloader
+        return dataset.tensors[-1].cpu().numpy()
+    return np.array([int(sample[-1]) for sample in dataset])
@@ -8,7 +8,10 @@ from sklearn.model_selection import StratifiedKFold
 
 from omegaconf import OmegaConf, DictConfig, open_dict
 
+from src.profiling import account_memory
 
+
+@account_memory("data_factory")
 def data_factory(cfg: DictConfig):
     """
     Model-agnostic data factory.
@@ -68,27 +71,7 @@ def data_factory(cfg: DictConfig):
         print(f"{dataset_name} dataset is loaded")
 
     # process data
-    if "custom_processor" not in cfg.dataset or not cfg.dataset.custom_processor:
-        processor = common_processor
-    else:
-        try:
-            dataset_module = import_module(f"src.datasets.{cfg.dataset.name}")
-        except ModuleNotFoundError as e:
-            raise ModuleNotFoundError(
-                f"No module named '{cfg.dataset.name}' \
-                                    found in 'src.datasets'. Check if dataset name \
-                                    in config file and its module name are the same"
-            ) from e
-
-        try:
-            get_processor = dataset_module.get_processor
-        except AttributeError as e:
-            raise AttributeError(
-                f"'src.datasets.{cfg.dataset.name}' has no function\
-                                'get_processor'. Is the function misnamed/not defined?"
-            ) from e
-
-        processor = get_processor()
+    processor = processor_factory(cfg)
 
     data = {}
     data_info = {}
@@ -101,6 +84,34 @@ def data_factory(cfg: DictConfig):
     return data
 
 
+def processor_factory(cfg: DictConfig):
+    """
+    Return common_processor, or the processor returned by src.datasets.{cfg.dataset.name}.get_processor()
+    if cfg.dataset.custom_processor is True
+    """
+    if "custom_processor" not in cfg.dataset or not cfg.dataset.custom_processor:
+        return common_processor
+
+    try:
+        dataset_module = import_module(f"src.datasets.{cfg.dataset.name}")
+    except ModuleNotFoundError as e:
+        raise ModuleNotFoundError(
+            f"No module named '{cfg.dataset.name}' \
+                                found in 'src.datasets'. Check if dataset name \
+                                in config file and its module name are the same"
+        ) from e
+
+    try:
+        get_processor = dataset_module.get_processor
+    except AttributeError as e:
+        raise AttributeError(
+            f"'src.datasets.{cfg.dataset.name}' has no function\
+                            'get_processor'. Is the function misnamed/not defined?"
+        ) from e
+
+    return get_processor()
+
+
 def common_processor(cfg: DictConfig, data):
     """
     Return processed data and data_info based on config
@@ -181,6 +192,7 @@ def common_processor(cfg: DictConfig, data):
     return data, data_info
 
 
+@account_memory("data_postfactory")
 def data_postfactory(cfg: DictConfig, model_cfg: DictConfig, original_data):
     """
     Post-process the raw dataset according to model_cfg if cfg.model.require_data_postproc is True
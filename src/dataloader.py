@@ -9,7 +9,10 @@ from sklearn.model_selection import StratifiedKFold, StratifiedShuffleSplit
 import torch
 from torch.utils.data import DataLoader, TensorDataset
 
+from src.profiling import account_memory
 
+
+@account_memory("dataloader_factory")
 def dataloader_factory(cfg, data, k, trial=None):
     """Return dataloader according to the used model"""
     if "custom_dataloader" not in cfg.model or not cfg.model.custom_dataloader:
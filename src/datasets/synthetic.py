@@ -0,0 +1,161 @@
+# pylint: disable=invalid-name
+""" Synthetic ICA-like dataset generator"""
+import hashlib
+import os
+
+import numpy as np
+from scipy.signal import lfilter
+
+from omegaconf import OmegaConf, DictConfig
+
+from src.settings import DATA_ROOT
+
+# subjects are generated in full chunks with their own random streams,
+# so the first N subjects are the same for any n_subjects >= N
+SUBJECTS_PER_CHUNK = 256
+
+
+def load_data(
+    cfg: DictConfig,
+    cache_path: str = DATA_ROOT.joinpath("synthetic"),
+):
+    """
+    Return synthetic data generated according to cfg.dataset.
+    If cfg.dataset.cache is True, the data is saved to/loaded from
+    '{cache_path}/{hash of the generator parameters}_{data,labels}.npy',
+    and the data is memory-mapped instead of being kept in memory.
+
+    Output:
+    features with shape [n_samples, time_length, feature_size],
+    labels
+    """
+    params = {
+        key: cfg.dataset[key]
+        for key in [
+            "n_subjects",
+            "time_length",
+            "n_components",
+            "n_classes",
+            "seed",
+            "connectivity",
+            "temporal",
+        ]
+    }
+    shape = (params["n_subjects"], params["time_length"], params["n_components"])
+
+    if not cfg.dataset.cache:
+        data = np.empty(shape, dtype=np.float32)
+        labels = generate(params, data)
+        return data, labels
+
+    params_hash = hashlib.md5(
+        OmegaConf.to_yaml(OmegaConf.create(params)).encode()
+    ).hexdigest()[:16]
+    data_path = f"{cache_path}/{params_hash}_data.npy"
+    labels_path = f"{cache_path}/{params_hash}_labels.npy"
+
+    if not (os.path.exists(data_path) and os.path.exists(labels_path)):
+        print(f"Generating synthetic data cache '{data_path}'")
+        os.makedirs(cache_path, exist_ok=True)
+        # chunks are written straight to the file, the dataset is never fully in memory
+        data = np.lib.format.open_memmap(
+            f"{data_path}.tmp", mode="w+", dtype=np.float32, shape=shape
+        )
+        labels = generate(params, data)
+        data.flush()
+        del data
+        np.save(labels_path, labels)
+        os.replace(f"{data_path}.tmp", data_path)
+
+    data = np.load(data_path, mmap_mode="r")
+    labels = np.load(labels_path)
+
+    return data, labels
+
+
+def generate(params, out):
+    """
+    Fill `out` [n_subjects, time_length, n_components] with the synthetic time series,
+    return labels.
+
+    Model of the time series:
+    1. Sources are independent stationary AR(1) processes with unit variance:
+        one shared source per network and one private source per component.
+    2. Components are split into `connectivity.n_networks` contiguous networks;
+        each component is a mix of its network's source (variance share `connectivity.within`)
+        and its private source, so components of one network are correlated.
+    3. Each class couples `connectivity.n_couplings` random pairs of networks:
+        components of the first network get loading `connectivity.effect_size` on
+        the source of the second one. Classes differ only by this connectivity structure.
+    4. Each subject gets its own component amplitudes (log-normal, `temporal.amplitude_std`)
+        and white measurement noise (`temporal.noise_std`).
+    Labels are balanced: subject i has label i % n_classes.
+    """
+    n_subjects, T, C = out.shape
+    n_classes = params["n_classes"]
+    labels = np.arange(n_subjects) % n_classes
+
+    mixing = mixing_matrices(params)
+    # mixing.shape: [n_classes; n_components; n_networks + n_components]
+    phi = params["temporal"]["ar_coef"]
+
+    ar_filter = np.array([1.0, -phi], dtype=np.float32)
+    ar_input = np.array([1.0], dtype=np.float32)
+
+    B = SUBJECTS_PER_CHUNK
+    for chunk, start in enumerate(range(0, n_subjects, B)):
+        end = min(start + B, n_subjects)
+        rng = np.random.default_rng([params["seed"], chunk + 1])
+
+        # 1. unit-variance stationary AR(1) sources
+        sources = rng.standard_normal((B, mixing.shape[2], T), dtype=np.float32)
+        sources[:, :, 1:] *= np.sqrt(1 - phi**2)
+        sources = lfilter(ar_input, ar_filter, sources, axis=-1)
+        # sources.shape: [B; n_networks + n_components; time_length]
+
+        # 2-3. class-specific spatial mixing
+        chunk_labels = np.arange(start, start + B) % n_classes
+        chunk_data = np.empty((B, C, T), dtype=np.float32)
+        for c in range(n_classes):
+            mask = chunk_labels == c
+            chunk_data[mask] = mixing[c] @ sources[mask]
+
+        # 4. subject variability and measurement noise
+        chunk_data *= rng.lognormal(
+            0.0, params["temporal"]["amplitude_std"], (B, C, 1)
+        ).astype(np.float32)
+        chunk_data += params["temporal"]["noise_std"] * rng.standard_normal(
+            (B, C, T), dtype=np.float32
+        )
+        out[start:end] = chunk_data[: end - start].transpose(0, 2, 1)
+
+    return labels
+
+
+def mixing_matrices(params):
+    """Return class-specific mixing matrices [n_classes, n_components, n_networks + n_components]"""
+    C = params["n_components"]
+    n_classes = params["n_classes"]
+    n_networks = params["connectivity"]["n_networks"]
+    within = params["connectivity"]["within"]
+    effect_size = params["connectivity"]["effect_size"]
+    n_couplings = params["connectivity"]["n_couplings"]
+    assert 1 < n_networks <= C, "n_networks must be in (1, n_components]"
+
+    rng = np.random.default_rng([params["seed"], 0])
+
+    networks = np.array_split(np.arange(C), n_networks)
+    base = np.zeros((C, n_networks + C))
+    for g, components in enumerate(networks):
+        base[components, g] = np.sqrt(within)
+    base[np.arange(C), n_networks + np.arange(C)] = np.sqrt(1 - within)
+
+    mixing = np.repeat(base[None], n_classes, axis=0)
+    for c in range(n_classes):
+        for _ in range(n_couplings):
+            g1, g2 = rng.choice(n_networks, size=2, replace=False)
+            mixing[c, networks[g1], g2] += effect_size
+
+    # unit variance components
+    mixing /= np.linalg.norm(mixing, axis=2, keepdims=True)
+    return mixing.astype(np.float32)
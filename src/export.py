@@ -0,0 +1,151 @@
+# pylint: disable=invalid-name, too-many-arguments, import-outside-toplevel
+"""Export of trained models to TorchScript/ONNX artifacts for serving"""
+import json
+import time
+import warnings
+
+import numpy as np
+import torch
+from torch import nn
+
+from omegaconf import OmegaConf
+
+# input shapes of the exportable models, None marks the dimensions of any size
+INPUT_SHAPES = {
+    "lr": lambda model_cfg: [None, model_cfg.input_size],
+    "rearranged_mlp": lambda model_cfg: [None, None, model_cfg.input_size],
+    "bnt": lambda model_cfg: [None, model_cfg.node_sz, model_cfg.node_feature_sz],
+}
+
+
+def shape_contract(cfg, model_cfg):
+    """
+    Return the description of the exported model's input and output:
+    their shapes and dtypes, the preprocessing of the raw time series they expect
+    (see src.data.common_processor and the model's data_postproc) and the model config
+    """
+    if cfg.model.name not in INPUT_SHAPES:
+        raise NotImplementedError(
+            f"Export of '{cfg.model.name}' is not supported, supported models are {list(INPUT_SHAPES)}"
+        )
+
+    data_type = cfg.model.data_type if "data_type" in cfg.model else "TS"
+    return {
+        "model": cfg.model.name,
+        "input": {
+            "name": "FNC" if data_type in ["FNC", "tri-FNC"] else "TS",
+            "shape": INPUT_SHAPES[cfg.model.name](model_cfg),
+            "dtype": "float32",
+        },
+        "output": {
+            "name": "logits",
+            "shape": [None, cfg.dataset.data_info.main.n_classes],
+            "dtype": "float32",
+        },
+        "preprocessing": {
+            "data_type": data_type,
+            "zscore": bool(cfg.dataset.zscore),
+            # shape of the processed training data, includes the model's padding
+            "data_shape": list(cfg.dataset.data_info.main.data_shape),
+        },
+        "model_config": OmegaConf.to_container(model_cfg, resolve=True),
+    }
+
+
+def quantize(model: nn.Module):
+    """Return a copy of the model with int8 dynamic-quantized nn.Linear layers (CPU only)"""
+    from torch.ao.quantization import quantize_dynamic
+
+    with warnings.catch_warnings():
+        # eager mode quantization is deprecated in favor of torchao
+        warnings.simplefilter("ignore")
+        return quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+
+def export_torchscript(model: nn.Module, example: torch.Tensor, path: str, contract):
+    """
+    Trace the model with the example input, freeze it and save it with the contract
+    (readable with torch.jit.load(path, _extra_files={"contract.json": ""}))
+    """
+    with torch.no_grad(), warnings.catch_warnings():
+        # shapes are traced as tensors, python ints derived from them are expected
+        warnings.simplefilter("ignore", torch.jit.TracerWarning)
+        traced = torch.jit.freeze(torch.jit.trace(model, example))
+    torch.jit.save(traced, path, _extra_files={"contract.json": json.dumps(contract)})
+    return traced
+
+
+def export_onnx(model: nn.Module, example: torch.Tensor, path: str, contract):
+    """
+    Export the model with the TorchScript-based ONNX exporter, the dimensions of any size
+    in the contract are dynamic; the contract is saved in the model's metadata ('contract').
+    Returns an onnxruntime session running the model, or None if onnxruntime is not installed
+    """
+    try:
+        import onnx
+    except ImportError as e:
+        raise ImportError("ONNX export requires the 'onnx' package") from e
+
+    input_name = contract["input"]["name"]
+    dynamic_axes = {
+        input_name: {
+            i: f"dim_{i}" for i, size in enumerate(contract["input"]["shape"]) if size is None
+        },
+        "logits": {0: "dim_0"},
+    }
+    with torch.no_grad():
+        torch.onnx.export(
+            model,
+            (example,),
+            path,
+            dynamo=False,
+            input_names=[input_name],
+            output_names=["logits"],
+            dynamic_axes=dynamic_axes,
+        )
+
+    onnx_model = onnx.load(path)
+    metadata = onnx_model.metadata_props.add()
+    metadata.key = "contract"
+    metadata.value = json.dumps(contract)
+    onnx.save(onnx_model, path)
+
+    try:
+        import onnxruntime
+    except ImportError:
+        print("onnxruntime is not installed, skipping the ONNX parity check")
+        return None
+
+    session = onnxruntime.InferenceSession(path, providers=["CPUExecutionProvider"])
+
+    def run(x):
+        return torch.from_numpy(session.run(None, {input_name: x.numpy()})[0])
+
+    return run
+
+
+def compare(eager, exported, inputs: torch.Tensor):
+    """Compare the logits of the eager and exported models on the inputs"""
+    with torch.no_grad():
+        expected = eager(inputs)
+        actual = exported(inputs)
+    return {
+        "max_abs_diff": (expected - actual).abs().max().item(),
+        "prediction_agreement": (expected.argmax(-1) == actual.argmax(-1))
+        .float()
+        .mean()
+        .item(),
+    }
+
+
+def latency_ms(model, inputs: torch.Tensor, warmup: int, iters: int):
+    """Mean latency of the model on the inputs (ms)"""
+    with torch.no_grad():
+        for _ in range(warmup):
+            model(inputs)
+        latencies = []
+        for _ in range(iters):
+            start = time.perf_counter()
+            model(inputs)
+            latencies.append(time.perf_counter() - start)
+    return float(np.mean(latencies) * 1000)
@@ -0,0 +1,214 @@
+# pylint: disable=invalid-name, too-many-instance-attributes, too-many-arguments, broad-except
+"""Scoring new data with trained checkpoints"""
+import contextlib
+from copy import deepcopy
+import glob
+import io
+import os
+
+import numpy as np
+import torch
+from torch.func import functional_call, stack_module_state, vmap
+
+from omegaconf import OmegaConf, open_dict
+
+from src.data import processor_factory, data_postfactory
+from src.model import model_factory
+
+# model config keys that don't change the model's forward pass:
+# optimizer/scheduler HPs and the wandb link of the tuning process
+TRAINING_KEYS = ["lr", "optimizer", "scheduler", "link"]
+
+
+def find_runs(path: str):
+    """Return the run directories with a trained model under `path` (a run, fold or project directory)"""
+    checkpoints = sorted(glob.glob(f"{path}/**/best_model.pt", recursive=True))
+    run_dirs = [os.path.dirname(checkpoint) for checkpoint in checkpoints]
+    if len(run_dirs) == 0:
+        raise FileNotFoundError(
+            f"No trained models found in '{path}'. Note that checkpoints are deleted\
+                after the runs unless 'mode.preserve_checkpoints' is True"
+        )
+    return run_dirs
+
+
+class Ensemble:
+    """
+    Trained models of the given run directories.
+    Each run directory must contain config.yaml, model_config.yaml and best_model.pt
+    saved by src.trainer.BasicTrainer; the models are built with src.model.model_factory.
+
+    All the runs must share the model and the dataset, so new data is preprocessed once
+    for all of them, the same way the training data was (see `preprocess`).
+
+    Models with the same architecture (model config without TRAINING_KEYS, e.g. the tuned
+    trials that differ only in lr) are evaluated in a single batched pass:
+    their parameters are stacked and the forward pass is vectorized over them with torch.func.vmap. Groups whose models can't be vmapped
+    fall back to evaluating the models one by one.
+    """
+
+    def __init__(self, run_dirs, device: torch.device, use_vmap: bool = True):
+        self.run_dirs = list(run_dirs)
+        self.device = device
+        self.use_vmap = use_vmap
+
+        self.cfg, self.model_cfg = self.load_configs(self.run_dirs[0])
+        self.n_classes = self.cfg.dataset.data_info.main.n_classes
+
+        # {architecture: [model indices]}, models are kept in run_dirs order
+        self.models = []
+        groups = {}
+        for i, run_dir in enumerate(self.run_dirs):
+            cfg, model_cfg = self.load_configs(run_dir)
+            if (cfg.model.name, cfg.dataset.name) != (
+                self.cfg.model.name,
+                self.cfg.dataset.name,
+            ):
+                raise ValueError(
+                    f"'{run_dir}' is a '{cfg.model.name}' model trained on '{cfg.dataset.name}', "
+                    f"expected '{self.cfg.model.name}' on '{self.cfg.dataset.name}'"
+                )
+
+            model = model_factory(cfg, model_cfg)
+            checkpoint = torch.load(
+                f"{run_dir}/best_model.pt", map_location=self.device
+            )
+            model.load_state_dict(checkpoint)
+            model.to(self.device).eval()
+            self.models.append(model)
+
+            groups.setdefault(self.architecture(model_cfg), []).append(i)
+
+        self.groups = [ModelGroup(self.models, indices) for indices in groups.values()]
+        print(
+            f"Loaded {len(self.models)} '{self.cfg.model.name}' model(s) "
+            f"in {len(self.groups)} group(s) of the same architecture"
+        )
+
+    @staticmethod
+    def architecture(model_cfg):
+        """YAML of the model config without the training-only and bookkeeping keys"""
+        model_cfg = OmegaConf.to_container(model_cfg, resolve=True)
+        for key in TRAINING_KEYS:
+            model_cfg.pop(key, None)
+        return OmegaConf.to_yaml(model_cfg)
+
+    @staticmethod
+    def load_configs(run_dir):
+        cfg = OmegaConf.load(f"{run_dir}/config.yaml")
+        model_cfg = OmegaConf.load(f"{run_dir}/model_config.yaml")
+        with open_dict(cfg):
+            # training-only options
+            cfg.memory_accounting = False
+        return cfg, model_cfg
+
+    def preprocess(self, ts_data):
+        """
+        Return the model inputs ([TS], [FNC] or [TS, FNC] arrays) of the time series
+        [subjects, time, components], processed by the dataset's processor
+        (src.data.common_processor by default) and the model's data_postproc.
+        Processing is done per subject, so the data can be processed in chunks
+        """
+        cfg = deepcopy(self.cfg)
+        processor = processor_factory(cfg)
+        # labels are not known
+        labels = np.zeros(ts_data.shape[0], dtype=np.int64)
+
+        # processors report the changes they make, which is just noise for every chunk
+        with contextlib.redirect_stdout(io.StringIO()):
+            data, data_info = processor(cfg, (ts_data, labels))
+            # data_postproc decides on the shape of the new data, not the training one
+            with open_dict(cfg):
+                cfg.dataset.data_info = {"main": data_info}
+            data = data_postfactory(cfg, deepcopy(self.model_cfg), {"main": data})[
+                "main"
+            ]
+
+        return [data[key] for key in ["TS", "FNC"] if key in data]
+
+    def predict_proba(self, inputs):
+        """Return class probabilities [n_models, batch_size, n_classes] of the input tensors"""
+        probabilities = torch.empty(
+            (len(self.models), inputs[0].shape[0], self.n_classes), device=self.device
+        )
+        with torch.no_grad():
+            for group in self.groups:
+                logits = group(inputs, self.use_vmap)
+                probabilities[group.indices] = torch.softmax(logits, dim=-1)
+        return probabilities
+
+
+class ModelGroup:
+    """Models of the same architecture, evaluated in a single vmapped pass if possible"""
+
+    def __init__(self, models, indices):
+        self.indices = indices
+        self.models = [models[i] for i in indices]
+
+        self.params, self.buffers = stack_module_state(self.models)
+        # stateless copy of the architecture, the stacked tensors are passed to it
+        self.base = deepcopy(self.models[0]).to("meta")
+        self.vmap_failed = len(self.models) == 1
+
+    def call(self, params, buffers, inputs):
+        logits = functional_call(self.base, (params, buffers), tuple(inputs))
+        # some models also return auxiliary outputs
+        return logits[0] if isinstance(logits, tuple) else logits
+
+    def __call__(self, inputs, use_vmap=True):
+        """Return logits [n_models, batch_size, n_classes]"""
+        if use_vmap and not self.vmap_failed:
+            try:
+                return vmap(self.call, in_dims=(0, 0, None))(
+                    self.params, self.buffers, inputs
+                )
+            except Exception as e:
+                print(
+                    f"Models can't be vmapped ({e!r:.200}), evaluating them one by one"
+                )
+                self.vmap_failed = True
+
+        outputs = []
+        for model in self.models:
+            logits = model(*inputs)
+            outputs.append(logits[0] if isinstance(logits, tuple) else logits)
+        return torch.stack(outputs)
+
+
+def score(ensemble: Ensemble, ts_data, chunk_size: int, batch_size: int):
+    """
+    Score the time series [subjects, time, components] (e.g. a memory-mapped .npy file)
+    with every model of the ensemble.
+    The data is preprocessed in chunks of chunk_size subjects, which are fed to the models
+    in batches of batch_size, so only a chunk of the data is in memory at once.
+
+    Returns class probabilities of each model [n_models, subjects, n_classes]
+    and their ensemble average [subjects, n_classes]
+    """
+    n_subjects = ts_data.shape[0]
+    probabilities = np.empty(
+        (len(ensemble.models), n_subjects, ensemble.n_classes), dtype=np.float32
+    )
+
+    for start in range(0, n_subjects, chunk_size):
+        # read the chunk into memory
+        chunk = np.array(ts_data[start : start + chunk_size], dtype=np.float32)
+        inputs = ensemble.preprocess(chunk)
+
+        for batch_start in range(0, chunk.shape[0], batch_size):
+            batch = [
+                torch.as_tensor(
+                    x[batch_start : batch_start + batch_size], dtype=torch.float32
+                ).to(ensemble.device)
+                for x in inputs
+            ]
+            batch_probabilities = ensemble.predict_proba(batch)
+
+            begin = start + batch_start
+            probabilities[:, begin : begin + batch[0].shape[0]] = (
+                batch_probabilities.cpu().numpy()
+            )
+
+        print(f"Scored {min(start + chunk_size, n_subjects)}/{n_subjects} subjects")
+
+    return probabilities, probabilities.mean(axis=0)
@@ -1,18 +1,35 @@
+# pylint: disable=import-outside-toplevel
 """Logger factory"""
+import glob
+import json
+import os
+import queue
+import threading
+
+import pandas as pd
 from omegaconf import open_dict
-import wandb
 
+from src.results_store import to_json
 from src.settings import ASSETS_ROOT
 
 
 def logger_factory(cfg, model_cfg):
-    """Basic logger factory"""
-    logger = wandb.init(
-        project=cfg.project_name,
-        name=cfg.wandb_trial_name,
-        save_code=True,
-        dir=f"{ASSETS_ROOT}/utility_logs"
-    )
+    """
+    Basic logger factory.
+    cfg.logger selects the logger backend:
+        'wandb' (default) - wandb run per experiment run
+        'local' - buffered JSON logs in the run directory, can be synced to wandb with scripts/sync_logs.py
+        'none' - no logging, only the results saved by the trainer
+    """
+    backend = cfg.logger if "logger" in cfg else "wandb"
+    if backend == "wandb":
+        logger = WandbLogger(cfg)
+    elif backend == "local":
+        logger = LocalLogger(cfg)
+    elif backend == "none":
+        logger = DummyLogger()
+    else:
+        raise NotImplementedError(f"Unknown logger '{backend}'")
 
     # save tuning process wandb link
     if cfg.mode.name == "tune":
@@ -21,3 +38,160 @@ def logger_factory(cfg, model_cfg):
             model_cfg.link = link
 
     return logger
+
+
+def log_train_table(wandb, run, train_results):
+    """Log per-epoch train results DataFrame to the wandb run as a table with loss plots"""
+    table = wandb.Table(dataframe=train_results)
+    for key in ["train_average_loss", "valid_average_loss"]:
+        run.log({key: wandb.plot.line(table, "epoch", key, title=key)})
+    run.log({"train_table": table})
+
+
+class WandbLogger:
+    """wandb run with the logger interface used by the trainers"""
+
+    def __init__(self, cfg):
+        import wandb
+
+        self.wandb = wandb
+        self.run = wandb.init(
+            project=cfg.project_name,
+            name=cfg.wandb_trial_name,
+            save_code=True,
+            dir=f"{ASSETS_ROOT}/utility_logs",
+        )
+        self.summary = self.run.summary
+        self.config = self.run.config
+
+    def log(self, data):
+        self.run.log(data)
+
+    def log_train_results(self, train_results):
+        """Log per-epoch train results DataFrame as a table with loss plots"""
+        log_train_table(self.wandb, self.run, train_results)
+
+    def get_url(self):
+        return self.run.get_url()
+
+    def finish(self):
+        self.run.finish()
+
+
+class DummyLogger:
+    """Logger that logs nothing"""
+
+    def __init__(self):
+        self.summary = {}
+        self.config = {}
+
+    def log(self, data):
+        pass
+
+    def log_train_results(self, train_results):
+        pass
+
+    def get_url(self):
+        return None
+
+    def finish(self):
+        pass
+
+
+class LocalLogger:
+    """
+    Low-overhead logger writing to '{cfg.run_dir}/logs':
+        metrics.jsonl - logged dicts, one per line, written by a background thread
+        train_results.csv - per-epoch train results, uploaded as a table with loss plots
+        summary.json, config.json, meta.json - written on finish()
+    """
+
+    def __init__(self, cfg):
+        self.log_dir = f"{cfg.run_dir}/logs"
+        os.makedirs(self.log_dir, exist_ok=True)
+
+        self.meta = {"project": cfg.project_name, "name": cfg.wandb_trial_name}
+        self.summary = {}
+        self.config = {}
+        self.step = 0
+
+        self.queue = queue.Queue()
+        self.writer = threading.Thread(target=self.write_metrics, daemon=True)
+        self.writer.start()
+
+    def write_metrics(self):
+        with open(f"{self.log_dir}/metrics.jsonl", "a", encoding="utf8") as f:
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    break
+                f.write(item + "\n")
+                # flush only when the buffer is drained
+                if self.queue.empty():
+                    f.flush()
+
+    def log(self, data):
+        self.queue.put(to_json({"_step": self.step, **data}))
+        self.step += 1
+
+    def log_train_results(self, train_results):
+        train_results.to_csv(f"{self.log_dir}/train_results.csv", index=False)
+
+    def get_url(self):
+        return self.log_dir
+
+    def finish(self):
+        self.queue.put(None)
+        self.writer.join()
+        for name, data in [
+            ("summary", dict(self.summary)),
+            ("config", dict(self.config)),
+            ("meta", self.meta),
+        ]:
+            with open(f"{self.log_dir}/{name}.json", "w", encoding="utf8") as f:
+                f.write(to_json(data))
+
+
+def sync_local_logs(path):
+    """
+    Upload the logs written by LocalLogger in all run directories under `path` to wandb.
+    Uploaded logs are marked with 'synced.json' (wandb run id and url) and skipped
+    by the following calls, so syncing can be repeated after new runs or failures
+    """
+    import wandb
+
+    log_dirs = sorted(glob.glob(f"{path}/**/logs/meta.json", recursive=True))
+    for meta_path in log_dirs:
+        log_dir = os.path.dirname(meta_path)
+        if os.path.exists(f"{log_dir}/synced.json"):
+            print(f"'{log_dir}' is already synced, skipping")
+            continue
+
+        loaded = {}
+        for name in ["meta", "summary", "config"]:
+            with open(f"{log_dir}/{name}.json", "r", encoding="utf8") as f:
+                loaded[name] = json.load(f)
+
+        run = wandb.init(
+            project=loaded["meta"]["project"],
+            name=loaded["meta"]["name"],
+            config=loaded["config"],
+            dir=f"{ASSETS_ROOT}/utility_logs",
+        )
+        # train results are logged before the test results, as in WandbLogger
+        if os.path.exists(f"{log_dir}/train_results.csv"):
+            log_train_table(wandb, run, pd.read_csv(f"{log_dir}/train_results.csv"))
+        with open(f"{log_dir}/metrics.jsonl", "r", encoding="utf8") as f:
+            for line in f:
+                data = json.loads(line)
+                data.pop("_step", None)
+                run.log(data)
+        for key, value in loaded["summary"].items():
+            run.summary[key] = value
+        synced = {"id": run.id, "url": run.get_url()}
+        run.finish()
+
+        with open(f"{log_dir}/synced.json", "w", encoding="utf8") as f:
+            f.write(to_json(synced))
+
+        print(f"Synced '{log_dir}'")
@@ -7,6 +7,8 @@ import os
 from omegaconf import OmegaConf, DictConfig, open_dict
 
 from src.settings import LOGS_ROOT
+from src.sampler import TPESampler, load_trial_history
+from src.profiling import account_memory
 
 
 def model_config_factory(cfg: DictConfig, k=None):
@@ -22,7 +24,12 @@ def model_config_factory(cfg: DictConfig, k=None):
 
 
 def get_tune_config(cfg: DictConfig):
-    """Returns random HPs defined by the models random_HPs() function"""
+    """
+    Returns HPs for the next tuning trial.
+    If cfg.mode.sampler is 'random' (default), returns random HPs defined by the models random_HPs() function.
+    If cfg.mode.sampler is 'tpe', returns HPs proposed by TPE, fitted on the finished trials of the tuning fold.
+        The search space is defined by the models search_space() function
+    """
     if "tunable" in cfg.model:
         assert cfg.model.tunable, "Model is specified as not tunable, aborting"
 
@@ -35,16 +42,33 @@ def get_tune_config(cfg: DictConfig):
                                   in config file and its module name are the same"
         ) from e
 
-    try:
-        random_HPs = model_module.random_HPs
-    except AttributeError as e:
-        raise AttributeError(
-            f"'src.models.{cfg.model.name}' has no function\
-                             'random_HPs'. Is the model not supposed to be\
-                             tuned, or the function misnamed/not defined?"
-        ) from e
-
-    model_cfg = random_HPs(cfg)
+    sampler = cfg.mode.sampler if "sampler" in cfg.mode else "random"
+    if sampler == "random":
+        try:
+            random_HPs = model_module.random_HPs
+        except AttributeError as e:
+            raise AttributeError(
+                f"'src.models.{cfg.model.name}' has no function\
+                                 'random_HPs'. Is the model not supposed to be\
+                                 tuned, or the function misnamed/not defined?"
+            ) from e
+
+        model_cfg = random_HPs(cfg)
+    elif sampler == "tpe":
+        try:
+            search_space = model_module.search_space
+        except AttributeError as e:
+            raise AttributeError(
+                f"'src.models.{cfg.model.name}' has no function\
+                                 'search_space'. TPE sampler requires a declarative\
+                                 search space, is the function misnamed/not defined?"
+            ) from e
+
+        space = search_space(cfg)
+        history = load_trial_history(cfg, space)
+        model_cfg = TPESampler(cfg.mode.tpe).sample(space, history)
+    else:
+        raise NotImplementedError(f"Unknown sampler '{sampler}'")
 
     print("Tuning model config:")
     print(f"{OmegaConf.to_yaml(model_cfg)}")
@@ -84,6 +108,7 @@ def get_best_config(cfg: DictConfig, k=None):
     return model_cfg
 
 
+@account_memory("model_factory")
 def model_factory(cfg: DictConfig, model_cfg: DictConfig):
     """Models factory"""
     try:
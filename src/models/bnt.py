@@ -25,6 +25,7 @@ def default_HPs(cfg: DictConfig):
         "freeze_center": True,
         "project_assignment": True,
         "pos_embed_dim": 360,
+        "input_align": input_align(cfg),
         "node_sz": cfg.dataset.data_info.main.data_shape[1],
         "node_feature_sz": cfg.dataset.data_info.main.data_shape[2],
         "output_size": cfg.dataset.data_info.main.n_classes,
@@ -44,30 +45,67 @@ def default_HPs(cfg: DictConfig):
     return OmegaConf.create(model_cfg)
 
 
-def data_postproc(cfg: DictConfig, model_cfg: DictConfig, original_data):
-    # 4 is the number of heads in the BNT TransPoolingEncoder
-    if cfg.dataset.data_info.main.data_shape[2] % 4 != 0:
-        addendum_size = 4 - cfg.dataset.data_info.main.data_shape[2] % 4
-        print(f"Adding {addendum_size} column(s) of zeros to the FNC matrices")
+# number of heads in the BNT TransPoolingEncoder, its input width must be divisible by it
+N_HEADS = 4
+
+# {dataset key: (original FNC, padded FNC)}, see data_postproc
+_padded_fnc = {}
+
+
+def input_align(cfg: DictConfig):
+    """
+    How the FNC width is aligned to the number of heads, set in cfg.model.input_align,
+    see BrainNetworkTransformer
+    """
+    align = cfg.model.input_align if "input_align" in cfg.model else "pad"
+    if align not in ["data", "pad", "project"]:
+        raise NotImplementedError(f"Unknown BNT input_align '{align}'")
+    return align
 
-        with open_dict(model_cfg):
-            model_cfg.node_feature_sz = model_cfg.node_feature_sz + addendum_size
 
-        for key in original_data:
-            fnc = original_data[key]["FNC"]
-            addendum = np.zeros((fnc.shape[0], fnc.shape[1], addendum_size))
-            expanded_fnc = np.concatenate((fnc, addendum), axis=2)
-            original_data[key]["FNC"] = expanded_fnc
+def aligned_size(size: int):
+    """Smallest width not less than size that is divisible by the number of heads"""
+    return size + (-size) % N_HEADS
+
+
+def data_postproc(cfg: DictConfig, model_cfg: DictConfig, original_data):
+    # configs saved before input_align pad the data
+    if model_cfg.get("input_align", "data") != "data":
+        return original_data
+
+    fnc_size = original_data["main"]["FNC"].shape[2]
+    if fnc_size % N_HEADS == 0:
+        return original_data
+
+    addendum_size = aligned_size(fnc_size) - fnc_size
+    print(f"Adding {addendum_size} column(s) of zeros to the FNC matrices")
+
+    with open_dict(model_cfg):
+        model_cfg.node_feature_sz = fnc_size + addendum_size
+
+    # original_data is shared by the trials, the padded copies are made once and reused
+    data = {}
+    for key in original_data:
+        fnc = original_data[key]["FNC"]
+        cached = _padded_fnc.get(key)
+        if cached is None or cached[0] is not fnc:
+            expanded_fnc = np.zeros(
+                (fnc.shape[0], fnc.shape[1], fnc_size + addendum_size), dtype=fnc.dtype
+            )
+            expanded_fnc[:, :, :fnc_size] = fnc
+            cached = (fnc, expanded_fnc)
+            _padded_fnc[key] = cached
+        data[key] = {**original_data[key], "FNC": cached[1]}
 
-            with open_dict(cfg):
-                cfg.dataset.data_info[key].data_shape = expanded_fnc.shape
+        with open_dict(cfg):
+            cfg.dataset.data_info[key].data_shape = cached[1].shape
 
-        print("New cfg.dataset.data_info:")
-        print(OmegaConf.to_yaml(cfg.dataset.data_info))
-        print("New model config:")
-        print(OmegaConf.to_yaml(model_cfg))
+    print("New cfg.dataset.data_info:")
+    print(OmegaConf.to_yaml(cfg.dataset.data_info))
+    print("New model config:")
+    print(OmegaConf.to_yaml(model_cfg))
 
-    return original_data
+    return data
 
 
 def get_optimizer(cfg: DictConfig, model_cfg: DictConfig, model):
@@ -91,6 +129,20 @@ class BrainNetworkTransformer(nn.Module):
         self.attention_list = nn.ModuleList()
         forward_dim = model_cfg.node_feature_sz
 
+        # the input width must be divisible by the number of heads:
+        # 'data' - the data is padded with zeros in data_postproc (configs saved before input_align),
+        # 'pad' - the inputs are padded with zeros on the fly,
+        # 'project' - the inputs are projected to the aligned width by a linear layer
+        self.input_align = model_cfg.get("input_align", "data")
+        self.input_padding = 0
+        self.input_projection = None
+        if self.input_align != "data" and forward_dim % N_HEADS != 0:
+            if self.input_align == "project":
+                self.input_projection = nn.Linear(forward_dim, aligned_size(forward_dim))
+            else:
+                self.input_padding = aligned_size(forward_dim) - forward_dim
+            forward_dim = aligned_size(forward_dim)
+
         self.pos_encoding = model_cfg.pos_encoding
         if self.pos_encoding == "identity":
             self.node_identity = nn.Parameter(
@@ -136,6 +188,11 @@ class BrainNetworkTransformer(nn.Module):
             _,
         ) = node_feature.shape
 
+        if self.input_projection is not None:
+            node_feature = self.input_projection(node_feature)
+        elif self.input_padding > 0:
+            node_feature = nn.functional.pad(node_feature, (0, self.input_padding))
+
         if self.pos_encoding == "identity":
             pos_emb = self.node_identity.expand(bz, *self.node_identity.shape)
             node_feature = torch.cat([node_feature, pos_emb], dim=-1)
@@ -152,7 +209,18 @@ class BrainNetworkTransformer(nn.Module):
 
         return self.fc(node_feature)
 
+    def set_attention_capture(self, enabled: bool = True):
+        """
+        Whether the attention weights of the following forward passes are stored
+        for get_attention_weights(); capturing disables the memory-efficient attention
+        """
+        for atten in self.attention_list:
+            atten.transformer.capture_attention = enabled
+            if not enabled:
+                atten.transformer.attention_weights = None
+
     def get_attention_weights(self):
+        """Attention weights of the last forward pass with attention capture enabled"""
         return [atten.get_attention_weights() for atten in self.attention_list]
 
     def get_cluster_centers(self) -> torch.Tensor:
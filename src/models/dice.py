@@ -1,13 +1,15 @@
-# pylint: disable=invalid-name, no-member, missing-function-docstring, too-many-branches, too-few-public-methods, unused-argument
+# pylint: disable=invalid-name, no-member, missing-function-docstring, too-many-branches, too-few-public-methods, unused-argument, too-many-locals, too-many-statements
 """ DICE model from https://github.com/UsmanMahmood27/DICE """
-from random import uniform, randint
-
 import torch
 from torch import nn
 from torch import optim
+from torch.profiler import record_function
+from torch.utils.checkpoint import checkpoint
 
 from omegaconf import OmegaConf, DictConfig
 
+from src.sampler import Uniform, RandInt, Choice, sample_random_HPs
+
 
 def get_model(cfg: DictConfig, model_cfg: DictConfig):
     return DICE(model_cfg)
@@ -18,30 +20,85 @@ def get_criterion(cfg: DictConfig, model_cfg: DictConfig):
 
 
 class DICEregCEloss:
-    """Cross-entropy loss with model regularization"""
+    """
+    Cross-entropy loss with L1 regularization of the GTA weights (see regularized_params).
+    If model_cfg.reg_mode is 'proximal', the L1 term is applied by ProximalAdam's
+    soft-thresholding step instead, and only its value is added to the loss, without gradients
+    """
 
     def __init__(self, model_cfg):
         self.ce_loss = nn.CrossEntropyLoss()
 
         self.reg_param = model_cfg.reg_param
+        # model configs saved before reg_mode was introduced add the L1 term to the loss
+        self.reg_mode = model_cfg.get("reg_mode", "loss")
+
+        # regularized parameters are collected once per model
+        self.model = None
+        self.params = None
 
     def __call__(self, logits, target, model, device):
         ce_loss = self.ce_loss(logits, target)
 
-        reg_loss = torch.zeros(1).to(device)
+        if self.model is not model:
+            self.model = model
+            self.params = regularized_params(model)
 
-        for name, param in model.gta_embed.named_parameters():
-            if "bias" not in name:
-                reg_loss += self.reg_param * torch.norm(param, p=1)
-
-        for name, param in model.gta_attend.named_parameters():
-            if "bias" not in name:
-                reg_loss += self.reg_param * torch.norm(param, p=1)
+        # in proximal mode the L1 term is applied by the optimizer, only its value is added
+        with torch.set_grad_enabled(torch.is_grad_enabled() and self.reg_mode == "loss"):
+            reg_loss = self.reg_param * torch.stack(torch._foreach_norm(self.params, 1)).sum()
 
         loss = ce_loss + reg_loss
         return loss
 
 
+def regularized_params(model):
+    """Weights of the GTA block, L1-regularized by DICEregCEloss or ProximalAdam"""
+    return [
+        param
+        for module in [model.gta_embed, model.gta_attend]
+        for name, param in module.named_parameters()
+        if "bias" not in name
+    ]
+
+
+def get_optimizer(cfg: DictConfig, model_cfg: DictConfig, model):
+    if model_cfg.get("reg_mode", "loss") == "proximal":
+        return ProximalAdam(model, lr=model_cfg.lr, reg_param=model_cfg.reg_param)
+    return optim.Adam(model.parameters(), lr=float(model_cfg.lr))
+
+
+class ProximalAdam(optim.Adam):
+    """
+    Adam with a proximal step for the L1 regularization of the GTA weights:
+    after each Adam step the regularized parameters are soft-thresholded by lr * reg_param
+    (the current lr of their parameter group, so ReduceLROnPlateau also scales the threshold).
+    The L1 term is then not a part of the loss, and the weights can become exactly zero
+    """
+
+    def __init__(self, model, lr, reg_param):
+        regularized = regularized_params(model)
+        regularized_ids = {id(param) for param in regularized}
+        others = [param for param in model.parameters() if id(param) not in regularized_ids]
+        super().__init__(
+            [
+                {"params": regularized, "l1": float(reg_param)},
+                {"params": others, "l1": 0.0},
+            ],
+            lr=float(lr),
+        )
+
+    @torch.no_grad()
+    def step(self, closure=None):
+        loss = super().step(closure)
+        for group in self.param_groups:
+            if group["l1"] > 0:
+                threshold = group["lr"] * group["l1"]
+                for param in group["params"]:
+                    param.copy_(nn.functional.softshrink(param, threshold))
+        return loss
+
+
 def get_scheduler(cfg: DictConfig, model_cfg: DictConfig, optimizer):
     scheduler = optim.lr_scheduler.ReduceLROnPlateau(
         optimizer,
@@ -52,12 +109,42 @@ def get_scheduler(cfg: DictConfig, model_cfg: DictConfig, optimizer):
     return scheduler
 
 
+def lstm_impl(cfg: DictConfig):
+    """Implementation of the temporal encoder set in cfg.model.lstm_impl, see DICE"""
+    impl = cfg.model.lstm_impl if "lstm_impl" in cfg.model else "torch"
+    if impl not in ["torch", "scan", "conv"]:
+        raise NotImplementedError(f"Unknown DICE lstm_impl '{impl}'")
+    return impl
+
+
+def reg_mode(cfg: DictConfig):
+    """How the L1 regularization is applied, set in cfg.model.reg_mode, see DICEregCEloss"""
+    mode = cfg.model.reg_mode if "reg_mode" in cfg.model else "loss"
+    if mode not in ["loss", "proximal"]:
+        raise NotImplementedError(f"Unknown DICE reg_mode '{mode}'")
+    return mode
+
+
+def chunk_size(cfg: DictConfig):
+    """Time chunk size of the attention and GTA blocks set in cfg.model.chunk_size, see DICE"""
+    return cfg.model.chunk_size if "chunk_size" in cfg.model else None
+
+
+def attention_impl(cfg: DictConfig):
+    """Implementation of the multi-head attention block set in cfg.model.attention_impl, see DICE"""
+    impl = cfg.model.attention_impl if "attention_impl" in cfg.model else "weights"
+    if impl not in ["mha", "weights"]:
+        raise NotImplementedError(f"Unknown DICE attention_impl '{impl}'")
+    return impl
+
+
 def default_HPs(cfg: DictConfig):
     model_cfg = {
         "lstm": {
             "bidirectional": True,
             "num_layers": 1,
             "hidden_size": 50,
+            "impl": lstm_impl(cfg),
         },
         "clf": {
             "hidden_size": 64,
@@ -67,45 +154,60 @@ def default_HPs(cfg: DictConfig):
             "n_heads": 1,
             "head_hidden_size": 48,
             "dropout": 0.0,
+            "impl": attention_impl(cfg),
         },
         "scheduler": {
             "patience": 4,
             "factor": 0.5,
         },
         "reg_param": 1e-6,
+        "reg_mode": reg_mode(cfg),
         "lr": 2e-4,
+        "chunk_size": chunk_size(cfg),
         "input_size": cfg.dataset.data_info.main.data_shape[2],
         "output_size": cfg.dataset.data_info.main.n_classes,
     }
+    if model_cfg["lstm"]["impl"] == "conv":
+        model_cfg["lstm"]["kernel_size"] = 3
     return OmegaConf.create(model_cfg)
 
 
-def random_HPs(cfg: DictConfig):
-    model_cfg = {
+def search_space(cfg: DictConfig):
+    space = {
         "lstm": {
-            "bidirectional": bool(randint(0, 1)),
-            "num_layers": randint(1, 3),
-            "hidden_size": randint(20, 60),
+            "bidirectional": Choice([False, True]),
+            "num_layers": RandInt(1, 3),
+            "hidden_size": RandInt(20, 60),
+            "impl": lstm_impl(cfg),
         },
         "clf": {
-            "hidden_size": randint(16, 128),
-            "num_layers": randint(0, 3),
+            "hidden_size": RandInt(16, 128),
+            "num_layers": RandInt(0, 3),
         },
         "MHAtt": {
-            "n_heads": randint(1, 4),
-            "head_hidden_size": randint(16, 64),
-            "dropout": uniform(0.0, 0.9),
+            "n_heads": RandInt(1, 4),
+            "head_hidden_size": RandInt(16, 64),
+            "dropout": Uniform(0.0, 0.9),
+            "impl": attention_impl(cfg),
         },
         "scheduler": {
-            "patience": randint(1, cfg.mode.patience // 2),
-            "factor": uniform(0.1, 0.8),
+            "patience": RandInt(1, cfg.mode.patience // 2),
+            "factor": Uniform(0.1, 0.8),
         },
-        "reg_param": 10 ** uniform(-8, -4),
-        "lr": 10 ** uniform(-5, -3),
+        "reg_param": Uniform(1e-8, 1e-4, log=True),
+        "reg_mode": reg_mode(cfg),
+        "lr": Uniform(1e-5, 1e-3, log=True),
+        "chunk_size": chunk_size(cfg),
         "input_size": cfg.dataset.data_info.main.data_shape[2],
         "output_size": cfg.dataset.data_info.main.n_classes,
     }
-    return OmegaConf.create(model_cfg)
+    if lstm_impl(cfg) == "conv":
+        space["lstm"]["kernel_size"] = RandInt(2, 5)
+    return space
+
+
+def random_HPs(cfg: DictConfig):
+    return sample_random_HPs(search_space(cfg))
 
 
 class DICE(nn.Module):
@@ -113,6 +215,25 @@ class DICE(nn.Module):
     DICE model for fMRI data.
     Expected input shape: [batch_size, time_length, input_feature_size].
     Output: [batch_size, n_classes]
+
+    Each channel is encoded independently by the temporal encoder (first block),
+    its implementation is set by model_cfg.lstm.impl:
+        torch - nn.LSTM over batch_size * input_feature_size sequences (default)
+        scan - the same LSTM (same parameters and outputs) as an explicit scan over time,
+            batched over the channels and both directions, with fused gate matmuls.
+            Unlike nn.LSTM it is composable with torch.func transforms (e.g. vmap in src.inference)
+        conv - gated dilated convolutions, a parallel approximation of the LSTM, see GatedConvEncoder
+
+    Only the head-averaged attention weights of the multi-head attention block (second block) are used,
+    its implementation is set by model_cfg.MHAtt.impl:
+        mha - nn.MultiheadAttention, which also computes the unused attention output
+        weights - AttentionWeights, the same weights without the value path and the output projection
+            (default for the new model configs)
+
+    If model_cfg.chunk_size is set, the attention and GTA blocks process time in chunks
+    of chunk_size time points with activation checkpointing, see chunked_attention_gta;
+    the activation memory of these blocks scales with chunk_size instead of time_length
+    at the cost of recomputing the attention (requires MHAtt.impl 'weights')
     """
 
     def __init__(self, model_cfg: DictConfig):
@@ -137,13 +258,25 @@ class DICE(nn.Module):
         MHAtt_dropout = model_cfg.MHAtt.dropout
 
         # LSTM - first block
-        self.lstm = nn.LSTM(
-            input_size=1,
-            hidden_size=lstm_hidden_size,
-            num_layers=lstm_num_layers,
-            bidirectional=bidirectional,
-            batch_first=True,
-        )
+        # model configs saved before lstm.impl was introduced use nn.LSTM
+        self.lstm_impl = model_cfg.lstm.get("impl", "torch")
+        if self.lstm_impl in ["torch", "scan"]:
+            self.lstm = nn.LSTM(
+                input_size=1,
+                hidden_size=lstm_hidden_size,
+                num_layers=lstm_num_layers,
+                bidirectional=bidirectional,
+                batch_first=True,
+            )
+        elif self.lstm_impl == "conv":
+            self.lstm = GatedConvEncoder(
+                hidden_size=lstm_hidden_size,
+                num_layers=lstm_num_layers,
+                bidirectional=bidirectional,
+                kernel_size=model_cfg.lstm.kernel_size,
+            )
+        else:
+            raise NotImplementedError(f"Unknown lstm.impl '{self.lstm_impl}'")
 
         # Classifier - last block
         clf = [
@@ -171,18 +304,33 @@ class DICE(nn.Module):
                 MHAtt_hidden_size,
             ),
         )
-        self.query_layer = nn.Sequential(
-            nn.Linear(
-                self.lstm_output_size,
-                MHAtt_hidden_size,
-            ),
-        )
-        self.multihead_attn = nn.MultiheadAttention(
-            embed_dim=MHAtt_hidden_size,
-            num_heads=MHAtt_n_heads,
-            dropout=MHAtt_dropout,
-            batch_first=True,
-        )
+        # model configs saved before MHAtt.impl was introduced use nn.MultiheadAttention
+        self.attention_impl = model_cfg.MHAtt.get("impl", "mha")
+        if self.attention_impl == "mha":
+            self.query_layer = nn.Sequential(
+                nn.Linear(
+                    self.lstm_output_size,
+                    MHAtt_hidden_size,
+                ),
+            )
+            self.multihead_attn = nn.MultiheadAttention(
+                embed_dim=MHAtt_hidden_size,
+                num_heads=MHAtt_n_heads,
+                dropout=MHAtt_dropout,
+                batch_first=True,
+            )
+        elif self.attention_impl == "weights":
+            self.multihead_attn = AttentionWeights(
+                embed_dim=MHAtt_hidden_size,
+                num_heads=MHAtt_n_heads,
+                dropout=MHAtt_dropout,
+            )
+        else:
+            raise NotImplementedError(f"Unknown MHAtt.impl '{self.attention_impl}'")
+
+        self.chunk_size = model_cfg.get("chunk_size", None)
+        if self.chunk_size and self.attention_impl != "weights":
+            raise NotImplementedError("Chunked execution requires MHAtt.impl 'weights'")
 
         # Global Temporal Attention - third block
         self.upscale = 0.05
@@ -217,9 +365,10 @@ class DICE(nn.Module):
         for name, param in self.clf.named_parameters():
             if "weight" in name:
                 nn.init.kaiming_normal_(param, mode="fan_in")
-        for name, param in self.query_layer.named_parameters():
-            if "weight" in name:
-                nn.init.kaiming_normal_(param, mode="fan_in")
+        if self.attention_impl == "mha":
+            for name, param in self.query_layer.named_parameters():
+                if "weight" in name:
+                    nn.init.kaiming_normal_(param, mode="fan_in")
         for name, param in self.key_layer.named_parameters():
             if "weight" in name:
                 nn.init.kaiming_normal_(param, mode="fan_in")
@@ -249,12 +398,110 @@ class DICE(nn.Module):
         x_graphattention = self.HW(x_graphattention.reshape(a, b))
         return (x * (x_graphattention.unsqueeze(-1))).mean(node_axis)
 
-    def multi_head_attention(self, x):
+    def chunked_attention_gta(self, lstm_output):
+        """
+        Same as the attention and GTA blocks of forward (including the batch statistics of gta_norm
+        in training), computed over chunks of chunk_size time points.
+        The GTA readout is built from running reductions over the chunks:
+            1. mean of the attention weights over time
+            2. (training only) mean and variance of the GTA embeddings for gta_norm,
+                combined over the chunks (Chan et al.)
+            3. sum of the attention weights weighted by GTA over time
+        Each chunk is computed with activation checkpointing, so only the chunks' inputs
+        and the reductions are kept for the backward pass. Attention dropout masks are
+        seeded per chunk, so the recomputed attention weights are the same in every pass
+        """
+        # lstm_output.shape: [batch_size; input_feature_size; time_length; lstm_hidden_size]
+        B, _, T, _ = lstm_output.shape
+        # a single split, so the gradient of lstm_output is assembled once rather than per chunk
+        time_chunks = lstm_output.split(self.chunk_size, dim=2)
+        seeds = [None] * len(time_chunks)
+        if self.training and self.multihead_attn.dropout > 0:
+            seeds = torch.randint(2**62, (len(time_chunks),)).tolist()
+
+        def chunks():
+            return zip(time_chunks, seeds)
+
+        def attention_sum(chunk, seed):
+            return self.attention_chunk(chunk, seed).sum(1)
+
+        # 1. mean of the attention weights over time
+        x_mean = sum(
+            checkpoint(attention_sum, chunk, seed, use_reentrant=False)
+            for chunk, seed in chunks()
+        ).unsqueeze(1) / T
+        # x_mean.shape: [batch_size; 1; input_feature_size * input_feature_size]
+
+        # 2. statistics of the GTA embeddings
+        norm = self.gta_norm[0]
+        if self.training:
+
+            def embed_stats(chunk, seed, x_mean):
+                x_embed = self.gta_embed_chunk(chunk, seed, x_mean)
+                var, mean = torch.var_mean(x_embed, dim=0, unbiased=False)
+                return mean, var
+
+            stats = [
+                (
+                    chunk.shape[2] * B,
+                    *checkpoint(embed_stats, chunk, seed, x_mean, use_reentrant=False),
+                )
+                for chunk, seed in chunks()
+            ]
+            n = T * B
+            mean = sum(count * chunk_mean for count, chunk_mean, _ in stats) / n
+            var = (
+                sum(
+                    count * (chunk_var + (chunk_mean - mean) ** 2)
+                    for count, chunk_mean, chunk_var in stats
+                )
+                / n
+            )
+            update_running_stats(norm, mean.detach(), var.detach(), n)
+        else:
+            mean, var = norm.running_mean, norm.running_var
+
+        # 3. attention weights weighted by GTA
+        def weighted_sum(chunk, seed, x_mean, mean, var):
+            x = self.attention_chunk(chunk, seed)
+            x_embed = self.gta_embed_chunk(chunk, seed, x_mean, x)
+            x_embed = (x_embed - mean) / torch.sqrt(var + norm.eps)
+            x_embed = self.gta_norm[1](x_embed * norm.weight + norm.bias)
+            x_graphattention = self.HW(self.gta_attend(x_embed).reshape(B, -1))
+            return (x * x_graphattention.unsqueeze(-1)).sum(1)
+
+        return (
+            sum(
+                checkpoint(weighted_sum, chunk, seed, x_mean, mean, var, use_reentrant=False)
+                for chunk, seed in chunks()
+            )
+            / T
+        )
+
+    def attention_chunk(self, chunk, seed=None):
+        """Attention weights [batch_size; chunk_length; input_feature_size * input_feature_size]"""
+        # chunk.shape: [batch_size; input_feature_size; chunk_length; lstm_hidden_size]
+        B, C, T, _ = chunk.shape
+        chunk = chunk.permute(2, 0, 1, 3).reshape(T * B, C, self.lstm_output_size)
+        _, attn_weights = self.multi_head_attention(chunk, seed)
+        return attn_weights.reshape(T, B, C * C).transpose(0, 1)
+
+    def gta_embed_chunk(self, chunk, seed, x_mean, x=None):
+        """GTA embeddings of the chunk [batch_size * chunk_length; GTA embedding size], before gta_norm"""
+        if x is None:
+            x = self.attention_chunk(chunk, seed)
+        return self.gta_embed((x * x_mean).reshape(-1, x.shape[2]))
+
+    def multi_head_attention(self, x, seed=None):
         # x.shape: [time_length * batch_size; input_feature_size; lstm_hidden_size]
+        # note that key_layer and value_layer outputs are the query and the key of the attention
         key = self.key_layer(x)
         value = self.value_layer(x)
-        query = self.query_layer(x)
 
+        if self.attention_impl == "weights":
+            return None, self.multihead_attn(key, value, seed)
+
+        query = self.query_layer(x)
         attn_output, attn_output_weights = self.multihead_attn(key, value, query)
 
         return attn_output, attn_output_weights
@@ -266,19 +513,32 @@ class DICE(nn.Module):
         x = x.permute(0, 2, 1)  # x.shape: [batch_size; input_feature_size; time_length]
         x = x.reshape(B * C, T, 1)  # x.shape: [batch_size * n_channels; time_length; 1]
         ##########################
-        lstm_output, _ = self.lstm(x)
+        with record_function("DICE.lstm"):
+            if self.lstm_impl == "torch":
+                lstm_output, _ = self.lstm(x)
+            elif self.lstm_impl == "scan":
+                lstm_output = lstm_scan(self.lstm, x)
+            else:
+                lstm_output = self.lstm(x)
         # lstm_output.shape: [batch_size * input_feature_size; time_length; lstm_hidden_size]
         ##########################
         lstm_output = lstm_output.reshape(B, C, T, self.lstm_output_size)
         # lstm_output.shape: [batch_size; input_feature_size; time_length; lstm_hidden_size]
 
+        if self.chunk_size:
+            # 2-3. attention and GTA blocks over chunks of time
+            with record_function("DICE.chunked_attention_gta"):
+                FC = self.chunked_attention_gta(lstm_output)
+            return self.clf(FC)
+
         # 2. pass lstm_output at each time point to multihead attention to reveal spatial connctions
         lstm_output = lstm_output.permute(2, 0, 1, 3)
         # lstm_output.shape: [time_length; batch_size; input_feature_size; lstm_hidden_size]
         lstm_output = lstm_output.reshape(T * B, C, self.lstm_output_size)
         # lstm_output.shape: [time_length * batch_size; input_feature_size; lstm_hidden_size]
         ##########################
-        _, attn_weights = self.multi_head_attention(lstm_output)
+        with record_function("DICE.multi_head_attention"):
+            _, attn_weights = self.multi_head_attention(lstm_output)
         # attn_weights.shape: [time_length * batch_size; input_feature_size; input_feature_size]
         ##########################
         attn_weights = attn_weights.reshape(T, B, C, C)
@@ -290,7 +550,8 @@ class DICE(nn.Module):
         attn_weights = attn_weights.reshape(B, T, -1)
         # attn_weights.shape: [batch_size; time_length; input_feature_size * input_feature_size]
         ##########################
-        FC = self.gta_attention(attn_weights)
+        with record_function("DICE.gta_attention"):
+            FC = self.gta_attention(attn_weights)
         # FC.shape: [batch_size; input_feature_size * input_feature_size]
         ##########################
 
@@ -299,3 +560,171 @@ class DICE(nn.Module):
         # logits.shape: [batch_size; n_classes]
 
         return logits
+
+
+class AttentionWeights(nn.Module):
+    """
+    Head-averaged attention weights softmax(QK^T / sqrt(head_dim)) of nn.MultiheadAttention
+    (batch_first, average_attn_weights=True), without the value projection, the attention output
+    and the output projection. Dropout is applied to the weights, as nn.MultiheadAttention does
+    before returning them.
+    Expected input shapes: query [batch_size, target_length, embed_dim],
+    key [batch_size, source_length, embed_dim].
+    Output: [batch_size, target_length, source_length]
+    """
+
+    def __init__(self, embed_dim, num_heads, dropout=0.0):
+        super().__init__()
+        assert embed_dim % num_heads == 0, "embed_dim must be divisible by num_heads"
+        self.num_heads = num_heads
+        self.head_dim = embed_dim // num_heads
+        self.dropout = dropout
+
+        self.q_proj = nn.Linear(embed_dim, embed_dim)
+        self.k_proj = nn.Linear(embed_dim, embed_dim)
+        # same initialization as nn.MultiheadAttention in_proj
+        nn.init.xavier_uniform_(self.q_proj.weight)
+        nn.init.xavier_uniform_(self.k_proj.weight)
+        nn.init.zeros_(self.q_proj.bias)
+        nn.init.zeros_(self.k_proj.bias)
+
+    def forward(self, query, key, seed=None):
+        """If seed is set, the dropout mask is drawn from a generator seeded with it"""
+        N, L, _ = query.shape
+        S = key.shape[1]
+        # [batch_size; num_heads; length; head_dim]
+        q = self.q_proj(query).view(N, L, self.num_heads, self.head_dim).transpose(1, 2)
+        k = self.k_proj(key).view(N, S, self.num_heads, self.head_dim).transpose(1, 2)
+
+        weights = torch.softmax(
+            torch.matmul(q * self.head_dim**-0.5, k.transpose(-2, -1)), dim=-1
+        )
+        if seed is not None and self.training and self.dropout > 0:
+            generator = torch.Generator(weights.device).manual_seed(seed)
+            keep = torch.rand(
+                weights.shape, generator=generator, device=weights.device
+            ) >= self.dropout
+            weights = weights * keep / (1 - self.dropout)
+        else:
+            weights = nn.functional.dropout(weights, self.dropout, self.training)
+        return weights.mean(dim=1)
+
+
+def update_running_stats(norm: nn.BatchNorm1d, mean, var, n):
+    """Update the running statistics of the batch norm with the batch mean and biased variance of n samples"""
+    if not norm.track_running_stats:
+        return
+    with torch.no_grad():
+        norm.num_batches_tracked += 1
+        momentum = (
+            1.0 / float(norm.num_batches_tracked) if norm.momentum is None else norm.momentum
+        )
+        norm.running_mean.mul_(1 - momentum).add_(momentum * mean)
+        norm.running_var.mul_(1 - momentum).add_(momentum * var * n / max(n - 1, 1))
+
+
+def lstm_scan(lstm: nn.LSTM, x):
+    """
+    Output of the batch_first nn.LSTM for the input x [batch_size, time_length, input_size],
+    computed with the LSTM's parameters as a scan over time:
+    input projections of all time points are computed in a single matmul,
+    and the recurrent projections of both directions are fused into a single batched matmul per step
+    """
+    N, T, _ = x.shape
+    H = lstm.hidden_size
+    directions = ["", "_reverse"] if lstm.bidirectional else [""]
+
+    for layer in range(lstm.num_layers):
+        if layer > 0:
+            x = nn.functional.dropout(x, lstm.dropout, lstm.training)
+
+        # [directions, 4 * hidden_size, ...], gates are ordered as in nn.LSTM: input, forget, cell, output
+        w_ih = torch.stack([getattr(lstm, f"weight_ih_l{layer}{d}") for d in directions])
+        w_hh = torch.stack([getattr(lstm, f"weight_hh_l{layer}{d}") for d in directions])
+        bias = torch.stack(
+            [
+                getattr(lstm, f"bias_ih_l{layer}{d}") + getattr(lstm, f"bias_hh_l{layer}{d}")
+                for d in directions
+            ]
+        )
+
+        # input projections: [time_length; directions; batch_size; 4 * hidden_size]
+        x_gates = torch.matmul(
+            x.transpose(0, 1).unsqueeze(1), w_ih.transpose(1, 2).unsqueeze(0)
+        ) + bias.unsqueeze(1)
+        # unbinding is cheaper than indexing in the backward pass
+        x_gates = x_gates.unbind(0)
+        w_hh = w_hh.transpose(1, 2)
+
+        h = x.new_zeros(len(directions), N, H)
+        c = x.new_zeros(len(directions), N, H)
+        outputs = []
+        for t in range(T):
+            if len(directions) == 2:
+                # the reverse direction runs from the end of the sequence
+                step_gates = torch.stack([x_gates[t][0], x_gates[T - 1 - t][1]])
+            else:
+                step_gates = x_gates[t]
+            gates = torch.baddbmm(step_gates, h, w_hh)
+            i, f, g, o = gates.chunk(4, dim=-1)
+            c = torch.sigmoid(f) * c + torch.sigmoid(i) * torch.tanh(g)
+            h = torch.sigmoid(o) * torch.tanh(c)
+            outputs.append(h)
+
+        output = torch.stack(outputs)
+        # output.shape: [time_length; directions; batch_size; hidden_size]
+        if len(directions) == 2:
+            output = torch.stack([output[:, 0], output[:, 1].flip(0)], dim=1)
+        x = output.permute(2, 0, 1, 3).reshape(N, T, len(directions) * H)
+
+    return x
+
+
+class GatedConvEncoder(nn.Module):
+    """
+    Parallel approximation of a single-feature LSTM encoder: a stack of gated convolutions
+    (tanh(a) * sigmoid(b)) over time with dilation kernel_size ** layer, so the receptive field
+    grows exponentially with num_layers. The forward direction is causal and the backward one is
+    anti-causal, as the directions of a bidirectional LSTM; both are computed by the same convolution.
+    Expected input shape: [batch_size, time_length, 1].
+    Output: [batch_size, time_length, hidden_size * directions]
+    """
+
+    def __init__(self, hidden_size, num_layers, bidirectional, kernel_size):
+        super().__init__()
+        self.hidden_size = hidden_size
+        self.n_directions = 2 if bidirectional else 1
+
+        self.paddings = []
+        convs = []
+        for layer in range(num_layers):
+            dilation = kernel_size**layer
+            padding = (kernel_size - 1) * dilation
+            self.paddings.append(padding)
+            convs.append(
+                nn.Conv1d(
+                    1 if layer == 0 else hidden_size * self.n_directions,
+                    2 * hidden_size * self.n_directions,
+                    kernel_size,
+                    padding=padding,
+                    dilation=dilation,
+                )
+            )
+        self.convs = nn.ModuleList(convs)
+
+    def forward(self, x):
+        T = x.shape[1]
+        x = x.transpose(1, 2)
+        # x.shape: [batch_size; features; time_length]
+        for padding, conv in zip(self.paddings, self.convs):
+            # output at i covers inputs [i - padding, i]
+            y = conv(x).split(2 * self.hidden_size, dim=1)
+            outputs = [y[0][..., :T]]
+            if self.n_directions == 2:
+                outputs.append(y[1][..., padding:])
+            outputs = [
+                torch.tanh(a) * torch.sigmoid(b)
+                for a, b in (output.chunk(2, dim=1) for output in outputs)
+            ]
+            x = torch.cat(outputs, dim=1)
+        return x.transpose(1, 2)
@@ -1,12 +1,14 @@
 # pylint: disable=invalid-name, missing-function-docstring
 """ MLP model module """
-from random import uniform, randint
-
 import torch
 from torch import nn
+from torch.profiler import record_function
 
 from omegaconf import OmegaConf, DictConfig
 
+from src.profiling import profiler_active
+from src.sampler import Uniform, RandInt, sample_random_HPs
+
 
 def get_model(cfg: DictConfig, model_cfg: DictConfig):
     return RearrangedMLP(model_cfg)
@@ -24,16 +26,19 @@ def default_HPs(cfg: DictConfig):
     return OmegaConf.create(model_cfg)
 
 
-def random_HPs(cfg: DictConfig):
-    model_cfg = {
-        "dropout": uniform(0.1, 0.9),
-        "hidden_size": randint(32, 256),
-        "num_layers": randint(0, 4),
-        "lr": 10 ** uniform(-4, -3),
+def search_space(cfg: DictConfig):
+    return {
+        "dropout": Uniform(0.1, 0.9),
+        "hidden_size": RandInt(32, 256),
+        "num_layers": RandInt(0, 4),
+        "lr": Uniform(1e-4, 1e-3, log=True),
         "input_size": cfg.dataset.data_info.main.data_shape[2],
         "output_size": cfg.dataset.data_info.main.n_classes,
     }
-    return OmegaConf.create(model_cfg)
+
+
+def random_HPs(cfg: DictConfig):
+    return sample_random_HPs(search_space(cfg))
 
 
 class ResidualBlock(nn.Module):
@@ -100,10 +105,28 @@ class RearrangedMLP(nn.Module):
 
         self.fc = nn.Sequential(*layers)
 
+        # (profiler range name, indices of the layers in self.fc) of the input, inter and output blocks,
+        # used while a TorchProfiler is recording (see src.profiling.profiler_active);
+        # layers are looked up in self.fc, so they can be replaced (e.g. quantized)
+        self.blocks = [("RearrangedMLP.input_block", range(0, 4))]
+        self.blocks += [
+            (f"RearrangedMLP.inter_block_{i}", range(4 + i, 5 + i))
+            for i in range(num_layers)
+        ]
+        self.blocks += [("RearrangedMLP.output_block", range(4 + num_layers, 5 + num_layers))]
+
     def forward(self, x: torch.Tensor, introspection=False):
         bs, tl, fs = x.shape  # [batch_size, time_length, input_feature_size]
 
-        fc_output = self.fc(x.view(-1, fs))
+        fc_output = x.view(-1, fs)
+        if profiler_active():
+            # same as self.fc(fc_output), with a profiler range for each block
+            for name, block in self.blocks:
+                with record_function(name):
+                    for i in block:
+                        fc_output = self.fc[i](fc_output)
+        else:
+            fc_output = self.fc(fc_output)
         fc_output = fc_output.view(bs, tl, -1)
 
         logits = fc_output.mean(1)
@@ -113,3 +136,101 @@ class RearrangedMLP(nn.Module):
             return fc_output, predictions
 
         return logits
+
+
+class StreamingRearrangedMLP:
+    """
+    Online classification with a trained RearrangedMLP as new time points arrive.
+
+    RearrangedMLP's logits are the mean of its per-time-point logits, so the running sum
+    and count of the per-time-point logits of each subject give the prediction on all
+    the time points seen so far; an update costs O(new time points).
+
+    If zscore is True (models trained on 'cfg.dataset.zscore=True' data), time points are
+    z-scored with the running per-component mean and std of the subject, updated with
+    each chunk (Welford/Chan). Time points of earlier chunks are not re-normalized,
+    so the predictions approach the offline ones as the statistics settle.
+
+    Usage:
+        stream = StreamingRearrangedMLP(model, n_subjects=1, zscore=cfg.dataset.zscore)
+        for chunk in acquisition:  # [n_subjects, new_time_points, components]
+            stream.update(chunk)
+            prediction, confidence = stream.predict()
+    """
+
+    def __init__(self, model: RearrangedMLP, n_subjects: int = 1, zscore: bool = False):
+        self.model = model.eval()
+        self.n_subjects = n_subjects
+        self.zscore = zscore
+
+        parameter = next(model.parameters())
+        self.device, self.dtype = parameter.device, parameter.dtype
+        self.n_classes = model.fc[-1].out_features
+        self.n_components = model.fc[0].in_features
+        self.reset()
+
+    def reset(self, subjects=None):
+        """Forget the time points of the subjects (all subjects by default)"""
+        if subjects is None:
+            shape = (self.n_subjects,)
+            self.count = torch.zeros(shape, device=self.device, dtype=self.dtype)
+            self.logit_sum = torch.zeros(
+                shape + (self.n_classes,), device=self.device, dtype=self.dtype
+            )
+            # running per-component mean and sum of squared deviations of the time points
+            self.mean = torch.zeros(
+                shape + (self.n_components,), device=self.device, dtype=self.dtype
+            )
+            self.m2 = torch.zeros_like(self.mean)
+        else:
+            for state in [self.count, self.logit_sum, self.mean, self.m2]:
+                state[subjects] = 0
+
+    @torch.no_grad()
+    def update(self, x: torch.Tensor, subjects=None):
+        """
+        Add new time points x [len(subjects), new_time_points, components]
+        of the subjects (all subjects by default)
+        """
+        if subjects is None:
+            subjects = torch.arange(self.n_subjects, device=self.device)
+        # RearrangedMLP views the input as [batch_size * time_length, components]
+        x = x.to(self.device, self.dtype).contiguous()
+
+        if self.zscore:
+            x = self.normalize(x, subjects)
+
+        # [len(subjects), new_time_points, n_classes]
+        logits, _ = self.model(x, introspection=True)
+        self.logit_sum[subjects] += logits.sum(1)
+        self.count[subjects] += x.shape[1]
+
+    def normalize(self, x, subjects):
+        """Update the running statistics of the subjects with x, return z-scored x"""
+        n_a = self.count[subjects][:, None]
+        n_b = x.shape[1]
+        mean_b = x.mean(1)
+        m2_b = ((x - mean_b[:, None]) ** 2).sum(1)
+
+        # combination of the statistics of the seen and new time points (Chan et al.)
+        n = n_a + n_b
+        delta = mean_b - self.mean[subjects]
+        mean = self.mean[subjects] + delta * n_b / n
+        m2 = self.m2[subjects] + m2_b + delta**2 * n_a * n_b / n
+        self.mean[subjects], self.m2[subjects] = mean, m2
+
+        # population std, as in scipy.stats.zscore; constant components are zeroed
+        std = torch.sqrt(m2 / n)[:, None]
+        return torch.where(std > 0, (x - mean[:, None]) / std, torch.zeros_like(x))
+
+    def logits(self):
+        """Logits [n_subjects, n_classes] on the time points seen so far"""
+        return self.logit_sum / self.count.clamp(min=1)[:, None]
+
+    def probabilities(self):
+        return torch.softmax(self.logits(), dim=-1)
+
+    def predict(self):
+        """Return the predicted classes [n_subjects] and their probabilities as confidence"""
+        confidence, prediction = self.probabilities().max(dim=-1)
+        return prediction, confidence
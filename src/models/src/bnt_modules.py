@@ -9,6 +9,7 @@ from typing import Tuple, Optional
 from torch.nn.functional import softmax
 from torch.nn import Parameter, TransformerEncoderLayer, functional as F
 from torch import nn, Tensor
+from torch.profiler import record_function
 import torch
 
 from omegaconf import DictConfig
@@ -61,6 +62,13 @@ class LRScheduler:
             param_group["lr"] = self.lr
         self.current_step += 1
 
+    def state_dict(self):
+        return {"current_step": self.current_step, "lr": self.lr}
+
+    def load_state_dict(self, state):
+        self.current_step = state["current_step"]
+        self.lr = state["lr"]
+
 
 class TransPoolingEncoder(nn.Module):
     """
@@ -111,10 +119,12 @@ class TransPoolingEncoder(nn.Module):
         return self.pooling
 
     def forward(self, x):
-        x = self.transformer(x)
-        if self.pooling:
-            x, assignment = self.dec(x)
-            return x, assignment
+        with record_function("BNT.TransPoolingEncoder"):
+            x = self.transformer(x)
+            if self.pooling:
+                with record_function("BNT.DEC"):
+                    x, assignment = self.dec(x)
+                return x, assignment
         return x, None
 
     def get_attention_weights(self):
@@ -174,14 +184,10 @@ class DEC(nn.Module):
         # [batch size, embedding dimension]
         flattened_batch = batch.view(batch_size, -1)
         encoded = self.encoder(flattened_batch)
-        # [batch size * node_num, hidden dimension]
-        encoded = encoded.view(batch_size * node_num, -1)
-        # [batch size * node_num, cluster_number]
-        assignment = self.assignment(encoded)
-        # [batch size, node_num, cluster_number]
-        assignment = assignment.view(batch_size, node_num, -1)
         # [batch size, node_num, hidden dimension]
         encoded = encoded.view(batch_size, node_num, -1)
+        # [batch size, node_num, cluster_number], assigned in a single batched pass
+        assignment = self.assignment(encoded)
         # Multiply the encoded vectors by the cluster assignment to get the final node representations
         # [batch size, cluster_number, hidden dimension]
         node_repr = torch.bmm(assignment.transpose(1, 2), encoded)
@@ -250,26 +256,57 @@ class ClusterAssignment(nn.Module):
             initial_cluster_centers = cluster_centers
 
         if orthogonal:
-            orthogonal_cluster_centers = torch.zeros(
-                self.cluster_number, self.embedding_dimension, dtype=torch.float
-            )
-            orthogonal_cluster_centers[0] = initial_cluster_centers[0]
-            for i in range(1, cluster_number):
-                project = 0
-                for j in range(i):
-                    project += self.project(
-                        initial_cluster_centers[j], initial_cluster_centers[i]
-                    )
-                initial_cluster_centers[i] -= project
-                orthogonal_cluster_centers[i] = initial_cluster_centers[i] / torch.norm(
-                    initial_cluster_centers[i], p=2
-                )
-
-            initial_cluster_centers = orthogonal_cluster_centers
+            initial_cluster_centers = self.orthogonalize(initial_cluster_centers)
 
         self.cluster_centers = Parameter(
             initial_cluster_centers, requires_grad=(not freeze_center)
         )
+        self.freeze_center = freeze_center
+        # centers scaled for the projected assignment, cached while the centers are frozen
+        self._scaled_centers = None
+        self._scaled_centers_key = None
+
+    @staticmethod
+    def orthogonalize(centers: torch.Tensor) -> torch.Tensor:
+        """
+        Gram-Schmidt orthogonalization of the centers (rows) via QR: rows are made orthogonal
+        to the previous ones and normalized, except for the first one, which is kept as is
+        (as in the original BNT implementation). Rows beyond the embedding dimension
+        can't be orthogonal to the previous ones, their residuals are normalized
+        """
+        n = min(centers.shape)
+        q, r = torch.linalg.qr(centers[:n].T)
+        # QR is unique up to the signs of the columns, Gram-Schmidt keeps positive diag(R)
+        signs = torch.sign(torch.diagonal(r))
+        signs[signs == 0] = 1
+        orthogonal = [(q * signs).T]
+        if centers.shape[0] > n:
+            residuals = centers[n:] - (centers[n:] @ q) @ q.T
+            orthogonal.append(residuals / torch.norm(residuals, p=2, dim=1, keepdim=True))
+
+        orthogonal = torch.cat(orthogonal)
+        orthogonal[0] = centers[0]
+        return orthogonal
+
+    def scaled_centers(self) -> torch.Tensor:
+        """
+        Centers divided by the square root of their norms, so that
+        (x @ scaled_centers.T)^2 == (x @ centers.T)^2 / ||centers||
+        """
+        centers = self.cluster_centers
+        # functional_call (e.g. vmapped ensembles) swaps the parameter for plain tensors
+        if not self.freeze_center or not isinstance(centers, Parameter):
+            return centers / torch.norm(centers, p=2, dim=-1, keepdim=True).sqrt()
+
+        # frozen centers only change on load_state_dict or .to(), which bump the version or the storage
+        key = (centers.data_ptr(), centers._version, centers.device, centers.dtype)
+        if self._scaled_centers_key != key:
+            with torch.no_grad():
+                self._scaled_centers = centers / torch.norm(
+                    centers, p=2, dim=-1, keepdim=True
+                ).sqrt()
+            self._scaled_centers_key = key
+        return self._scaled_centers
 
     @staticmethod
     def project(u, v):
@@ -280,27 +317,25 @@ class ClusterAssignment(nn.Module):
         Compute the soft assignment for a batch of feature vectors, returning a batch of assignments
         for each cluster.
 
-        :param batch: FloatTensor of [batch size, embedding dimension]
-        :return: FloatTensor [batch size, number of clusters]
+        :param batch: FloatTensor of [..., embedding dimension], e.g. [batch size, node_num, embedding dimension]
+        :return: FloatTensor [..., number of clusters]
         """
 
         if self.project_assignment:
-            assignment = batch @ self.cluster_centers.T
-            # prove
-            assignment = torch.pow(assignment, 2)
-
-            norm = torch.norm(self.cluster_centers, p=2, dim=-1)
-            soft_assign = assignment / norm
-            return softmax(soft_assign, dim=-1)
-
-        else:
-            norm_squared = torch.sum(
-                (batch.unsqueeze(1) - self.cluster_centers) ** 2, 2
-            )
-            numerator = 1.0 / (1.0 + (norm_squared / self.alpha))
-            power = float(self.alpha + 1) / 2
-            numerator = numerator**power
-            return numerator / torch.sum(numerator, dim=1, keepdim=True)
+            # (batch @ centers.T)^2 / ||centers|| in a single matmul
+            assignment = torch.matmul(batch, self.scaled_centers().T)
+            return softmax(assignment.square(), dim=-1)
+
+        # ||x - c||^2 = ||x||^2 - 2 x @ c.T + ||c||^2 without the [..., clusters, embedding dimension] difference
+        norm_squared = (
+            batch.square().sum(-1, keepdim=True)
+            - 2 * torch.matmul(batch, self.cluster_centers.T)
+            + self.cluster_centers.square().sum(-1)
+        ).clamp_min(0)
+        numerator = 1.0 / (1.0 + (norm_squared / self.alpha))
+        power = float(self.alpha + 1) / 2
+        numerator = numerator**power
+        return numerator / torch.sum(numerator, dim=-1, keepdim=True)
 
     def get_cluster_centers(self) -> torch.Tensor:
         """
@@ -312,6 +347,13 @@ class ClusterAssignment(nn.Module):
 
 
 class InterpretableTransformerEncoder(TransformerEncoderLayer):
+    """
+    TransformerEncoderLayer that can keep its self-attention weights for get_attention_weights().
+    The weights are computed and stored only while capture_attention is True (see
+    BrainNetworkTransformer.set_attention_capture); otherwise the attention runs without
+    materializing them (scaled_dot_product_attention, or the fused encoder layer in inference)
+    """
+
     def __init__(
         self,
         d_model,
@@ -324,6 +366,7 @@ class InterpretableTransformerEncoder(TransformerEncoderLayer):
         norm_first=False,
         device=None,
         dtype=None,
+        capture_attention=False,
     ) -> None:
         super().__init__(
             d_model,
@@ -337,8 +380,30 @@ class InterpretableTransformerEncoder(TransformerEncoderLayer):
             device,
             dtype,
         )
+        self.capture_attention = capture_attention
         self.attention_weights: Optional[Tensor] = None
 
+    def forward(
+        self,
+        src: Tensor,
+        src_mask: Optional[Tensor] = None,
+        src_key_padding_mask: Optional[Tensor] = None,
+        is_causal: bool = False,
+    ) -> Tensor:
+        if not self.capture_attention:
+            return super().forward(src, src_mask, src_key_padding_mask, is_causal)
+
+        # same as TransformerEncoderLayer.forward without its fused fast path,
+        # which doesn't call _sa_block
+        x = src
+        if self.norm_first:
+            x = x + self._sa_block(self.norm1(x), src_mask, src_key_padding_mask, is_causal)
+            x = x + self._ff_block(self.norm2(x))
+        else:
+            x = self.norm1(x + self._sa_block(x, src_mask, src_key_padding_mask, is_causal))
+            x = self.norm2(x + self._ff_block(x))
+        return x
+
     def _sa_block(
         self,
         x: Tensor,
@@ -346,15 +411,17 @@ class InterpretableTransformerEncoder(TransformerEncoderLayer):
         key_padding_mask: Optional[Tensor],
         is_causal: bool = False,
     ) -> Tensor:
+        # without the weights nn.MultiheadAttention uses F.scaled_dot_product_attention
         x, weights = self.self_attn(
             x,
             x,
             x,
             attn_mask=attn_mask,
             key_padding_mask=key_padding_mask,
-            need_weights=True,
+            need_weights=self.capture_attention,
         )
-        self.attention_weights = weights
+        if self.capture_attention:
+            self.attention_weights = weights
         return self.dropout1(x)
 
     def get_attention_weights(self) -> Optional[Tensor]:
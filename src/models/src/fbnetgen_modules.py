@@ -1,19 +1,11 @@
 # pylint: disable=invalid-name, missing-function-docstring, missing-class-docstring, unused-argument, too-few-public-methods, no-member, too-many-arguments, line-too-long, too-many-instance-attributes
 """ FBNetGen model sub-modules from https://github.com/Wayfear/BrainNetworkTransformer"""
 
-import time
-
-import numpy as np
-
 from torch.nn import Conv1d, MaxPool1d, Linear, GRU
 from torch import nn
 import torch
 from omegaconf import DictConfig
 
-from src.trainer import BasicTrainer
-
-from apto.utils.report import get_classification_report
-
 
 class FBNetGenLoss:
     def __init__(self, model_cfg: DictConfig):
@@ -62,62 +54,6 @@ class FBNetGenLoss:
         return 0
 
 
-class FBNetGenTrainer(BasicTrainer):
-    def run_epoch(self, ds_name):
-        """Run single epoch on `ds_name` dataloder"""
-        is_train_dataset = ds_name == "train"
-
-        all_scores, all_targets = [], []
-        total_loss, total_size = 0.0, 0
-
-        self.model.train(is_train_dataset)
-        start_time = time.time()
-
-        with torch.set_grad_enabled(is_train_dataset):
-            for ts_data, fnc, target in self.dataloaders[ds_name]:
-                ts_data, fnc, target = (
-                    ts_data.to(self.device),
-                    fnc.to(self.device),
-                    target.to(self.device),
-                )
-                total_size += ts_data.shape[0]
-
-                logits, learned_matrix = self.model(ts_data, fnc)
-                loss = self.criterion(
-                    logits, learned_matrix, target, self.model, self.device
-                )
-                score = torch.softmax(logits, dim=-1)
-
-                all_scores.append(score.cpu().detach().numpy())
-                all_targets.append(target.cpu().detach().numpy())
-                total_loss += loss.sum().item()
-
-                if is_train_dataset:
-                    self.optimizer.zero_grad()
-                    loss.backward()
-                    self.optimizer.step()
-
-        average_time = (time.time() - start_time) / total_size
-        average_loss = total_loss / total_size
-
-        y_test = np.hstack(all_targets)
-        y_score = np.vstack(all_scores)
-        y_pred = np.argmax(y_score, axis=-1).astype(np.int32)
-
-        report = get_classification_report(
-            y_true=y_test, y_pred=y_pred, y_score=y_score, beta=0.5
-        )
-
-        metrics = {
-            ds_name + "_accuracy": report["precision"].loc["accuracy"],
-            ds_name + "_score": report["auc"].loc["weighted"],
-            ds_name + "_average_loss": average_loss,
-            ds_name + "_average_time": average_time,
-        }
-
-        return metrics
-
-
 class GruKRegion(nn.Module):
     def __init__(self, kernel_size=8, layers=4, out_size=8, dropout=0.5):
         super().__init__()
@@ -217,8 +153,34 @@ class Embed2GraphByProduct(nn.Module):
 
 
 class GNNPredictor(nn.Module):
-    def __init__(self, node_input_dim, roi_num=360, n_classes=2):
+    """
+    Graph network over the learned graph m [batch size, roi_num, roi_num].
+    message_passing sets how the node features are propagated over the graph in each of the 3 rounds:
+        legacy - the original FBNetGen propagation einsum("ijk,ijp->ijp", m, x),
+            which scales the node features by the node degrees (row sums of m)
+        bmm - message passing m @ x
+        topk - m @ x over the top_k strongest edges of each node only (by absolute weight),
+            the neighbour features are gathered instead of multiplying by the dense graph
+    """
+
+    def __init__(
+        self,
+        node_input_dim,
+        roi_num=360,
+        n_classes=2,
+        message_passing="legacy",
+        top_k=None,
+    ):
         super().__init__()
+        if message_passing not in ["legacy", "bmm", "topk"]:
+            raise NotImplementedError(
+                f"Unknown GNNPredictor message_passing '{message_passing}'"
+            )
+        if message_passing == "topk" and top_k is None:
+            raise ValueError("message_passing 'topk' requires top_k")
+        self.message_passing = message_passing
+        self.top_k = top_k
+
         inner_dim = roi_num
         self.roi_num = roi_num
         self.gcn = nn.Sequential(
@@ -249,10 +211,50 @@ class GNNPredictor(nn.Module):
             nn.Linear(32, n_classes),
         )
 
+    def graph(self, m):
+        """Propagation operator of the learned graph, computed once for the 3 rounds of propagate"""
+        if self.message_passing == "legacy":
+            # [batch size, roi_num, 1] node degrees
+            return m.sum(-1, keepdim=True)
+        if self.message_passing == "bmm":
+            return m
+
+        # [batch size, roi_num, k] weights and indices of each node's strongest edges
+        _, index = m.abs().topk(min(self.top_k, m.shape[-1]), dim=-1)
+        weights = m.gather(-1, index)
+        # indices of the neighbours in the [batch size * roi_num, features] node features
+        offsets = torch.arange(m.shape[0], device=m.device).view(-1, 1, 1) * m.shape[1]
+        return weights, index + offsets
+
+    def propagate(self, graph, x):
+        """Propagate the node features x [batch size, roi_num, features] over the graph"""
+        if self.message_passing == "legacy":
+            return graph * x
+        if self.message_passing == "bmm":
+            return torch.bmm(graph, x)
+
+        weights, index = graph
+        bz, roi_num, k = index.shape
+        x_flat = x.reshape(bz * roi_num, -1)
+        if not torch.is_grad_enabled():
+            # inference: block-diagonal [bz * roi_num, bz * roi_num] sparse graph with k edges per row
+            sparse_graph = torch.sparse_csr_tensor(
+                torch.arange(0, bz * roi_num * k + 1, k, device=index.device),
+                index.reshape(-1),
+                weights.reshape(-1),
+                (bz * roi_num, bz * roi_num),
+            )
+            return (sparse_graph @ x_flat).view(bz, roi_num, -1)
+
+        # [batch size, roi_num, k, features], gradients are scattered back to the nodes
+        neighbours = x_flat.index_select(0, index.reshape(-1)).view(bz, roi_num, k, -1)
+        return torch.matmul(weights.unsqueeze(-2), neighbours).squeeze(-2)
+
     def forward(self, m, node_feature):
         bz = m.shape[0]
 
-        x = torch.einsum("ijk,ijp->ijp", m, node_feature)
+        graph = self.graph(m)
+        x = self.propagate(graph, node_feature)
 
         x = self.gcn(x)
 
@@ -260,7 +262,7 @@ class GNNPredictor(nn.Module):
         x = self.bn1(x)
         x = x.reshape((bz, self.roi_num, -1))
 
-        x = torch.einsum("ijk,ijp->ijp", m, x)
+        x = self.propagate(graph, x)
 
         x = self.gcn1(x)
 
@@ -268,7 +270,7 @@ class GNNPredictor(nn.Module):
         x = self.bn2(x)
         x = x.reshape((bz, self.roi_num, -1))
 
-        x = torch.einsum("ijk,ijp->ijp", m, x)
+        x = self.propagate(graph, x)
 
         x = self.gcn2(x)
 
@@ -280,38 +282,31 @@ class GNNPredictor(nn.Module):
 
 
 class Embed2GraphByLinear(nn.Module):
+    """
+    Edge weights relu(fc_cat(relu(fc_out([x_j, x_i])))) of every pair of regions (i, j).
+    fc_out of the concatenated pair is split into the sender and receiver halves of its weight,
+    which are applied to the node embeddings once and broadcast over the pairs,
+    instead of gathering [roi_num^2, 2 * input_dim] pair features with one-hot matrices.
+    roi_num is kept for compatibility, the number of regions is taken from the input
+    """
+
     def __init__(self, input_dim, roi_num=360):
         super().__init__()
 
         self.fc_out = nn.Linear(input_dim * 2, input_dim)
         self.fc_cat = nn.Linear(input_dim, 1)
 
-        def encode_onehot(labels):
-            classes = set(labels)
-            classes_dict = {
-                c: np.identity(len(classes))[i, :] for i, c in enumerate(classes)
-            }
-            labels_onehot = np.array(
-                list(map(classes_dict.get, labels)), dtype=np.int32
-            )
-            return labels_onehot
-
-        off_diag = np.ones([roi_num, roi_num])
-        rel_rec = np.array(encode_onehot(np.where(off_diag)[0]), dtype=np.float32)
-        rel_send = np.array(encode_onehot(np.where(off_diag)[1]), dtype=np.float32)
-        self.rel_rec = torch.FloatTensor(rel_rec).cuda()
-        self.rel_send = torch.FloatTensor(rel_send).cuda()
-
     def forward(self, x):
-        batch_sz, region_num, _ = x.shape
-        receivers = torch.matmul(self.rel_rec, x)
-
-        senders = torch.matmul(self.rel_send, x)
-        x = torch.cat([senders, receivers], dim=2)
-        x = torch.relu(self.fc_out(x))
+        # [input_dim, input_dim] halves of fc_out applied to the senders (j) and receivers (i)
+        weight_send, weight_rec = self.fc_out.weight.chunk(2, dim=1)
+        # [batch_sz, region_num, input_dim]
+        senders = torch.matmul(x, weight_send.T)
+        receivers = nn.functional.linear(x, weight_rec, self.fc_out.bias)
+
+        # [batch_sz, region_num (i), region_num (j), input_dim]
+        x = torch.relu(receivers.unsqueeze(2) + senders.unsqueeze(1))
         x = self.fc_cat(x)
 
-        x = torch.relu(x)
-
-        m = torch.reshape(x, (batch_sz, region_num, region_num, -1))
+        # [batch_sz, region_num, region_num, 1]
+        m = torch.relu(x)
         return m
@@ -0,0 +1,433 @@
+# pylint: disable=import-outside-toplevel
+"""Low-overhead timing and memory instrumentation, torch.profiler capture of the training loop"""
+import functools
+import gc
+import json
+import os
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+
+import torch
+from omegaconf import DictConfig
+
+
+class StepTimer:
+    """
+    Accumulates the wall time spent in named stages of the training loop.
+    If the device is CUDA, the device is synchronized at stage boundaries,
+    so the asynchronous kernels are attributed to the stage that launched them.
+    When disabled, `stage` returns a no-op context and `iterate` returns the iterable as is.
+    """
+
+    def __init__(self, enabled: bool, device: torch.device):
+        self.enabled = enabled
+        self.synchronize = enabled and device.type == "cuda"
+        self.device = device
+        self.totals = {}
+        self.noop = nullcontext()
+
+    def now(self):
+        if self.synchronize:
+            torch.cuda.synchronize(self.device)
+        return time.perf_counter()
+
+    def stage(self, name):
+        """Context manager adding its wall time to the `name` stage"""
+        if not self.enabled:
+            return self.noop
+        return self.timed(name)
+
+    @contextmanager
+    def timed(self, name):
+        start = self.now()
+        try:
+            yield
+        finally:
+            self.totals[name] = self.totals.get(name, 0.0) + self.now() - start
+
+    def iterate(self, iterable, name="fetch"):
+        """Iterate over `iterable` adding the time spent in `next` to the `name` stage"""
+        if not self.enabled:
+            return iterable
+        return self.timed_iterate(iterable, name)
+
+    def timed_iterate(self, iterable, name):
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name):
+                item = next(iterator, StopIteration)
+            if item is StopIteration:
+                return
+            yield item
+
+    def reset(self):
+        self.totals = {}
+
+    def collect(self, prefix):
+        """Return {'{prefix}_time_{stage}': seconds} and reset the counters"""
+        results = {f"{prefix}_time_{name}": value for name, value in self.totals.items()}
+        self.reset()
+        return results
+
+
+def current_rss():
+    """Resident set size of the process in bytes, None if it can't be measured"""
+    try:
+        with open("/proc/self/statm", "r", encoding="utf8") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        import psutil
+    except ImportError:
+        return None
+    return psutil.Process().memory_info().rss
+
+
+class PeakMemory:
+    """
+    Context manager measuring the peak memory used by the enclosed code, results are in
+    `self.results` after exit (MB):
+        python_peak_mb - peak of the Python heap allocations traced by tracemalloc
+            (numpy arrays are traced, torch tensors are not)
+        rss_peak_mb - peak resident set size of the process, sampled every `interval` seconds
+            by a background thread
+        rss_increase_mb - rss_peak_mb minus the RSS at entry
+    tracemalloc slows down Python allocations, so don't time the code measured with trace_python=True.
+    """
+
+    def __init__(
+        self, interval: float = 0.001, trace_python: bool = True, trace_frames: int = 1
+    ):
+        self.interval = interval
+        self.trace_python = trace_python
+        self.trace_frames = trace_frames
+        self.results = {}
+
+    def __enter__(self):
+        self.start_rss = current_rss()
+        self.peak_rss = self.start_rss
+        self.stop_sampling = threading.Event()
+        if self.start_rss is not None:
+            self.sampler = threading.Thread(target=self.sample, daemon=True)
+            self.sampler.start()
+
+        if self.trace_python:
+            self.started_tracing = not tracemalloc.is_tracing()
+            if self.started_tracing:
+                tracemalloc.start(self.trace_frames)
+            tracemalloc.reset_peak()
+            self.start_traced = tracemalloc.get_traced_memory()[0]
+        return self
+
+    def sample(self):
+        while not self.stop_sampling.wait(self.interval):
+            self.peak_rss = max(self.peak_rss, current_rss())
+
+    def __exit__(self, *exc_info):
+        mb = 1024**2
+        if self.trace_python:
+            self.results["python_peak_mb"] = (
+                tracemalloc.get_traced_memory()[1] - self.start_traced
+            ) / mb
+            if self.started_tracing:
+                tracemalloc.stop()
+
+        if self.start_rss is not None:
+            self.stop_sampling.set()
+            self.sampler.join()
+            self.peak_rss = max(self.peak_rss, current_rss())
+            self.results["rss_peak_mb"] = self.peak_rss / mb
+            self.results["rss_increase_mb"] = (self.peak_rss - self.start_rss) / mb
+
+
+def tensor_storage_mb():
+    """Total size of the alive tensor storages by device type (MB)"""
+    storages = {}
+    for obj in gc.get_objects():
+        if isinstance(obj, torch.Tensor):
+            try:
+                storage = obj.untyped_storage()
+            except RuntimeError:
+                # tensors without storage, e.g. sparse or meta tensors
+                continue
+            storages[(storage.device.type, storage.data_ptr())] = storage.nbytes()
+
+    totals = {}
+    for (device_type, _), nbytes in storages.items():
+        totals[device_type] = totals.get(device_type, 0) + nbytes / 1024**2
+    return totals
+
+
+# the latest record of each stage, see MemoryAccount
+MEMORY_RECORDS = {}
+
+
+class MemoryAccount:
+    """
+    Context manager recording the memory used by a stage of the experiment
+    if cfg.memory_accounting is True:
+        rss_{before,peak,after}_mb, rss_increase_mb - RSS of the process, see PeakMemory
+        python_peak_mb - peak of the Python heap allocations (numpy arrays included)
+        tensors_{device}_mb - total size of the alive tensor storages after the stage
+        cuda_peak_mb - peak of the CUDA memory allocated by torch, if CUDA is available
+        peak_allocations - the biggest allocations made by the stage at (nearly) its peak:
+            the traced allocations are snapshotted each time they grow by 10% over the last snapshot
+        retained_allocations - the biggest allocations made by the stage and still alive after it
+    Allocations are listed with the innermost line of the project's code that made them.
+    Records are appended to '{cfg.project_dir}/memory.jsonl' and kept in MEMORY_RECORDS,
+    so the trainer can save them with the run (see write_memory_records).
+    tracemalloc slows down Python allocations by orders of magnitude, so the stages
+    with trace=False (e.g. the training loop) record only the RSS, tensor and CUDA figures
+    """
+
+    def __init__(self, cfg: DictConfig, stage: str, top_n: int = 10, trace: bool = True):
+        self.cfg = cfg
+        self.stage = stage
+        self.top_n = top_n
+        self.trace = trace
+        self.enabled = "memory_accounting" in cfg and cfg.memory_accounting
+
+    def __enter__(self):
+        if not self.enabled:
+            return self
+
+        if torch.cuda.is_available():
+            torch.cuda.reset_peak_memory_stats()
+        gc.collect()
+        if not self.trace:
+            # RSS sampling competes with the stage for the GIL, sample it less often
+            self.peak_memory = PeakMemory(interval=0.01, trace_python=False).__enter__()
+            return self
+
+        self.peak_memory = PeakMemory(trace_frames=25).__enter__()
+        self.snapshot = tracemalloc.take_snapshot()
+
+        self.peak_snapshot = None
+        self.peak_traced = tracemalloc.get_traced_memory()[0]
+        self.stop_watching = threading.Event()
+        self.watcher = threading.Thread(target=self.watch_peak, daemon=True)
+        self.watcher.start()
+        return self
+
+    def watch_peak(self):
+        while not self.stop_watching.wait(0.01):
+            traced = tracemalloc.get_traced_memory()[0]
+            if traced > 1.1 * self.peak_traced + 1024**2:
+                self.peak_snapshot = tracemalloc.take_snapshot()
+                self.peak_traced = traced
+
+    def __exit__(self, *exc_info):
+        if not self.enabled:
+            return
+
+        if self.trace:
+            self.stop_watching.set()
+            self.watcher.join()
+            snapshot = tracemalloc.take_snapshot()
+        self.peak_memory.__exit__(*exc_info)
+        mb = 1024**2
+
+        record = {"stage": self.stage}
+        if "run_ids" in self.cfg:
+            record.update(self.cfg.run_ids)
+        record.update(
+            {
+                "rss_before_mb": self.peak_memory.start_rss / mb
+                if self.peak_memory.start_rss is not None
+                else None,
+                "rss_after_mb": (current_rss() or 0) / mb,
+                **self.peak_memory.results,
+            }
+        )
+        for device_type, total in tensor_storage_mb().items():
+            record[f"tensors_{device_type}_mb"] = total
+        if torch.cuda.is_available():
+            record["cuda_peak_mb"] = torch.cuda.max_memory_allocated() / mb
+
+        if self.trace:
+            record["peak_allocations"] = self.top_allocations(
+                self.peak_snapshot or snapshot
+            )
+            record["retained_allocations"] = self.top_allocations(snapshot)
+
+        MEMORY_RECORDS[self.stage] = record
+        os.makedirs(self.cfg.project_dir, exist_ok=True)
+        with open(f"{self.cfg.project_dir}/memory.jsonl", "a", encoding="utf8") as f:
+            f.write(json.dumps(record) + "\n")
+
+        print(
+            f"Memory of '{self.stage}': RSS peak {record.get('rss_peak_mb', 0):.1f} MB "
+            f"(+{record.get('rss_increase_mb', 0):.1f} MB)"
+        )
+
+    def top_allocations(self, snapshot, min_size=0.1):
+        """Format the biggest (>= min_size MB) allocations made since the stage started"""
+        project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        # allocations of the accounting itself
+        own = tracemalloc.Filter(False, __file__)
+        stats = snapshot.filter_traces([own]).compare_to(
+            self.snapshot.filter_traces([own]), "traceback"
+        )
+        stats = [stat for stat in stats if stat.size_diff >= min_size * 1024**2]
+
+        allocations = []
+        for stat in stats[: self.top_n]:
+            # frames are sorted from the oldest to the most recent one
+            allocating = stat.traceback[-1]
+            project_frames = [
+                frame
+                for frame in stat.traceback
+                if frame.filename.startswith(project_root) and frame.filename != __file__
+            ]
+            line = f"+{stat.size_diff / 1024**2:.1f} MB"
+            if project_frames:
+                caller = project_frames[-1]
+                line += f" {os.path.relpath(caller.filename, project_root)}:{caller.lineno}"
+            line += f" (allocated in {allocating.filename}:{allocating.lineno})"
+            allocations.append(line)
+        return allocations
+
+
+def account_memory(stage: str):
+    """Decorator wrapping a function with cfg as its first argument in MemoryAccount"""
+
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(cfg, *args, **kwargs):
+            with MemoryAccount(cfg, stage):
+                return function(cfg, *args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def write_memory_records(cfg: DictConfig, logger):
+    """Save the latest record of each stage to '{cfg.run_dir}/memory.json' and the run summary"""
+    if not MEMORY_RECORDS:
+        return
+
+    with open(f"{cfg.run_dir}/memory.json", "w", encoding="utf8") as f:
+        json.dump(list(MEMORY_RECORDS.values()), f, indent=2)
+
+    for stage, record in MEMORY_RECORDS.items():
+        for key in ["rss_peak_mb", "rss_increase_mb", "python_peak_mb", "cuda_peak_mb"]:
+            if key in record:
+                logger.summary[f"memory_{stage}_{key}"] = record[key]
+
+
+def profiler_factory(cfg: DictConfig):
+    """
+    Return TorchProfiler if cfg.profiler.enabled is True and the current run
+    (cfg.run_ids, see src.utils.set_run_name) is selected in cfg.profiler.runs,
+    otherwise DummyProfiler.
+    Must be called after src.utils.set_run_name
+    """
+    if "profiler" not in cfg or cfg.profiler is None or not cfg.profiler.enabled:
+        return DummyProfiler()
+
+    for key, selected in cfg.profiler.runs.items():
+        # run ids that don't apply in the current mode (e.g. inner_k in exp mode) are None
+        run_id = cfg.run_ids[key]
+        if selected is not None and run_id is not None and run_id not in selected:
+            return DummyProfiler()
+
+    return TorchProfiler(cfg.profiler, f"{cfg.run_dir}/profiler")
+
+
+# True while a TorchProfiler is recording, see profiler_active
+_PROFILER_ACTIVE = False
+
+
+def profiler_active():
+    """
+    Whether a TorchProfiler is recording: models add their profiler ranges only then,
+    so the runs without profiling don't pay for them
+    """
+    return _PROFILER_ACTIVE
+
+
+class DummyProfiler:
+    """Profiler that profiles nothing"""
+
+    def start_epoch(self, epoch):
+        pass
+
+    def step(self):
+        pass
+
+    def stop(self):
+        pass
+
+
+class TorchProfiler:
+    """
+    torch.profiler.profile running during the selected epochs of a run.
+    Every batch (train, valid) is a profiler step; the steps are scheduled with
+    torch.profiler.schedule(wait, warmup, active, repeat).
+    Each finished cycle is saved to `path` as a Chrome trace (trace_{step}.json,
+    open in chrome://tracing or https://ui.perfetto.dev) and a table of the operators
+    sorted by their self time (ops_{step}.txt).
+    """
+
+    def __init__(self, profiler_cfg: DictConfig, path: str):
+        self.epochs = set(profiler_cfg.epochs)
+        self.path = path
+        os.makedirs(self.path, exist_ok=True)
+
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.sort_by = "self_cuda_time_total"
+        else:
+            self.sort_by = "self_cpu_time_total"
+        self.row_limit = profiler_cfg.row_limit
+
+        self.profiler = torch.profiler.profile(
+            activities=activities,
+            schedule=torch.profiler.schedule(
+                wait=profiler_cfg.schedule.wait,
+                warmup=profiler_cfg.schedule.warmup,
+                active=profiler_cfg.schedule.active,
+                repeat=profiler_cfg.schedule.repeat,
+            ),
+            on_trace_ready=self.save,
+            record_shapes=profiler_cfg.record_shapes,
+            profile_memory=profiler_cfg.profile_memory,
+            with_stack=profiler_cfg.with_stack,
+        )
+        self.running = False
+
+    def start_epoch(self, epoch):
+        """Start or stop profiling depending on whether the epoch is selected"""
+        global _PROFILER_ACTIVE  # pylint: disable=global-statement
+        if epoch in self.epochs and not self.running:
+            print(f"Profiling epoch {epoch}")
+            self.profiler.start()
+            self.running = True
+            _PROFILER_ACTIVE = True
+        elif epoch not in self.epochs and self.running:
+            self.stop()
+
+    def step(self):
+        if self.running:
+            self.profiler.step()
+
+    def stop(self):
+        global _PROFILER_ACTIVE  # pylint: disable=global-statement
+        if self.running:
+            self.profiler.stop()
+            self.running = False
+            _PROFILER_ACTIVE = False
+
+    def save(self, prof):
+        prof.export_chrome_trace(f"{self.path}/trace_{prof.step_num:05d}.json")
+        table = prof.key_averages(group_by_input_shape=False).table(
+            sort_by=self.sort_by, row_limit=self.row_limit
+        )
+        with open(f"{self.path}/ops_{prof.step_num:05d}.txt", "w", encoding="utf8") as f:
+            f.write(table)
+        print(f"Profiler traces are saved in '{self.path}'")
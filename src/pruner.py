@@ -0,0 +1,150 @@
+# pylint: disable=invalid-name, too-many-instance-attributes
+"""Asynchronous successive halving (ASHA) pruning of tuning trials"""
+import math
+import os
+
+import pandas as pd
+from omegaconf import DictConfig
+
+
+class TrialPruned(Exception):
+    """Raised when the pruner decides to stop the current trial"""
+
+
+def pruner_factory(cfg: DictConfig):
+    """
+    Return ASHAPruner if cfg.mode.pruner.enabled is True, otherwise DummyPruner.
+    Must be called after src.utils.set_run_name, the rungs are stored in cfg.k_dir
+    """
+    if (
+        cfg.mode.name == "tune"
+        and "pruner" in cfg.mode
+        and cfg.mode.pruner is not None
+        and cfg.mode.pruner.enabled
+    ):
+        return ASHAPruner(cfg.mode.pruner, f"{cfg.k_dir}/rungs.csv")
+
+    return DummyPruner()
+
+
+class DummyPruner:
+    """Pruner that never prunes"""
+
+    def report_epoch(self, trial, inner_k, epoch, results):
+        return False
+
+    def report_fold(self, trial, inner_k, cv_results):
+        return False
+
+    def restore(self, trial, inner_k, train_results):
+        pass
+
+
+class ASHAPruner:
+    """
+    Asynchronous successive halving (Li et al., 2020, https://arxiv.org/abs/1810.05934).
+
+    A trial is compared against all previously seen trials at rungs:
+    - epoch rungs: the best `metric` value of inner fold `inner_k` after
+        min_epochs * reduction_factor ** i epochs;
+    - fold rungs: the mean `metric` counterpart on the inner test fold
+        (e.g. `test_average_loss` for `valid_average_loss`) after each finished inner fold.
+    A trial survives a rung only if its value is in the top 1/reduction_factor
+    of all the values recorded at this rung. Decisions are made with whatever
+    trials have reached the rung so far, so the pruner never waits for other trials.
+
+    The rung values are appended to `path`, so the pruner state survives interruptions
+    and can be shared by several workers tuning the same fold.
+    """
+
+    def __init__(self, pruner_cfg: DictConfig, path: str):
+        self.metric = pruner_cfg.metric
+        assert self.metric in [
+            "valid_average_loss",
+            "valid_score",
+        ], f"Unsupported pruner metric '{self.metric}'"
+        self.fold_metric = self.metric.replace("valid_", "test_", 1)
+        self.minimize = self.metric.endswith("loss")
+
+        self.min_epochs = pruner_cfg.min_epochs
+        self.reduction_factor = pruner_cfg.reduction_factor
+        self.min_trials = pruner_cfg.min_trials
+        self.prune_folds = pruner_cfg.prune_folds
+
+        self.path = path
+        # {rung: {trial: value}}
+        self.rungs = {}
+        if os.path.exists(self.path):
+            df = pd.read_csv(self.path)
+            for trial, rung, value in zip(df["trial"], df["rung"], df["value"]):
+                self.rungs.setdefault(rung, {})[int(trial)] = float(value)
+
+        self.best_values = {}
+
+    def is_epoch_rung(self, epoch):
+        """Check if the (0-based) epoch closes a rung"""
+        budget = (epoch + 1) / self.min_epochs
+        if budget < 1:
+            return False
+        power = math.log(budget, self.reduction_factor)
+        return abs(power - round(power)) < 1e-9
+
+    def report_epoch(self, trial, inner_k, epoch, results):
+        """Track the best metric value of the run, return True if the trial should be pruned"""
+        value = results[self.metric]
+        best = self.best_values.get((trial, inner_k))
+        if best is None or (value < best if self.minimize else value > best):
+            best = value
+        self.best_values[(trial, inner_k)] = best
+
+        if not self.is_epoch_rung(epoch):
+            return False
+
+        return self.report(
+            trial, f"k_{inner_k:02d}-epoch_{epoch + 1:04d}", best, self.metric
+        )
+
+    def restore(self, trial, inner_k, train_results):
+        """Restore the best metric value of a resumed run from its train log so far"""
+        values = [results[self.metric] for results in train_results]
+        if len(values) > 0:
+            self.best_values[(trial, inner_k)] = min(values) if self.minimize else max(values)
+
+    def report_fold(self, trial, inner_k, cv_results):
+        """
+        Report the results of the trial's inner folds finished so far,
+        return True if the trial should be pruned
+        """
+        if not self.prune_folds:
+            return False
+
+        value = float(pd.DataFrame(cv_results)[self.fold_metric].mean())
+        return self.report(trial, f"folds_{inner_k + 1:02d}", value, self.fold_metric)
+
+    def report(self, trial, rung, value, metric):
+        """Record the value at the rung and decide whether the trial is promoted"""
+        values = self.rungs.setdefault(rung, {})
+        values[trial] = value
+
+        df = pd.DataFrame({"trial": trial, "rung": rung, "value": value}, index=[0])
+        with open(self.path, "a", encoding="utf8") as f:
+            df.to_csv(f, header=f.tell() == 0, index=False)
+
+        if len(values) < self.min_trials:
+            return False
+
+        ranked = sorted(values.values(), reverse=not self.minimize)
+        n_promoted = max(1, len(ranked) // self.reduction_factor)
+        threshold = ranked[n_promoted - 1]
+
+        if self.minimize:
+            prune = value > threshold
+        else:
+            prune = value < threshold
+
+        if prune:
+            print(
+                f"Pruning trial {trial:04d} at rung '{rung}': "
+                f"{metric} {value:.4f} is not in the top {n_promoted}/{len(ranked)}"
+            )
+        return prune
@@ -0,0 +1,373 @@
+# pylint: disable=invalid-name, too-many-arguments
+"""Storage of the experiments' results: CSV files or a single SQLite database per project"""
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import pandas as pd
+from omegaconf import OmegaConf, DictConfig
+
+_STORES = {}
+
+
+def results_store_factory(cfg: DictConfig):
+    """
+    Return the results store of the project.
+    If cfg.results_store is True, results are kept in '{cfg.project_dir}/results.sqlite',
+    otherwise they are appended to CSV files in the run directories.
+    Stores are cached, so all the callers in a process share one connection.
+    """
+    if "results_store" in cfg and cfg.results_store:
+        path = f"{cfg.project_dir}/results.sqlite"
+        if path not in _STORES:
+            os.makedirs(cfg.project_dir, exist_ok=True)
+            _STORES[path] = SQLiteResultsStore(path)
+        return _STORES[path]
+
+    return CSVResultsStore()
+
+
+def _key(index):
+    """None indices (e.g. outer_k with tuning_holdout) are stored as -1"""
+    return -1 if index is None else int(index)
+
+
+def to_json(data):
+    """JSON of results with numpy/torch scalars (and anything else non-serializable as str)"""
+    return json.dumps(
+        data, default=lambda value: value.item() if hasattr(value, "item") else str(value)
+    )
+
+
+def _append_csv(df, path):
+    with open(path, "a", encoding="utf8") as f:
+        df.to_csv(f, header=f.tell() == 0, index=False)
+
+
+class CSVResultsStore:
+    """
+    Default results store: every result is appended to a CSV file
+    - tune mode: '{trial_dir}/CV_runs.csv' and '{k_dir}/trial_runs.csv'
+    - exp mode: '{k_dir}/fold_runs.csv' and '{project_dir}/runs.csv'
+    - every run: '{run_dir}/train_log.csv' and '{run_dir}/test_log.csv'
+    Methods expect cfg with the run names set by src.utils.set_run_name
+    """
+
+    def add_run(self, cfg, results):
+        df = pd.DataFrame(results, index=[0])
+        if cfg.mode.name == "tune":
+            _append_csv(df, f"{cfg.trial_dir}/CV_runs.csv")
+        else:
+            _append_csv(df, f"{cfg.k_dir}/fold_runs.csv")
+
+    def cv_runs(self, cfg):
+        path = f"{cfg.trial_dir}/CV_runs.csv"
+        if not os.path.exists(path):
+            return pd.DataFrame()
+        return pd.read_csv(path)
+
+    def add_trial(self, cfg, trial_results):
+        _append_csv(pd.DataFrame(trial_results, index=[0]), f"{cfg.k_dir}/trial_runs.csv")
+
+    def trial_runs(self, cfg):
+        path = f"{cfg.k_dir}/trial_runs.csv"
+        if not os.path.exists(path):
+            return pd.DataFrame()
+        return pd.read_csv(path)
+
+    def fold_runs(self, cfg):
+        return pd.read_csv(f"{cfg.k_dir}/fold_runs.csv")
+
+    def add_fold(self, cfg):
+        _append_csv(self.fold_runs(cfg), f"{cfg.project_dir}/runs.csv")
+
+    def add_epochs(self, cfg, train_results):
+        train_results.to_csv(f"{cfg.run_dir}/train_log.csv", index=False)
+
+    def add_test(self, cfg, test_results):
+        pd.DataFrame(test_results, index=[0]).to_csv(
+            f"{cfg.run_dir}/test_log.csv", index=False
+        )
+
+    def add_config(self, path, config):
+        with open(path, "w", encoding="utf8") as f:
+            OmegaConf.save(config, f)
+
+    def load_config(self, path):
+        return OmegaConf.load(path)
+
+    def has_config(self, path):
+        return os.path.exists(path)
+
+    def export(self, cfg):
+        """CSV files are written as the results come"""
+
+
+class SQLiteResultsStore:
+    """
+    Results store backed by a single SQLite database (stdlib sqlite3, WAL journal).
+
+    Tables:
+    - runs: test results of every run (tune mode inner folds, exp mode trials)
+    - epochs: per-epoch train/valid metrics of every run (train_log.csv)
+    - trials: summaries of tuning trials (trial_runs.csv)
+    - configs: YAML configs, keyed by the path they would have been saved to
+
+    Every write is a short 'BEGIN IMMEDIATE' transaction, so several worker processes can
+    write to the same project; readers are never blocked by the writer in WAL mode.
+    Note that WAL needs shared memory, so all workers must run on the same host
+    (the database itself can live on NFS if it is not shared across hosts).
+
+    CSV files with the usual layouts (trial_runs.csv, CV_runs.csv, fold_runs.csv, runs.csv,
+    and train_log.csv, test_log.csv of every run) are exported by `export`
+    at the end of each tuning/experiment fold.
+    Configs are kept in the database only; `export` saves the trial (tune mode) and fold
+    (exp mode) model configs, and config.yaml and model_config.yaml of the runs
+    with a preserved checkpoint, so they can be loaded by src.inference
+    """
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS runs (
+        mode TEXT NOT NULL,
+        outer_k INTEGER NOT NULL,
+        trial INTEGER NOT NULL,
+        inner_k INTEGER NOT NULL,
+        run_dir TEXT NOT NULL,
+        results TEXT NOT NULL,
+        created REAL NOT NULL,
+        PRIMARY KEY (mode, outer_k, trial, inner_k)
+    );
+    CREATE TABLE IF NOT EXISTS epochs (
+        run_dir TEXT NOT NULL,
+        epoch INTEGER NOT NULL,
+        results TEXT NOT NULL,
+        PRIMARY KEY (run_dir, epoch)
+    );
+    CREATE TABLE IF NOT EXISTS trials (
+        outer_k INTEGER NOT NULL,
+        trial INTEGER NOT NULL,
+        score REAL,
+        loss REAL,
+        time REAL,
+        pruned INTEGER NOT NULL DEFAULT 0,
+        path_to_config TEXT,
+        PRIMARY KEY (outer_k, trial)
+    );
+    CREATE TABLE IF NOT EXISTS configs (
+        path TEXT PRIMARY KEY,
+        config TEXT NOT NULL
+    );
+    CREATE VIEW IF NOT EXISTS trial_runs AS
+        SELECT outer_k, trial, score, loss, time, pruned, path_to_config
+        FROM trials ORDER BY outer_k, trial;
+    """
+
+    def __init__(self, path, timeout=60.0):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(
+            path, timeout=timeout, isolation_level=None, check_same_thread=False
+        )
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(self.SCHEMA)
+
+    def write(self, query, rows):
+        """Run an INSERT query for the rows in a single transaction"""
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                self.conn.executemany(query, rows)
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.conn.execute("COMMIT")
+
+    def read(self, query, params=()):
+        with self.lock:
+            return self.conn.execute(query, params).fetchall()
+
+    @staticmethod
+    def results_frame(rows):
+        return pd.DataFrame([json.loads(row[0]) for row in rows])
+
+    def add_run(self, cfg, results):
+        inner_k = cfg.run_ids.inner_k if cfg.mode.name == "tune" else None
+        self.write(
+            "INSERT OR REPLACE INTO runs VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [
+                (
+                    cfg.mode.name,
+                    _key(cfg.run_ids.outer_k),
+                    _key(cfg.run_ids.trial),
+                    _key(inner_k),
+                    cfg.run_dir,
+                    to_json(results),
+                    time.time(),
+                )
+            ],
+        )
+
+    def cv_runs(self, cfg, outer_k=None, trial=None):
+        if cfg is not None:
+            outer_k, trial = cfg.run_ids.outer_k, cfg.run_ids.trial
+        rows = self.read(
+            "SELECT results FROM runs WHERE mode = 'tune' AND outer_k = ? AND trial = ? "
+            "ORDER BY inner_k",
+            (_key(outer_k), _key(trial)),
+        )
+        return self.results_frame(rows)
+
+    def add_trial(self, cfg, trial_results):
+        self.write(
+            "INSERT OR REPLACE INTO trials VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [
+                (
+                    _key(cfg.run_ids.outer_k),
+                    _key(trial_results["trial"]),
+                    trial_results["score"],
+                    trial_results["loss"],
+                    trial_results["time"],
+                    int(trial_results["pruned"]),
+                    trial_results["path_to_config"],
+                )
+            ],
+        )
+
+    def trial_runs(self, cfg, outer_k=None):
+        if cfg is not None:
+            outer_k = cfg.run_ids.outer_k
+        rows = self.read(
+            "SELECT trial, score, loss, time, pruned, path_to_config FROM trials "
+            "WHERE outer_k = ? ORDER BY trial",
+            (_key(outer_k),),
+        )
+        df = pd.DataFrame(
+            rows, columns=["trial", "score", "loss", "time", "pruned", "path_to_config"]
+        )
+        df["pruned"] = df["pruned"].astype(bool)
+        return df
+
+    def fold_runs(self, cfg, outer_k=None):
+        if cfg is not None:
+            outer_k = cfg.run_ids.outer_k
+        rows = self.read(
+            "SELECT results FROM runs WHERE mode = 'exp' AND outer_k = ? ORDER BY trial",
+            (_key(outer_k),),
+        )
+        return self.results_frame(rows)
+
+    def runs(self):
+        rows = self.read(
+            "SELECT results FROM runs WHERE mode = 'exp' ORDER BY outer_k, trial"
+        )
+        return self.results_frame(rows)
+
+    def add_fold(self, cfg):
+        """runs.csv is exported from the runs table"""
+        self.export(cfg)
+
+    def add_epochs(self, cfg, train_results):
+        self.write(
+            "INSERT OR REPLACE INTO epochs VALUES (?, ?, ?)",
+            [
+                (cfg.run_dir, int(row["epoch"]), to_json(row))
+                for row in train_results.to_dict("records")
+            ],
+        )
+
+    def train_log(self, run_dir):
+        rows = self.read(
+            "SELECT results FROM epochs WHERE run_dir = ? ORDER BY epoch", (run_dir,)
+        )
+        return self.results_frame(rows)
+
+    def add_test(self, cfg, test_results):
+        """Test results are the run results, they are stored by add_run"""
+
+    def add_config(self, path, config):
+        self.write(
+            "INSERT OR REPLACE INTO configs VALUES (?, ?)",
+            [(str(path), OmegaConf.to_yaml(config))],
+        )
+
+    def load_config(self, path):
+        rows = self.read("SELECT config FROM configs WHERE path = ?", (str(path),))
+        if len(rows) == 0:
+            return OmegaConf.load(path)
+        return OmegaConf.create(rows[0][0])
+
+    def has_config(self, path):
+        rows = self.read("SELECT 1 FROM configs WHERE path = ?", (str(path),))
+        return len(rows) > 0 or os.path.exists(path)
+
+    def last_outer_k(self, mode):
+        """Return the largest outer_k with recorded results, or None"""
+        if mode == "tune":
+            rows = self.read(
+                "SELECT MAX(outer_k) FROM (SELECT outer_k FROM trials "
+                "UNION SELECT outer_k FROM runs WHERE mode = 'tune')"
+            )
+        else:
+            rows = self.read("SELECT MAX(outer_k) FROM runs WHERE mode = ?", (mode,))
+        return rows[0][0]
+
+    def export_runs(self, k_dir):
+        """
+        Write train_log.csv and test_log.csv of the runs in k_dir from the database,
+        and the configs of the runs with a preserved checkpoint (best_model.pt)
+        """
+        prefix = f"{k_dir}/"
+        # pruned runs have no test results, but have their train logs
+        run_dirs = self.read(
+            "SELECT DISTINCT run_dir FROM epochs WHERE substr(run_dir, 1, ?) = ?",
+            (len(prefix), prefix),
+        )
+        for (run_dir,) in run_dirs:
+            if os.path.exists(run_dir):
+                self.train_log(run_dir).to_csv(f"{run_dir}/train_log.csv", index=False)
+
+        rows = self.read(
+            "SELECT run_dir, results FROM runs WHERE substr(run_dir, 1, ?) = ?",
+            (len(prefix), prefix),
+        )
+        for run_dir, results in rows:
+            if not os.path.exists(run_dir):
+                continue
+            pd.DataFrame(json.loads(results), index=[0]).to_csv(
+                f"{run_dir}/test_log.csv", index=False
+            )
+            if os.path.exists(f"{run_dir}/best_model.pt"):
+                for name in ["config.yaml", "model_config.yaml"]:
+                    self.export_config(f"{run_dir}/{name}")
+
+    def export_config(self, path):
+        """Write the config saved under `path` to the file, if its directory exists"""
+        rows = self.read("SELECT config FROM configs WHERE path = ?", (str(path),))
+        if len(rows) > 0 and os.path.isdir(os.path.dirname(path)):
+            with open(path, "w", encoding="utf8") as f:
+                f.write(rows[0][0])
+
+    def export(self, cfg):
+        """
+        Write the CSV layouts of the current fold and the project from the database,
+        and the model configs of the fold's trials (tune mode) or of the fold (exp mode)
+        """
+        self.export_runs(cfg.k_dir)
+        if cfg.mode.name == "tune":
+            df = self.trial_runs(cfg)
+            df.to_csv(f"{cfg.k_dir}/trial_runs.csv", index=False)
+            for trial in df["trial"]:
+                trial_dir = f"{cfg.k_dir}/trial_{trial:04d}"
+                cv_runs = self.cv_runs(None, outer_k=cfg.run_ids.outer_k, trial=trial)
+                if os.path.exists(trial_dir) and len(cv_runs) > 0:
+                    cv_runs.to_csv(f"{trial_dir}/CV_runs.csv", index=False)
+            # trial_runs.csv refers to the trial configs
+            for path in df["path_to_config"]:
+                self.export_config(path)
+        else:
+            self.export_config(f"{cfg.k_dir}/model_config.yaml")
+            self.fold_runs(cfg).to_csv(f"{cfg.k_dir}/fold_runs.csv", index=False)
+            self.runs().to_csv(f"{cfg.project_dir}/runs.csv", index=False)
@@ -0,0 +1,265 @@
+# pylint: disable=invalid-name, too-few-public-methods, too-many-locals
+"""Hyperparameter search spaces and samplers used in tune mode"""
+import math
+import random
+from copy import deepcopy
+
+import numpy as np
+from omegaconf import OmegaConf, DictConfig
+
+from src.results_store import results_store_factory
+
+
+class Distribution:
+    """Base class of the search space distributions"""
+
+    def sample(self):
+        raise NotImplementedError
+
+
+class Uniform(Distribution):
+    """Float from [low, high], uniform on log scale if log is True"""
+
+    def __init__(self, low, high, log=False):
+        assert low < high
+        if log:
+            assert low > 0
+        self.low = low
+        self.high = high
+        self.log = log
+
+    def sample(self):
+        if self.log:
+            return 10 ** random.uniform(math.log10(self.low), math.log10(self.high))
+        return random.uniform(self.low, self.high)
+
+
+class RandInt(Distribution):
+    """Integer from [low, high], both ends included"""
+
+    def __init__(self, low, high):
+        assert low <= high
+        self.low = low
+        self.high = high
+
+    def sample(self):
+        return random.randint(self.low, self.high)
+
+
+class Choice(Distribution):
+    """One of the choices"""
+
+    def __init__(self, choices):
+        assert len(choices) > 0
+        self.choices = list(choices)
+
+    def sample(self):
+        return self.choices[random.randint(0, len(self.choices) - 1)]
+
+
+def flatten_space(space, prefix=""):
+    """Return {'dotted.key': Distribution} of the search space"""
+    flat = {}
+    for key, value in space.items():
+        if isinstance(value, Distribution):
+            flat[f"{prefix}{key}"] = value
+        elif isinstance(value, dict):
+            flat.update(flatten_space(value, prefix=f"{prefix}{key}."))
+    return flat
+
+
+def fill_space(space, params, prefix=""):
+    """Return a copy of the search space with the distributions replaced by params"""
+    filled = {}
+    for key, value in space.items():
+        if isinstance(value, Distribution):
+            filled[key] = params[f"{prefix}{key}"]
+        elif isinstance(value, dict):
+            filled[key] = fill_space(value, params, prefix=f"{prefix}{key}.")
+        else:
+            filled[key] = deepcopy(value)
+    return filled
+
+
+def sample_random_HPs(space):
+    """Sample independent values from the search space distributions"""
+    params = {key: dist.sample() for key, dist in flatten_space(space).items()}
+    return OmegaConf.create(fill_space(space, params))
+
+
+def load_trial_history(cfg, space):
+    """
+    Load the HPs and the scores of the finished trials of the current tuning fold
+    from the project's results store (trial_runs.csv by default).
+    Returns a list of (params, score) tuples, score is None for pruned trials
+    """
+    results_store = results_store_factory(cfg)
+    df = results_store.trial_runs(cfg)
+
+    flat_space = flatten_space(space)
+    history = []
+    for _, row in df.iterrows():
+        try:
+            trial_cfg = results_store.load_config(row["path_to_config"])
+        except FileNotFoundError:
+            continue
+        params = {key: OmegaConf.select(trial_cfg, key) for key in flat_space}
+        if any(value is None for value in params.values()):
+            # trial was sampled from a different search space
+            continue
+
+        pruned = "pruned" in row and bool(row["pruned"])
+        score = None if pruned or np.isnan(row["score"]) else float(row["score"])
+        history.append((params, score))
+
+    return history
+
+
+class TPESampler:
+    """
+    Tree-structured Parzen Estimator (Bergstra et al., 2011,
+    https://papers.nips.cc/paper/4443-algorithms-for-hyper-parameter-optimization).
+
+    The finished trials are split into the top `gamma` fraction by score (good)
+    and the rest (bad); pruned trials always count as bad.
+    For each HP, Parzen estimators l(x) and g(x) are fitted on the good and the bad values,
+    `n_candidates` values are drawn from l(x), and the one maximizing l(x)/g(x) is proposed.
+    HPs are treated independently, as in the original univariate TPE.
+    Until `n_startup_trials` trials are finished, HPs are sampled at random.
+
+    The sampler is stateless: the history is re-read from the results store,
+    so interrupted tuning can be resumed without extra files.
+    """
+
+    def __init__(self, tpe_cfg: DictConfig):
+        self.n_startup_trials = tpe_cfg.n_startup_trials
+        self.gamma = tpe_cfg.gamma
+        self.n_candidates = tpe_cfg.n_candidates
+        self.rng = np.random.default_rng()
+
+    def sample(self, space, history):
+        """Propose HPs given the search space and the history of finished trials"""
+        scored = [(params, score) for params, score in history if score is not None]
+        if len(scored) < self.n_startup_trials:
+            return sample_random_HPs(space)
+
+        pruned = [params for params, score in history if score is None]
+        scored = sorted(scored, key=lambda item: item[1], reverse=True)
+        n_good = max(1, math.ceil(self.gamma * len(scored)))
+        good = [params for params, _ in scored[:n_good]]
+        bad = [params for params, _ in scored[n_good:]] + pruned
+
+        params = {}
+        for key, dist in flatten_space(space).items():
+            good_values = [p[key] for p in good]
+            bad_values = [p[key] for p in bad]
+            if isinstance(dist, Choice):
+                params[key] = self.sample_choice(dist, good_values, bad_values)
+            else:
+                params[key] = self.sample_numerical(dist, good_values, bad_values)
+
+        return OmegaConf.create(fill_space(space, params))
+
+    def sample_choice(self, dist, good_values, bad_values):
+        """Sample a categorical HP maximizing l(x)/g(x)"""
+
+        def weights(values):
+            # prior weight 1 for each choice
+            counts = np.ones(len(dist.choices))
+            for value in values:
+                if value in dist.choices:
+                    counts[dist.choices.index(value)] += 1
+            return counts / counts.sum()
+
+        l_weights, g_weights = weights(good_values), weights(bad_values)
+        candidates = self.rng.choice(
+            len(dist.choices), size=self.n_candidates, p=l_weights
+        )
+        ratio = np.log(l_weights[candidates]) - np.log(g_weights[candidates])
+        return dist.choices[int(candidates[np.argmax(ratio)])]
+
+    def sample_numerical(self, dist, good_values, bad_values):
+        """Sample a float or integer HP maximizing l(x)/g(x)"""
+        if isinstance(dist, RandInt):
+            low, high = dist.low - 0.5, dist.high + 0.5
+            transform = float
+        elif dist.log:
+            low, high = math.log(dist.low), math.log(dist.high)
+            transform = math.log
+        else:
+            low, high = dist.low, dist.high
+            transform = float
+
+        good = np.array([transform(value) for value in good_values], dtype=float)
+        bad = np.array([transform(value) for value in bad_values], dtype=float)
+
+        l_mus, l_sigmas = self.parzen_estimator(good, low, high)
+        g_mus, g_sigmas = self.parzen_estimator(bad, low, high)
+
+        candidates = self.sample_mixture(l_mus, l_sigmas, low, high)
+        ratio = self.mixture_log_pdf(
+            candidates, l_mus, l_sigmas, low, high
+        ) - self.mixture_log_pdf(candidates, g_mus, g_sigmas, low, high)
+        best = candidates[np.argmax(ratio)]
+
+        if isinstance(dist, RandInt):
+            return int(np.clip(np.round(best), dist.low, dist.high))
+        if dist.log:
+            return float(np.clip(np.exp(best), dist.low, dist.high))
+        return float(best)
+
+    @staticmethod
+    def parzen_estimator(values, low, high):
+        """
+        Gaussian components centered at the observations plus a wide prior component
+        at the middle of the range; bandwidths are the distances to the neighbours
+        """
+        prior_mu, prior_sigma = 0.5 * (low + high), high - low
+        mus = np.append(values, prior_mu)
+        order = np.argsort(mus)
+        sorted_mus = mus[order]
+
+        padded = np.concatenate(([low], sorted_mus, [high]))
+        sigmas = np.maximum(padded[1:-1] - padded[:-2], padded[2:] - padded[1:-1])
+        min_sigma = (high - low) / min(100.0, 1.0 + len(mus))
+        sigmas = np.clip(sigmas, min_sigma, high - low)
+
+        unsorted_sigmas = np.empty_like(sigmas)
+        unsorted_sigmas[order] = sigmas
+        unsorted_sigmas[-1] = prior_sigma
+        return mus, unsorted_sigmas
+
+    def sample_mixture(self, mus, sigmas, low, high):
+        """Sample n_candidates values from the truncated Gaussian mixture"""
+        components = self.rng.integers(0, len(mus), size=self.n_candidates)
+        samples = self.rng.normal(mus[components], sigmas[components])
+        # resample out-of-range values, clip the stubborn ones
+        for _ in range(10):
+            outside = (samples < low) | (samples > high)
+            if not outside.any():
+                break
+            samples[outside] = self.rng.normal(
+                mus[components[outside]], sigmas[components[outside]]
+            )
+        return np.clip(samples, low, high)
+
+    @staticmethod
+    def mixture_log_pdf(x, mus, sigmas, low, high):
+        """Log-density of the equally weighted truncated Gaussian mixture"""
+
+        def normal_cdf(z):
+            return 0.5 * (1 + np.vectorize(math.erf)(z / math.sqrt(2)))
+
+        mass = normal_cdf((high - mus) / sigmas) - normal_cdf((low - mus) / sigmas)
+        z = (x[:, None] - mus[None, :]) / sigmas[None, :]
+        log_pdf = (
+            -0.5 * z**2
+            - np.log(sigmas[None, :] * math.sqrt(2 * math.pi))
+            - np.log(np.maximum(mass[None, :], 1e-12))
+        )
+        max_log_pdf = log_pdf.max(axis=1, keepdims=True)
+        return (
+            max_log_pdf[:, 0]
+            + np.log(np.exp(log_pdf - max_log_pdf).sum(axis=1))
+            - np.log(len(mus))
+        )
@@ -3,6 +3,7 @@
 from importlib import import_module
 import gc
 import os
+import random
 import time
 import warnings
 from pprint import pprint
@@ -13,14 +14,20 @@ from torch import nn, randperm as rp
 import numpy as np
 import pandas as pd
 
-from captum.attr import Saliency
-
 from tqdm import tqdm
 from apto.utils.report import get_classification_report
 
 from omegaconf import OmegaConf, open_dict
 
-import wandb
+from src.attribution import Attribution
+from src.profiling import (
+    StepTimer,
+    profiler_factory,
+    MemoryAccount,
+    write_memory_records,
+)
+from src.pruner import DummyPruner, TrialPruned
+from src.results_store import results_store_factory
 
 warnings.filterwarnings("ignore")
 
@@ -75,7 +82,14 @@ def trainer_factory(
 
 
 class BasicTrainer:
-    """Basic training script"""
+    """
+    Basic training script.
+    Batches are tuples (*inputs, target), with the inputs in the key_order of
+    src.dataloader.common_dataloader (e.g. (TS, FNC, labels) for TS-FNC models),
+    which are passed to the model as model(*inputs).
+    Models can return (logits, *aux) tuples, the auxiliary outputs are passed
+    to the criterion as criterion(logits, *aux, target, model, device)
+    """
 
     def __init__(
         self,
@@ -96,6 +110,7 @@ class BasicTrainer:
         self.optimizer = optimizer
         self.scheduler = scheduler
         self.logger = logger
+        self.results_store = results_store_factory(cfg)
 
         if "permute" in cfg and cfg.permute == "Multiple":
             self.permute = True
@@ -113,6 +128,16 @@ class BasicTrainer:
             minimize=True,
             patience=self.cfg.mode.patience,
         )
+        # can be replaced with src.pruner.ASHAPruner in tune mode
+        self.pruner = DummyPruner()
+
+        # full training state is saved every checkpoint_interval epochs,
+        # so resumed experiments continue interrupted runs from the last saved epoch
+        self.train_state_path = f"{self.save_path}/train_state.pt"
+        if "checkpoint_interval" in self.cfg and self.cfg.checkpoint_interval:
+            self.checkpoint_interval = self.cfg.checkpoint_interval
+        else:
+            self.checkpoint_interval = 0
 
         # set device
         if torch.cuda.is_available():
@@ -132,6 +157,13 @@ class BasicTrainer:
 
         self.model = model.to(self.device)
 
+        # per-stage timing of the training loop
+        self.timer = StepTimer(
+            enabled="timing" in self.cfg and self.cfg.timing, device=self.device
+        )
+        # torch.profiler capture of the selected epochs
+        self.profiler = profiler_factory(self.cfg)
+
         # log configs
         self.logger.config.update(
             {"general": OmegaConf.to_container(self.cfg, resolve=True)}
@@ -141,10 +173,10 @@ class BasicTrainer:
         )
 
         # save configs in the run's directory
-        with open(f"{self.save_path}/config.yaml", "w", encoding="utf8") as f:
-            OmegaConf.save(self.cfg, f)
-        with open(f"{self.save_path}/model_config.yaml", "w", encoding="utf8") as f:
-            OmegaConf.save(self.model_cfg, f)
+        self.results_store.add_config(f"{self.save_path}/config.yaml", self.cfg)
+        self.results_store.add_config(
+            f"{self.save_path}/model_config.yaml", self.model_cfg
+        )
 
     def count_params(self, model, only_requires_grad: bool = False):
         "count number trainable parameters in a pytorch model"
@@ -201,49 +233,59 @@ class BasicTrainer:
         total_loss, total_size = 0.0, 0
 
         self.model.train(is_train_dataset)
+        # drop the counters of the failed attempts
+        self.timer.reset()
         start_time = time.time()
 
-        if inference:
-            grads = []
-
         with torch.set_grad_enabled(is_train_dataset):
-            for data, target in self.dataloaders[ds_name]:
-                # permute TS data if needed
+            for *inputs, target in self.timer.iterate(self.dataloaders[ds_name]):
+                # permute TS data (the first input) if needed
                 if is_train_dataset and self.permute:
-                    for i, sample in enumerate(data):
-                        data[i] = sample[rp(sample.shape[0]), :]
-
-                data, target = data.to(self.device), target.to(self.device)
-                total_size += data.shape[0]
-
-                logits = self.model(data)
-                loss = self.criterion(logits, target, self.model, self.device)
-                score = torch.softmax(logits, dim=-1)
-
-                all_scores.append(score.cpu().detach().numpy())
-                all_targets.append(target.cpu().detach().numpy())
-                total_loss += loss.sum().item()
+                    with self.timer.stage("permute"):
+                        data = inputs[0]
+                        for i, sample in enumerate(data):
+                            data[i] = sample[rp(sample.shape[0]), :]
+
+                with self.timer.stage("to_device"):
+                    inputs = [data.to(self.device) for data in inputs]
+                    target = target.to(self.device)
+                total_size += target.shape[0]
+
+                with self.timer.stage("forward"):
+                    logits = self.model(*inputs)
+                    # auxiliary outputs of the model are passed to the criterion
+                    aux = ()
+                    if isinstance(logits, tuple):
+                        logits, *aux = logits
+                with self.timer.stage("loss"):
+                    loss = self.criterion(logits, *aux, target, self.model, self.device)
+
+                with self.timer.stage("metrics"):
+                    score = torch.softmax(logits, dim=-1)
+                    all_scores.append(score.cpu().detach().numpy())
+                    all_targets.append(target.cpu().detach().numpy())
+                    total_loss += loss.sum().item()
 
                 if is_train_dataset:
-                    self.optimizer.zero_grad()
-                    loss.backward()
-                    self.optimizer.step()
+                    with self.timer.stage("backward"):
+                        self.optimizer.zero_grad()
+                        loss.backward()
+                    with self.timer.stage("optimizer"):
+                        self.optimizer.step()
 
-                if inference:
-                    saliency = Saliency(self.model)
-                    grad = saliency.attribute(data, target=target, abs=False)
-                    grads.append(grad.cpu().detach().numpy())
+                self.profiler.step()
 
         average_time = (time.time() - start_time) / total_size
         average_loss = total_loss / total_size
 
-        y_test = np.hstack(all_targets)
-        y_score = np.vstack(all_scores)
-        y_pred = np.argmax(y_score, axis=-1).astype(np.int32)
+        with self.timer.stage("metrics"):
+            y_test = np.hstack(all_targets)
+            y_score = np.vstack(all_scores)
+            y_pred = np.argmax(y_score, axis=-1).astype(np.int32)
 
-        report = get_classification_report(
-            y_true=y_test, y_pred=y_pred, y_score=y_score, beta=0.5
-        )
+            report = get_classification_report(
+                y_true=y_test, y_pred=y_pred, y_score=y_score, beta=0.5
+            )
 
         metrics = {
             ds_name + "_accuracy": report["precision"].loc["accuracy"],
@@ -251,14 +293,7 @@ class BasicTrainer:
             ds_name + "_average_loss": average_loss,
             ds_name + "_average_time": average_time,
         }
-
-        if inference:
-            grads = np.vstack(grads)
-            for class_label in range(self.cfg.dataset.data_info.main.n_classes):
-                np.save(
-                    f"{self.save_path}/{ds_name}_grads_{class_label}.npy",
-                    grads[y_test == class_label],
-                )
+        metrics.update(self.timer.collect(ds_name))
 
         return metrics
 
@@ -267,7 +302,25 @@ class BasicTrainer:
         start_time = time.time()
 
         train_results = []
-        for epoch in tqdm(range(self.epochs)):
+        start_epoch = 0
+        if (
+            "resume" in self.cfg
+            and self.cfg.resume
+            and os.path.exists(self.train_state_path)
+        ):
+            train_state = self.load_train_state()
+            if train_state is not None:
+                start_epoch, train_results, elapsed = train_state
+                start_time -= elapsed
+                print(f"Resuming training from epoch {start_epoch}")
+
+        pruned = False
+        pruned_epoch = None
+        for epoch in tqdm(
+            range(start_epoch, self.epochs), initial=start_epoch, total=self.epochs
+        ):
+            self.profiler.start_epoch(epoch)
+
             # run train and valid dataloaders
             results = self.run_epoch("train")
             results.update(self.run_epoch("valid"))
@@ -278,11 +331,31 @@ class BasicTrainer:
             # update scheduler
             self.scheduler.step(results["valid_average_loss"])
 
-            # check early stopping criterion
-            self.early_stopping(results["valid_average_loss"], self.model, epoch)
+            # check early stopping criterion, save the training state
+            with self.timer.stage("checkpoint"):
+                self.early_stopping(results["valid_average_loss"], self.model, epoch)
+                if (
+                    self.checkpoint_interval
+                    and (epoch + 1) % self.checkpoint_interval == 0
+                    and not self.early_stopping.early_stop
+                ):
+                    self.save_train_state(
+                        epoch + 1, train_results, time.time() - start_time
+                    )
+            results.update(self.timer.collect("epoch"))
             if self.early_stopping.early_stop:
                 break
 
+            # check if the trial is hopeless compared to the other trials
+            pruned = self.pruner.report_epoch(
+                self.cfg.run_ids.trial, self.cfg.run_ids.inner_k, epoch, results
+            )
+            if pruned:
+                pruned_epoch = epoch
+                break
+
+        self.profiler.stop()
+
         if self.early_stopping.early_stop:
             print("EarlyStopping triggered")
 
@@ -291,27 +364,108 @@ class BasicTrainer:
         train_results["epoch"] = train_results.index
         epoch = train_results.pop("epoch")
         train_results.insert(0, "epoch", epoch)
-        train_results.to_csv(f"{self.save_path}/train_log.csv", index=False)
+        with self.timer.stage("logging"):
+            self.results_store.add_epochs(self.cfg, train_results)
+            self.logger.log_train_results(train_results)
 
-        table = wandb.Table(dataframe=train_results)
-        self.logger.log(
-            {
-                "train_average_loss": wandb.plot.line(
-                    table, "epoch", "train_average_loss", title="train_average_loss"
-                )
-            }
+        self.training_time = time.time() - start_time
+        self.logger.summary["training_time"] = self.training_time
+
+        # total time spent in each stage
+        if self.timer.enabled:
+            for column in train_results.columns:
+                if "_time_" in column:
+                    self.logger.summary[f"total_{column}"] = train_results[column].sum()
+            for key, value in self.timer.collect("run").items():
+                self.logger.summary[f"total_{key}"] = value
+
+        if pruned:
+            self.logger.summary["pruned"] = True
+            self.remove_train_state()
+            raise TrialPruned(f"Trial is pruned at epoch {pruned_epoch}")
+
+    def save_train_state(self, epoch, train_results, training_time):
+        """
+        Save everything needed to continue training from `epoch` to '{run_dir}/train_state.pt':
+        model, optimizer, scheduler and early stopping states, RNG states and the train log so far.
+        The file is replaced atomically, so an interruption never leaves a broken state
+        """
+        state = {
+            "epoch": epoch,
+            "model": self.model.state_dict(),
+            "optimizer": self.optimizer.state_dict(),
+            "scheduler": self.scheduler.state_dict(),
+            "early_stopping": self.early_stopping.state_dict(),
+            "train_results": train_results,
+            "training_time": training_time,
+            "batch_size": self.cfg.mode.batch_size,
+            "model_config": self.model_config_yaml(),
+            "rng": {
+                "torch": torch.get_rng_state(),
+                "cuda": torch.cuda.get_rng_state_all()
+                if torch.cuda.is_available()
+                else None,
+                "numpy": np.random.get_state(),
+                "python": random.getstate(),
+            },
+        }
+        torch.save(state, f"{self.train_state_path}.tmp")
+        os.replace(f"{self.train_state_path}.tmp", self.train_state_path)
+
+    def load_train_state(self):
+        """
+        Restore the state saved by save_train_state,
+        return the epoch to continue from, the train log so far and the training time so far.
+        A state saved with a different model config is removed and None is returned
+        """
+        state = torch.load(
+            self.train_state_path, map_location=self.device, weights_only=False
         )
-        self.logger.log(
-            {
-                "valid_average_loss": wandb.plot.line(
-                    table, "epoch", "valid_average_loss", title="valid_average_loss"
+        # the run dir might have been reused with new HPs (e.g. the trial was restarted)
+        if state.get("model_config") != self.model_config_yaml():
+            print("Saved training state has a different model config, training from scratch")
+            self.remove_train_state()
+            return None
+
+        self.model.load_state_dict(state["model"])
+        self.optimizer.load_state_dict(state["optimizer"])
+        self.scheduler.load_state_dict(state["scheduler"])
+        self.early_stopping.load_state_dict(state["early_stopping"])
+
+        # batch size might have been reduced after CUDA OOM
+        if state["batch_size"] != self.cfg.mode.batch_size:
+            with open_dict(self.cfg):
+                self.cfg.mode.batch_size = state["batch_size"]
+            for key in self.dataloaders:
+                self.dataloaders[key] = DataLoader(
+                    self.dataloaders[key].dataset,
+                    batch_size=self.cfg.mode.batch_size,
+                    num_workers=0,
+                    shuffle=key == "train",
                 )
-            }
+
+        torch.set_rng_state(state["rng"]["torch"].cpu())
+        if state["rng"]["cuda"] is not None and torch.cuda.is_available():
+            torch.cuda.set_rng_state_all([s.cpu() for s in state["rng"]["cuda"]])
+        np.random.set_state(state["rng"]["numpy"])
+        random.setstate(state["rng"]["python"])
+
+        self.pruner.restore(
+            self.cfg.run_ids.trial, self.cfg.run_ids.inner_k, state["train_results"]
         )
-        self.logger.log({"train_table": table})
 
-        self.training_time = time.time() - start_time
-        self.logger.summary["training_time"] = self.training_time
+        return state["epoch"], state["train_results"], state["training_time"]
+
+    def model_config_yaml(self):
+        """Model config without the bookkeeping keys (wandb link of the tuning process)"""
+        model_cfg = OmegaConf.to_container(self.model_cfg, resolve=True)
+        model_cfg.pop("link", None)
+        return OmegaConf.to_yaml(model_cfg)
+
+    def remove_train_state(self):
+        """The training state is not needed after the run is finished"""
+        if os.path.exists(self.train_state_path):
+            os.remove(self.train_state_path)
 
     def test(self):
         """Start testing"""
@@ -321,35 +475,52 @@ class BasicTrainer:
             if key not in ["train", "valid"]:
                 self.test_results.update(results)
 
+        # input attributions of the trained model
+        self.timer.reset()
+        with self.timer.stage("attribution"):
+            Attribution(self.cfg, self.model, self.device).run(
+                self.dataloaders, self.save_path
+            )
+        if self.timer.enabled:
+            for key, value in self.timer.collect("run").items():
+                self.logger.summary[f"total_{key}"] = value
+
         # log test results
-        test_results = pd.DataFrame(self.test_results, index=[0])
-        test_results.to_csv(f"{self.save_path}/test_log.csv", index=False)
+        self.results_store.add_test(self.cfg, self.test_results)
 
         self.logger.log(self.test_results)
 
     def run(self):
         """Run training script"""
+        # tracing every allocation of the training loop would slow it down ~100x
+        memory_account = MemoryAccount(self.cfg, "trainer_run", trace=False)
+        with memory_account:
+            print("Training model")
+            self.train()
+
+            print("Loading best model")
+            model_logpath = f"{self.save_path}/best_model.pt"
+            checkpoint = torch.load(
+                model_logpath, map_location=lambda storage, loc: storage
+            )
+            self.model.load_state_dict(checkpoint)
+
+            print("Testing trained model")
+            self.test_results = {}
+            self.test_results["training_time"] = self.training_time
+            if memory_account.enabled:
+                # the timings include the overhead of the memory accounting
+                self.test_results["timing_valid"] = False
+            self.test()
+        write_memory_records(self.cfg, self.logger)
 
-        print("Training model")
-        self.train()
-
-        print("Loading best model")
-        model_logpath = f"{self.save_path}/best_model.pt"
-        checkpoint = torch.load(
-            model_logpath, map_location=lambda storage, loc: storage
-        )
-        self.model.load_state_dict(checkpoint)
-
-        print("Testing trained model")
-        self.test_results = {}
-        self.test_results["training_time"] = self.training_time
-        self.test()
         print("Test results:")
         pprint(self.test_results, indent=2)
         print("Done!")
 
         if not self.cfg.mode.preserve_checkpoints:
             os.remove(f"{self.save_path}/best_model.pt")
+        self.remove_train_state()
 
         return self.test_results
 
@@ -391,6 +562,18 @@ class EarlyStopping:
                 if self.counter >= self.patience:
                     self.early_stop = True
 
+    def state_dict(self):
+        return {
+            "counter": self.counter,
+            "best_score": self.best_score,
+            "early_stop": self.early_stop,
+        }
+
+    def load_state_dict(self, state):
+        self.counter = state["counter"]
+        self.best_score = state["best_score"]
+        self.early_stop = state["early_stop"]
+
     def save_checkpoint(self, model):
         # based on callback from animus package
         """Saves model if criterion is met"""
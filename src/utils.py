@@ -3,12 +3,12 @@
 
 import os
 import glob
-import shutil
 
 from omegaconf import open_dict, OmegaConf, DictConfig
 import pandas as pd
 
 from src.settings import UTCNOW, LOGS_ROOT
+from src.results_store import results_store_factory
 
 
 def set_project_name(cfg: DictConfig):
@@ -60,7 +60,10 @@ def set_project_name(cfg: DictConfig):
 
 
 def set_run_name(cfg: DictConfig, outer_k=None, trial=None, inner_k=None):
-    """set wandb run name and run directories"""
+    """set wandb run name, run directories and run indices"""
+    with open_dict(cfg):
+        cfg.run_ids = {"outer_k": outer_k, "trial": trial, "inner_k": inner_k}
+
     if cfg.mode.name == "tune":
         if ("single_HP" in cfg and cfg.single_HP) or (
             "tuning_holdout" in cfg.dataset and cfg.dataset.tuning_holdout
@@ -147,40 +150,58 @@ def get_resume_params(cfg: DictConfig) -> DictConfig:
     with open_dict(interrupted_cfg):
         interrupted_cfg.resume = True
 
+    if "results_store" in interrupted_cfg and interrupted_cfg.results_store:
+        # progress is recorded in the results database
+        results_store = results_store_factory(interrupted_cfg)
+        last_k = results_store.last_outer_k(cfg.mode.name)
+        starting_k = 0 if last_k is None or last_k < 0 else last_k
+    else:
+        results_store = None
+
     if cfg.mode.name == "tune":
         if ("single_HP" in cfg and cfg.single_HP) or (
             "tuning_holdout" in cfg.dataset and cfg.dataset.tuning_holdout
         ):
             starting_k = 0
             search_dir = cfg.project_dir
+            outer_k = None
         else:
-            starting_k = max(len(glob.glob(f"{cfg.project_dir}/k_*")) - 1, 0)
+            if results_store is None:
+                starting_k = max(len(glob.glob(f"{cfg.project_dir}/k_*")) - 1, 0)
             search_dir = f"{cfg.project_dir}/k_{starting_k:02d}"
+            outer_k = starting_k
 
-        try:
-            df = pd.read_csv(f"{search_dir}/trial_runs.csv")
-            interrupted_trial = len(df)
-        except FileNotFoundError:
-            interrupted_trial = 0
+        if results_store is not None:
+            interrupted_trial = len(results_store.trial_runs(None, outer_k=outer_k))
+        else:
+            try:
+                df = pd.read_csv(f"{search_dir}/trial_runs.csv")
+                interrupted_trial = len(df)
+            except FileNotFoundError:
+                interrupted_trial = 0
 
         interrupted_dir = f"{search_dir}/trial_{interrupted_trial:04d}"
 
     elif cfg.mode.name == "exp":
-        starting_k = max(len(glob.glob(f"{cfg.project_dir}/k_*")) - 1, 0)
+        if results_store is None:
+            starting_k = max(len(glob.glob(f"{cfg.project_dir}/k_*")) - 1, 0)
         search_dir = f"{cfg.project_dir}/k_{starting_k:02d}"
-        try:
-            df = pd.read_csv(f"{search_dir}/fold_runs.csv")
-            interrupted_trial = len(df)
-        except FileNotFoundError:
-            interrupted_trial = 0
+
+        if results_store is not None:
+            interrupted_trial = len(results_store.fold_runs(None, outer_k=starting_k))
+        else:
+            try:
+                df = pd.read_csv(f"{search_dir}/fold_runs.csv")
+                interrupted_trial = len(df)
+            except FileNotFoundError:
+                interrupted_trial = 0
 
         interrupted_dir = f"{search_dir}/trial_{interrupted_trial:04d}"
 
-    print(f"Deleting interrupted run logs in '{interrupted_dir}'")
-    try:
-        shutil.rmtree(interrupted_dir)
-    except FileNotFoundError:
-        print("Could not delete interrupted run logs - FileNotFoundError")
+    # the interrupted trial is continued: finished inner folds (tune mode) are kept,
+    # and the interrupted run continues from its last saved training state, if any
+    # (see checkpoint_interval and src.trainer.BasicTrainer.save_train_state)
+    print(f"Resuming interrupted trial in '{interrupted_dir}'")
 
     if interrupted_trial == interrupted_cfg.mode.n_trials:
         interrupted_trial = 0